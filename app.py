@@ -1,60 +1,133 @@
-from flask import Flask, request, jsonify, render_template, flash, redirect, url_for, session
+from flask import Flask, Request, Response, request, jsonify, render_template, flash, redirect, url_for, session
 from blockchain.block import Block
 from blockchain.chain import Blockchain
 from blockchain.merkle_tree import MerkleTree
-from crypto.hash_utils import sha256
+from blockchain.merkle_proof import encode_proof, proof_to_base64
+from blockchain.batcher import BlockBatcher, BATCH_MAX_DOCS, BATCH_MAX_BYTES, BATCH_MAX_DELAY_MS
+from crypto.hash_utils import sha256_stream, HashingFile
 from crypto.key_manager import get_private_key_from_id, generate_keypair
-from storage.ipfs_client import add_file, IPFSDaemon
+from storage.ipfs_client import connect_api, IPFSDaemon
+from storage.chain_store import ChainStore
+from storage.upload_queue import UploadQueue
 import time
 import os
 import tempfile
 import logging
 import atexit
-import glob
 import json
-from collections import deque
+import hashlib
+import tarfile
+import zipfile
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+class UploadRequest(Request):
+    # Uploaded files are spooled to named temp files and hashed while the body is parsed,
+    # so each upload is read once and can be handed to the upload queue without copying
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spooled_files = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spooled = HashingFile(tempfile.NamedTemporaryFile(delete=False))
+        self.spooled_files.append(spooled)
+        return spooled
+
+    # Take over the temp file behind an uploaded file, returning (path, hash, size)
+    def claim_upload(self, file):
+        spooled = file.stream
+        spooled.close()
+        self.spooled_files.remove(spooled)
+        return spooled.name, spooled.digest(), spooled.size
+
+    # Remove the spooled uploads nobody claimed
+    def close(self):
+        super().close()
+        for spooled in self.spooled_files:
+            spooled.close()
+            os.unlink(spooled.name)
+        self.spooled_files = []
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = 'TEST'
-blockchain = Blockchain()
+
+# Blocks are persisted to append-only segment files so the ledger survives restarts
+chain_store = ChainStore(os.environ.get('CHAIN_DATA_DIR', './chain_data'))
+
+# Set when several worker processes (e.g. gunicorn workers) serve the same chain data directory
+SHARED_STATE = os.environ.get('CHAIN_SHARED_STATE') == '1'
+
+# Only one process may create the genesis block, so the chain is opened under the store's write lock
+with chain_store.writer():
+    chain_store.refresh()
+    blockchain = Blockchain(store=chain_store)
 
 # Ensure keys directory exists
 os.makedirs('./keys', exist_ok=True)
 
-# Initialize IPFS daemon
-ipfs_daemon = IPFSDaemon()
-ipfs_daemon.start()
-
 # IPFS node address
 IPFS_NODE = "/ip4/127.0.0.1/tcp/5001"
+connect_api(IPFS_NODE)
 
-# Store pending documents
-pending_docs = deque(maxlen=2)
+# Initialize IPFS daemon without blocking startup; an already running daemon is reused
+ipfs_daemon = IPFSDaemon(IPFS_NODE)
+ipfs_daemon.start(background=True)
 
-# Cleanup function to remove all key files and reset key registry
-def cleanup_keys():
-    try:
-        # Remove all .pem files from keys directory
-        key_files = glob.glob('./keys/*.pem')
-        for key_file in key_files:
-            os.remove(key_file)
-            logger.info(f"Removed key file: {key_file}")
-        
-        # Reset key registry
-        with open('key_registry.json', 'w') as f:
-            json.dump({}, f, indent=4)
-        logger.info("Reset key registry")
-        
-    except Exception as e:
-        logger.error(f"Error during cleanup: {str(e)}")
+# Documents are pushed to IPFS in the background; each records a pending CID until its upload finishes
+upload_queue = UploadQueue()
+
+# Threads that run blocking work (body parsing, signing, Merkle trees) for the async views
+BLOCKING_WORKERS = 32
+blocking_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BLOCKING_WORKERS', BLOCKING_WORKERS)))
+
+# Await a blocking call on the worker threads, keeping the request context available to it
+async def run_blocking(func, *args):
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, call)
+
+# Parse the request's multipart body, which reads and hashes every uploaded file
+def parse_files():
+    return request.files
+
+# Blocks per page of the chain view and block API, and the largest page a client may ask for
+CHAIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# Seal a signer's pending documents into a block, reusing the tree the batch built as documents arrived
+def seal_block(signer_id, docs, accumulator):
+    merkle_tree = MerkleTree.from_accumulator(accumulator)
+    return create_block_from_docs(docs, signer_id, get_private_key_from_id(signer_id), merkle_tree)
+
+# Pending documents are batched per signer; a block is sealed on a document count, byte size or age limit
+batcher = BlockBatcher(
+    seal_block,
+    max_docs=int(os.environ.get('BATCH_MAX_DOCS', BATCH_MAX_DOCS)),
+    max_bytes=int(os.environ.get('BATCH_MAX_BYTES', BATCH_MAX_BYTES)),
+    max_delay_ms=int(os.environ.get('BATCH_MAX_DELAY_MS', BATCH_MAX_DELAY_MS)),
+    leaf=lambda doc: doc['hash']
+)
 
 # Register cleanup functions
-atexit.register(cleanup_keys)
+# (atexit runs them in reverse: pending batches are sealed before the store closes).
+# Key files and the registry are kept, since the stored blocks are verified with them after a restart.
+atexit.register(chain_store.close)
 atexit.register(ipfs_daemon.cleanup)
+atexit.register(upload_queue.close)
+atexit.register(blocking_executor.shutdown)
+atexit.register(batcher.flush_all)
+
+# Pick up blocks sealed by other worker processes before serving each request
+@app.before_request
+def refresh_chain():
+    if SHARED_STATE:
+        blockchain.refresh()
 
 def check_credentials(signer_id):
     """Check if a signer has valid credentials."""
@@ -74,10 +147,14 @@ def index():
             return redirect(url_for('index'))
         
         try:
-            output_path = './keys'
-            generate_keypair(output_path, signer_id)
+            # A registered signer keeps its keys; new ones would orphan the blocks it already signed
+            if check_credentials(signer_id):
+                flash('Signed in with existing credentials', 'success')
+            else:
+                output_path = './keys'
+                generate_keypair(output_path, signer_id)
+                flash('Successfully registered', 'success')
             session['signer_id'] = signer_id
-            flash('Successfully registered', 'success')
             return redirect(url_for('upload'))
         except Exception as e:
             flash(f'Error generating credentials: {str(e)}', 'danger')
@@ -87,7 +164,7 @@ def index():
 
 # Upload page
 @app.route('/upload', methods=['GET', 'POST'])
-def upload():
+async def upload():
     if 'signer_id' not in session:
         flash('Please enter a signer ID', 'warning')
         return redirect(url_for('index'))
@@ -98,55 +175,32 @@ def upload():
         return redirect(url_for('index'))
     
     if request.method == 'POST':
-        if 'file' not in request.files:
+        files = await run_blocking(parse_files)
+        if 'file' not in files:
             flash('No file selected', 'danger')
             return redirect(request.url)
         
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             flash('No file selected', 'danger')
             return redirect(request.url)
         
+        file_path = None
         try:
-            # Save file temporarily using system temp directory
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                file.save(temp_file.name)
-                file_path = temp_file.name
-            
-            # Add file to IPFS if daemon is available
-            if ipfs_daemon:
-                try:
-                    ipfs_hash = add_file(file_path)
-                    logger.info(f"File added to IPFS with hash: {ipfs_hash}")
-                except Exception as e:
-                    logger.error(f"Failed to add file to IPFS: {str(e)}")
-                    ipfs_hash = f"Qm{sha256(open(file_path, 'rb').read()).hex()[:40]}"
-            else:
-                logger.warning("IPFS daemon not available, using mock hash")
-                ipfs_hash = f"Qm{sha256(open(file_path, 'rb').read()).hex()[:40]}"
+            # The upload was spooled to a temp file and hashed while the body was parsed
+            file_path, file_hash, file_size = request.claim_upload(file)
             
-            # Calculate file hash
-            file_hash = sha256(open(file_path, 'rb').read())
-            
-            # Add document to pending queue
-            doc_info = {
-                'hash': file_hash,
-                'ipfs_hash': ipfs_hash,
-                'file_path': file_path
-            }
-            pending_docs.append(doc_info)
+            # Queue the file for IPFS; the queue now owns the temp file and fills in the CID later
+            doc_info = upload_queue.submit(file_hash, file_path)
+            file_path = None
             
-            # If we have two documents, create a new block
-            if len(pending_docs) == 2:
-                private_key = get_private_key_from_id(session['signer_id'])
-                new_block = create_block_from_docs(pending_docs, session['signer_id'], private_key)
-                if new_block:
-                    flash('Block created successfully', 'success')
-                    pending_docs.clear()
-                else:
-                    flash('Failed to create block', 'danger')
+            # Add document to the signer's pending batch, which seals a block once a limit is reached;
+            # sealing signs the block, so it runs on the worker threads
+            new_block = await run_blocking(batcher.add, session['signer_id'], doc_info, file_size)
+            if new_block:
+                flash('Block created successfully', 'success')
             else:
-                flash('Document added to pending queue', 'info')
+                flash('Document added to pending batch', 'info')
             
             return redirect(url_for('upload'))
             
@@ -154,14 +208,14 @@ def upload():
             flash(f'Error processing document: {str(e)}', 'danger')
             return redirect(request.url)
         finally:
-            if 'file_path' in locals():
+            if file_path:
                 os.unlink(file_path)
     
     return render_template('upload.html')
 
 # Verify page
 @app.route('/verify', methods=['GET', 'POST'])
-def verify():
+async def verify():
     if 'signer_id' not in session:
         flash('Please enter a signer ID', 'warning')
         return redirect(url_for('index'))
@@ -174,92 +228,336 @@ def verify():
     verification_result = None
     
     if request.method == 'POST':
-        if 'file' not in request.files:
+        files = await run_blocking(parse_files)
+        if 'file' not in files:
             flash('No file selected', 'danger')
             return redirect(request.url)
         
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             flash('No file selected', 'danger')
             return redirect(request.url)
         
         try:
-            # Save file temporarily using system temp directory
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                file.save(temp_file.name)
-                file_path = temp_file.name
+            # The upload was hashed while the body was parsed; its temp file goes with the request
+            file_hash = file.stream.digest()
             
-            # Calculate file hash
-            file_hash = sha256(open(file_path, 'rb').read())
-            
-            # Verify file in blockchain
-            exists, block_index = blockchain.verify_file_in_blockchain(file_hash)
-            
-            if exists:
-                # Get merkle proof
-                proof, _ = blockchain.get_file_proof(file_hash)
-                block = blockchain.chain[block_index]
-                
-                verification_result = {
-                    'verified': True,
-                    'block_index': block_index,
-                    'block_hash': block.hash.hex(),
-                    'merkle_proof': [
-                        {
-                            'hash': p['hash'].hex(),
-                            'direction': p['direction']
-                        } for p in proof
-                    ]
-                }
-            else:
-                verification_result = {
-                    'verified': False,
-                    'message': 'Document not found in blockchain'
-                }
+            # Looking up the proof may rebuild the file index or load the block's tree from disk
+            verification_result = await run_blocking(document_result, file_hash)
             
         except Exception as e:
             flash(f'Error verifying document: {str(e)}', 'danger')
-        finally:
-            if 'file_path' in locals():
-                os.unlink(file_path)
     
     return render_template('verify.html', verification_result=verification_result)
 
-# Chain page
+# Verify a file hash in the blockchain, describing its inclusion or absence
+def document_result(file_hash):
+    proof, block_index = blockchain.get_file_proof(file_hash)
+    if proof is None:
+        return {
+            'verified': False,
+            'message': 'Document not found in blockchain'
+        }
+    return inclusion_result(blockchain.chain[block_index], proof)
+
+# Describe a document's inclusion in a block along with its merkle proof,
+# either as a list of hex entries or as a base64 compact proof
+def inclusion_result(block, proof, compact=False):
+    return {
+        'verified': True,
+        'block_index': block.index,
+        'block_hash': block.hash.hex(),
+        'merkle_proof': proof_to_base64(encode_proof(proof)) if compact else [
+            {
+                'hash': p['hash'].hex(),
+                'direction': p['direction']
+            } for p in proof
+        ]
+    }
+
+# Hash every regular file in an uploaded tar or zip archive, returning (name, hash) pairs.
+# The archive is read from the temp file it was spooled to while the body was parsed.
+def hash_archive_members(archive):
+    spooled = archive.stream
+    spooled.seek(0)
+    if zipfile.is_zipfile(spooled):
+        with zipfile.ZipFile(spooled) as zip_file:
+            return [
+                (info.filename, sha256_stream(zip_file.open(info)))
+                for info in zip_file.infolist() if not info.is_dir()
+            ]
+
+    spooled.seek(0)
+    with tarfile.open(fileobj=spooled, mode='r:*') as tar_file:
+        return [
+            (member.name, sha256_stream(tar_file.extractfile(member)))
+            for member in tar_file if member.isfile()
+        ]
+
+# Batch verification: a JSON list of hex hashes, or a tar/zip archive (multipart field "archive").
+# ?proof_format=compact returns each proof as base64 compact bytes.
+@app.route('/api/v1/documents:verify', methods=['POST'])
+def verify_documents():
+    compact = request.args.get('proof_format') == 'compact'
+    documents = []
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        # A body that is not a JSON object is answered like a missing hash list
+        hashes = payload.get('hashes') if isinstance(payload, dict) else None
+        try:
+            if not isinstance(hashes, list):
+                raise ValueError
+            documents = [(None, bytes.fromhex(file_hash)) for file_hash in hashes]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'hashes must be a list of hex digests'}), 400
+    elif 'archive' in request.files:
+        try:
+            documents = hash_archive_members(request.files['archive'])
+        except (tarfile.TarError, zipfile.BadZipFile):
+            return jsonify({'error': 'archive must be a tar or zip file'}), 400
+    else:
+        return jsonify({'error': 'No hashes or archive given'}), 400
+
+    # One set-based lookup for the whole request, loading each containing block once
+    proofs = blockchain.get_file_proofs([file_hash for _, file_hash in documents])
+    results = []
+    for name, file_hash in documents:
+        proof, block_index = proofs[file_hash]
+        if proof is None:
+            result = {'verified': False}
+        else:
+            result = inclusion_result(blockchain.chain[block_index], proof, compact)
+        result['hash'] = file_hash.hex()
+        if name is not None:
+            result['name'] = name
+        results.append(result)
+
+    return jsonify({'documents': results})
+
+# Prove that a block is part of the chain at a tip (?tip=<index>, the latest block by default).
+# The proof rebuilds the chain root signed into the tip header, so a client holding the tip
+# checks the tip's signature and the proof without trusting the server.
+@app.route('/api/v1/blocks/<int:index>/proof')
+def block_proof(index):
+    tip_index = int_arg('tip', len(blockchain.chain) - 1)
+    if not 0 <= index < tip_index < len(blockchain.chain):
+        return jsonify({'error': 'Block must come before a tip in the chain'}), 404
+    tip = blockchain.chain[tip_index]
+    if not tip.commits_chain:
+        return jsonify({'error': 'Tip header does not commit to a chain root'}), 409
+    proof = blockchain.get_block_proof(index, tip_index)
+    return jsonify({
+        'block_index': index,
+        'block_hash': blockchain.chain[index].hash.hex(),
+        'tip': dict(
+            block_summary(tip),
+            signature=tip.signature.hex(),
+            header_version=tip.header_version,
+            chain_root=tip.chain_root.hex()
+        ),
+        'leaf_count': proof['leaf_count'],
+        'siblings': [sibling.hex() for sibling in proof['siblings']],
+        'peaks': [peak.hex() for peak in proof['peaks']]
+    })
+
+# Upload state of a document
+@app.route('/api/v1/documents/<file_hash>')
+def document_status(file_hash):
+    try:
+        document = upload_queue.get(bytes.fromhex(file_hash))
+    except ValueError:
+        return jsonify({'error': 'Invalid document hash'}), 400
+    if document is None:
+        return jsonify({'error': 'Document not found'}), 404
+    return jsonify({
+        'hash': document['hash'].hex(),
+        'ipfs_hash': document['ipfs_hash'],
+        'status': document['status']
+    })
+
+# Bulk ingest: many files (multipart field "files") and/or precomputed hex hashes ("hashes") per request
+@app.route('/api/v1/documents:batch', methods=['POST'])
+def ingest_documents():
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return jsonify({'error': 'request body must be a JSON object'}), 400
+        hashes = payload.get('hashes', [])
+        signer_id = payload.get('signer_id') or session.get('signer_id')
+    else:
+        hashes = request.form.getlist('hashes')
+        signer_id = request.form.get('signer_id') or session.get('signer_id')
+
+    if not signer_id or not check_credentials(signer_id):
+        return jsonify({'error': 'Unknown signer ID'}), 401
+    if not isinstance(hashes, list):
+        return jsonify({'error': 'hashes must be a list of hex digests'}), 400
+
+    documents = []
+    try:
+        for file_hash in hashes:
+            file_hash = bytes.fromhex(file_hash)
+            if len(file_hash) != 32:
+                raise ValueError
+            documents.append(({'hash': file_hash, 'ipfs_hash': None, 'status': None}, 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'hashes must be a list of hex digests'}), 400
+
+    for file in request.files.getlist('files'):
+        # Each file was spooled and hashed while the body was parsed; hand it to the upload queue
+        file_path = None
+        try:
+            file_path, file_hash, file_size = request.claim_upload(file)
+            documents.append((upload_queue.submit(file_hash, file_path), file_size))
+            file_path = None
+        finally:
+            if file_path:
+                os.unlink(file_path)
+
+    if not documents:
+        return jsonify({'error': 'No documents given'}), 400
+
+    # Hold the batcher so this request's documents land in consecutive batches
+    receipts = []
+    unsealed = []
+    with batcher.lock:
+        for document, size in documents:
+            receipt = {
+                'hash': document['hash'].hex(),
+                'ipfs_hash': document['ipfs_hash'],
+                'ipfs_status': document['status'],
+                'sealed': False
+            }
+            receipts.append(receipt)
+            unsealed.append(receipt)
+
+            new_block = batcher.add(signer_id, document, size)
+            if new_block:
+                for sealed in unsealed:
+                    sealed['sealed'] = True
+                    sealed['pending_block_index'] = new_block.index
+                unsealed = []
+
+        # Documents still pending are provisionally headed for the block after the current tip
+        next_index = blockchain.get_latest_block().index + 1
+        for receipt in unsealed:
+            receipt['pending_block_index'] = next_index
+
+    return jsonify({'signer_id': signer_id, 'documents': receipts})
+
+# Summarize a block header for the chain view and block API
+def block_summary(block):
+    return {
+        'index': block.index,
+        'timestamp': block.timestamp,
+        'merkle_root': block.merkle_root.hex() if isinstance(block.merkle_root, bytes) else block.merkle_root,
+        'prev_hash': block.prev_hash.hex() if isinstance(block.prev_hash, bytes) else block.prev_hash,
+        'signer_id': block.signer_id,
+        'hash': block.hash.hex() if isinstance(block.hash, bytes) else block.hash
+    }
+
+# Read an integer query argument, falling back to a default when it is missing or malformed
+def int_arg(name, default):
+    try:
+        return int(request.args[name])
+    except (KeyError, ValueError):
+        return default
+
+# Page size requested by the client, clamped to MAX_PAGE_SIZE
+def page_limit():
+    return min(max(int_arg('limit', CHAIN_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+
+# ETag for a chain page: the tip hash and the query that selected the page.
+# Returns the tag and, when the client's copy is still current, a 304 response to send instead.
+def chain_etag():
+    tip = blockchain.get_latest_block().hash.hex()
+    etag = hashlib.sha256(f"{tip}?{request.query_string.decode('utf-8', 'replace')}".encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return etag, response
+    return etag, None
+
+# Chain page, newest blocks first; ?before=<index> pages back through older blocks
 @app.route('/chain')
 def view_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        chain_data.append({
-            'index': block.index,
-            'timestamp': block.timestamp,
-            'merkle_root': block.merkle_root.hex() if isinstance(block.merkle_root, bytes) else block.merkle_root,
-            'prev_hash': block.prev_hash.hex() if isinstance(block.prev_hash, bytes) else block.prev_hash,
-            'signer_id': block.signer_id,
-            'hash': block.hash.hex() if isinstance(block.hash, bytes) else block.hash
-        })
-    
-    return render_template('chain.html', chain=chain_data)
+    etag, not_modified = chain_etag()
+    if not_modified:
+        return not_modified
+
+    length = len(blockchain.chain)
+    limit = page_limit()
+    before = min(max(int_arg('before', length), 0), length)
+    start = max(before - limit, 0)
+    chain_data = [block_summary(blockchain.chain[position]) for position in range(before - 1, start - 1, -1)]
+
+    response = app.make_response(render_template(
+        'chain.html',
+        chain=chain_data,
+        older_cursor=start if start > 0 else None,
+        newer_cursor=before + limit if before < length else None,
+        limit=limit
+    ))
+    response.set_etag(etag)
+    return response
+
+# Block headers oldest first, streamed as JSON or, with ?format=ndjson or an NDJSON Accept header,
+# as one JSON object per line. ?after=<index> continues from a previous page's next_cursor.
+@app.route('/api/v1/blocks')
+def list_blocks():
+    etag, not_modified = chain_etag()
+    if not_modified:
+        return not_modified
+
+    length = len(blockchain.chain)
+    limit = page_limit()
+    start = min(max(int_arg('after', -1) + 1, 0), length)
+    end = min(start + limit, length)
+    next_cursor = end - 1 if end < length else None
+    ndjson = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+    def generate_ndjson():
+        for position in range(start, end):
+            yield json.dumps(block_summary(blockchain.chain[position])) + '\n'
+
+    def generate_json():
+        yield '{"blocks": ['
+        for position in range(start, end):
+            yield (', ' if position > start else '') + json.dumps(block_summary(blockchain.chain[position]))
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+    if ndjson:
+        response = Response(generate_ndjson(), mimetype='application/x-ndjson')
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+    else:
+        response = Response(generate_json(), mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 # Create block from documents
-def create_block_from_docs(docs, signer_id, private_key):
+def create_block_from_docs(docs, signer_id, private_key, merkle_tree=None):
     """Create a new block from a list of documents."""
-    # Create merkle tree with all document hashes
-    merkle_tree = MerkleTree([doc['hash'] for doc in docs])
+    # Create merkle tree with all document hashes, unless one was accumulated already
+    if merkle_tree is None:
+        merkle_tree = MerkleTree([doc['hash'] for doc in docs])
     
-    # Create and add new block
-    latest_block = blockchain.get_latest_block()
-    new_block = Block(
-        latest_block.index + 1,
-        time.time(),
-        merkle_tree,
-        latest_block.compute_hash(),
-        signer_id,
-        private_key
-    )
-    
-    if blockchain.add_block(new_block):
-        return new_block
+    # Create and add new block, holding the write lock so other processes cannot extend the same tip
+    with blockchain.exclusive():
+        latest_block = blockchain.get_latest_block()
+        new_block = Block(
+            latest_block.index + 1,
+            time.time(),
+            merkle_tree,
+            latest_block.hash,
+            signer_id,
+            private_key,
+            chain_root=blockchain.get_chain_root()
+        )
+
+        if blockchain.add_block(new_block):
+            return new_block
     return None
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+"""Time full chain validation with different numbers of signature workers.
+
+Run from the repository root, for example on an 8-core machine:
+
+    python benchmarks/validation_benchmark.py --blocks 2000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blockchain import chain
+from blockchain.block import Block
+from blockchain.chain import Blockchain
+from blockchain.merkle_tree import MerkleTree
+from crypto.hash_utils import sha256
+from crypto import key_manager
+from crypto.key_manager import generate_keypair
+
+
+# Build a chain of signed blocks with a few leaves each
+def build_chain(length, signer_id, private_key):
+    blockchain = Blockchain(checkpoint_interval=None)
+    for i in range(length):
+        latest = blockchain.get_latest_block()
+        tree = MerkleTree([sha256(f"bench-{i}-{j}") for j in range(4)])
+        block = Block(latest.index + 1, time.time(), tree, latest.hash, signer_id, private_key,
+                      chain_root=blockchain.get_chain_root())
+        if not blockchain.add_block(block):
+            raise SystemExit(f"Benchmark block {block.index} was rejected")
+    return blockchain
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    # Keys and registry entries of the run live in a scratch directory removed at the end
+    temp_dir = tempfile.mkdtemp()
+    key_manager.KEY_REGISTRY_PATH = os.path.join(temp_dir, "key_registry.json")
+    key_manager.KEY_REGISTRY_DB_PATH = os.path.join(temp_dir, "key_registry.db")
+    chain.KEYS_PATH = temp_dir
+    try:
+        run(args, temp_dir)
+    finally:
+        key_manager.close_registry()
+        shutil.rmtree(temp_dir)
+
+
+# Time validation of a freshly built chain with each worker count
+def run(args, keys_path):
+    signer_id = "bench"
+    private_key, _ = generate_keypair(keys_path, signer_id)
+    print(f"Building a chain of {args.blocks} blocks...")
+    blockchain = build_chain(args.blocks, signer_id, private_key)
+
+    baseline = None
+    print(f"{'workers':>8} {'seconds':>10} {'speedup':>8}")
+    for workers in args.workers:
+        blockchain.validation_workers = workers
+        if workers > 1:
+            # Start the pool outside the timed region
+            blockchain.get_executor().submit(int).result()
+
+        start = time.perf_counter()
+        valid = blockchain.is_valid_chain(blockchain.chain)
+        elapsed = time.perf_counter() - start
+        blockchain.shutdown_executor()
+
+        if not valid:
+            raise SystemExit("Benchmark chain failed validation")
+        baseline = baseline or elapsed
+        print(f"{workers:>8} {elapsed:>10.3f} {baseline / elapsed:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import threading
+from blockchain.merkle_accumulator import MerkleAccumulator
+
+# A pending batch is sealed into a block once it holds this many documents
+BATCH_MAX_DOCS = 1000
+
+# ... or once its documents add up to this many bytes
+BATCH_MAX_BYTES = 64 * 1024 * 1024
+
+# ... or once this many milliseconds have passed since its first document arrived
+BATCH_MAX_DELAY_MS = 2000
+
+
+class PendingBatch:
+    # Documents waiting to be sealed for one signer, with their leaves hashed into a tree as they arrive
+    def __init__(self, accumulate):
+        self.documents = []
+        self.accumulator = MerkleAccumulator() if accumulate else None
+        self.size = 0
+        self.timer = None
+
+
+class BlockBatcher:
+    # Collect documents per signer and seal each signer's batch when any of its limits is reached.
+    # seal(signer_id, documents, accumulator) builds and adds the block, returning it or None on failure.
+    # When leaf(document) is given, each batch feeds a MerkleAccumulator so sealing needs no rehashing;
+    # otherwise accumulator is None.
+    def __init__(self, seal, max_docs=BATCH_MAX_DOCS, max_bytes=BATCH_MAX_BYTES, max_delay_ms=BATCH_MAX_DELAY_MS, leaf=None):
+        self.seal = seal
+        self.leaf = leaf
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_delay_ms = max_delay_ms
+        self.pending = {}
+        # Held while sealing too, so blocks are appended to the chain one at a time
+        self.lock = threading.RLock()
+
+    # Add a document of the given size to a signer's batch, returning the block if this sealed it
+    def add(self, signer_id, document, size=0):
+        with self.lock:
+            batch = self.pending.get(signer_id)
+            if batch is None:
+                batch = self.start_batch(signer_id)
+
+            batch.documents.append(document)
+            if batch.accumulator is not None:
+                batch.accumulator.add(self.leaf(document))
+            batch.size += size
+            if len(batch.documents) >= self.max_docs or batch.size >= self.max_bytes:
+                return self.flush(signer_id)
+            return None
+
+    # Open an empty batch for a signer and arm its deadline
+    def start_batch(self, signer_id, batch=None):
+        batch = batch or PendingBatch(self.leaf is not None)
+        self.pending[signer_id] = batch
+        if self.max_delay_ms is not None:
+            batch.timer = threading.Timer(self.max_delay_ms / 1000, self.expire, args=(signer_id, batch))
+            batch.timer.daemon = True
+            batch.timer.start()
+        return batch
+
+    # Seal a batch whose deadline passed, unless it was already sealed
+    def expire(self, signer_id, batch):
+        with self.lock:
+            if self.pending.get(signer_id) is batch:
+                self.flush(signer_id)
+
+    # Seal a signer's pending documents into a block now
+    def flush(self, signer_id):
+        with self.lock:
+            batch = self.pending.pop(signer_id, None)
+            if batch is None or not batch.documents:
+                return None
+            if batch.timer is not None:
+                batch.timer.cancel()
+
+            try:
+                block = self.seal(signer_id, batch.documents, batch.accumulator)
+            except Exception as e:
+                print(f"Failed to seal block for {signer_id}: {e}")
+                block = None
+            if block is None:
+                # Keep the documents and try again when the next deadline passes
+                self.start_batch(signer_id, batch)
+            return block
+
+    # Seal the pending documents of every signer
+    def flush_all(self):
+        with self.lock:
+            return [block for block in (self.flush(signer_id) for signer_id in list(self.pending)) if block]
+
+    # Number of documents waiting for a signer
+    def pending_count(self, signer_id):
+        with self.lock:
+            batch = self.pending.get(signer_id)
+            return len(batch.documents) if batch else 0
@@ -1,59 +1,220 @@
 import json
+import struct
+import hashlib
 from crypto.hash_utils import sha256
 from crypto.signer import sign_digest, verify_signature
 
-class Block:
-    # Initialize block with data and compute hash
-    def __init__(self, index, timestamp, merkle_tree, prev_hash, signer_id, private_key):
+# Header formats: version 1 hashes a JSON object of hex fields and signs the digest hashed once more;
+# version 2 hashes a fixed binary layout and signs that digest directly; version 3 adds the
+# chain root, the Merkle mountain range root of every earlier block, to the binary layout
+HEADER_V1 = 1
+HEADER_V2 = 2
+HEADER_V3 = 3
+
+# Header format of newly created blocks
+HEADER_VERSION = HEADER_V3
+
+# Fixed part of a binary header: format version, block index, timestamp.
+# Stored block records start with the same layout, carrying the record version instead.
+HEADER_LAYOUT = struct.Struct('<Bqd')
+
+# Type tags for header values whose Python type varies (e.g. the genesis prev_hash is 0)
+TAG_NONE = 0
+TAG_INT = 1
+TAG_BYTES = 2
+TAG_STR = 3
+TAG_FLOAT = 4
+
+# Signed fields, fixed once a header is built so its cached digest and hash stay valid
+SEALED_FIELDS = frozenset((
+    'index', 'timestamp', 'merkle_root', 'prev_hash', 'signer_id', 'signature', 'hash', 'header_version',
+    'chain_root'
+))
+
+# Encode a header value with a type tag and length, so it decodes to the same Python type
+# and different values never encode the same
+def pack_value(value):
+    if value is None:
+        return struct.pack('<B', TAG_NONE)
+    if isinstance(value, int):
+        return struct.pack('<Bq', TAG_INT, int(value))
+    if isinstance(value, float):
+        return struct.pack('<Bd', TAG_FLOAT, value)
+    if isinstance(value, (bytes, bytearray)):
+        return struct.pack('<BI', TAG_BYTES, len(value)) + bytes(value)
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        return struct.pack('<BI', TAG_STR, len(data)) + data
+    raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+# Decode a tagged value, returning it with the offset just past it
+def unpack_value(buffer, offset):
+    tag = buffer[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_INT:
+        return struct.unpack_from('<q', buffer, offset)[0], offset + 8
+    if tag == TAG_FLOAT:
+        return struct.unpack_from('<d', buffer, offset)[0], offset + 8
+    if tag in (TAG_BYTES, TAG_STR):
+        length = struct.unpack_from('<I', buffer, offset)[0]
+        offset += 4
+        data = bytes(buffer[offset:offset + length])
+        if tag == TAG_STR:
+            return data.decode('utf-8'), offset + length
+        return data, offset + length
+    raise ValueError(f"Unknown value tag {tag}")
+
+# Render a field as it appears in a JSON (version 1) header
+def json_field(value):
+    return value.hex() if isinstance(value, bytes) else value
+
+class BlockHeader:
+    # Signed fields and hash of a block, without its Merkle tree
+    __slots__ = (
+        'index', 'timestamp', 'merkle_root', 'prev_hash', 'signer_id', 'signature', 'hash',
+        'header_version', 'chain_root', '_header_digest', '_hash', '_sealed'
+    )
+
+    def __init__(self, index, timestamp, merkle_root, prev_hash, signer_id, signature, hash, header_version=HEADER_VERSION, chain_root=None):
+        if chain_root is not None and header_version < HEADER_V3:
+            raise ValueError(f"Header version {header_version} cannot hold a chain root")
+        # Every V3 block after genesis commits to the blocks before it
+        if chain_root is None and header_version >= HEADER_V3 and index > 0:
+            raise ValueError(f"Header version {header_version} needs a chain root after the genesis block")
         self.index = index
         self.timestamp = timestamp
-        self.merkle_tree = merkle_tree  # Store the complete merkle tree
-        self.merkle_root = merkle_tree.root  # Keep root for backward compatibility
+        self.merkle_root = merkle_root
         self.prev_hash = prev_hash
         self.signer_id = signer_id
-        self.signature = None
-        self.sign_block(private_key)
-        self.hash = self.compute_hash()
-    
-    # Generate SHA256 hash from block data
+        self.signature = signature
+        self.hash = hash
+        self.header_version = header_version
+        self.chain_root = chain_root
+        self._header_digest = None
+        self._hash = None
+        # A header built without its hash (a newly signed block) computes it
+        if hash is None:
+            self.hash = self.compute_hash()
+        self._sealed = True
+
+    # Reject changes to signed fields, which would leave the cached digest and hash stale
+    def __setattr__(self, name, value):
+        if name in SEALED_FIELDS and getattr(self, '_sealed', False):
+            raise AttributeError(f"Cannot change {name} of a built block")
+        object.__setattr__(self, name, value)
+
+    # Canonical binary encoding of the signed header fields
+    def header_bytes(self):
+        parts = [
+            HEADER_LAYOUT.pack(self.header_version, self.index, float(self.timestamp)),
+            pack_value(self.merkle_root),
+            pack_value(self.prev_hash),
+            pack_value(self.signer_id)
+        ]
+        if self.header_version >= HEADER_V3:
+            parts.append(pack_value(self.chain_root))
+        return b''.join(parts)
+
+    # Whether the header commits to the chain root of the blocks before it
+    @property
+    def commits_chain(self):
+        return self.header_version >= HEADER_V3
+
+    # Generate SHA256 hash from block data, computed once per block
     def compute_hash(self):
-        data = {
-            'index': self.index,
-            'timestamp': self.timestamp,
-            'merkle_root': self.merkle_root.hex() if isinstance(self.merkle_root, bytes) else self.merkle_root,
-            'prev_hash': self.prev_hash.hex() if isinstance(self.prev_hash, bytes) else self.prev_hash,
-            'signer_id': self.signer_id,
-            'signature': self.signature.hex() if isinstance(self.signature, bytes) else self.signature
-        }
-        data_serialized = json.dumps(data)
-        return sha256(data_serialized)
+        if self._hash is None:
+            if self.header_version == HEADER_V1:
+                data = {
+                    'index': self.index,
+                    'timestamp': self.timestamp,
+                    'merkle_root': json_field(self.merkle_root),
+                    'prev_hash': json_field(self.prev_hash),
+                    'signer_id': self.signer_id,
+                    'signature': json_field(self.signature)
+                }
+                self._hash = sha256(json.dumps(data))
+            elif self.header_version in (HEADER_V2, HEADER_V3):
+                self._hash = hashlib.sha256(self.header_bytes() + pack_value(self.signature)).digest()
+            else:
+                raise ValueError(f"Unsupported header version {self.header_version}")
+        return self._hash
     
-    # Generates the signature from the partial header data
-    def sign_block(self, private_key):
-        data = {
-            'index': self.index,
-            'timestamp': self.timestamp,
-            'merkle_root': self.merkle_root.hex() if isinstance(self.merkle_root, bytes) else self.merkle_root,
-            'prev_hash': self.prev_hash.hex() if isinstance(self.prev_hash, bytes) else self.prev_hash,
-            'signer_id': self.signer_id
-        }
-        data_serialized = json.dumps(data)
-        header_digest = sha256(data_serialized)
-
-        self.signature = sign_digest(header_digest, private_key)
+    # Hash the partial header data that the signature covers, computed once per block
+    def header_digest(self):
+        if self._header_digest is None:
+            if self.header_version == HEADER_V1:
+                data = {
+                    'index': self.index,
+                    'timestamp': self.timestamp,
+                    'merkle_root': json_field(self.merkle_root),
+                    'prev_hash': json_field(self.prev_hash),
+                    'signer_id': self.signer_id
+                }
+                self._header_digest = sha256(json.dumps(data))
+            elif self.header_version in (HEADER_V2, HEADER_V3):
+                self._header_digest = hashlib.sha256(self.header_bytes()).digest()
+            else:
+                raise ValueError(f"Unsupported header version {self.header_version}")
+        return self._header_digest
+
+    # Whether the signature covers the header digest itself rather than a hash of it
+    @property
+    def prehashed(self):
+        return self.header_version >= HEADER_V2
 
     def verify_block_signature(self, public_key):
-        header_digest = self.compute_hash()
-        data = {
-            'index': self.index,
-            'timestamp': self.timestamp,
-            'merkle_root': self.merkle_root.hex() if isinstance(self.merkle_root, bytes) else self.merkle_root,
-            'prev_hash': self.prev_hash.hex() if isinstance(self.prev_hash, bytes) else self.prev_hash,
-            'signer_id': self.signer_id
-        }
-        data_serialized = json.dumps(data)
-        header_digest = sha256(data_serialized)
-        return verify_signature(header_digest, self.signature, public_key)
+        return verify_signature(self.header_digest(), self.signature, public_key, self.prehashed)
+
+
+
+class Block(BlockHeader):
+    # The Merkle tree is held in memory, or loaded through tree_loader each time it is needed
+    __slots__ = ('_merkle_tree', 'tree_loader')
+
+    # Initialize block with data, signing the partial header data and computing the hash.
+    # chain_root is the root of the chain's Merkle mountain range before this block.
+    def __init__(self, index, timestamp, merkle_tree, prev_hash, signer_id, private_key, header_version=HEADER_VERSION, chain_root=None):
+        unsigned = BlockHeader(index, timestamp, merkle_tree.root, prev_hash, signer_id, None, None, header_version, chain_root)
+        signature = sign_digest(unsigned.header_digest(), private_key, unsigned.prehashed)
+        super().__init__(index, timestamp, merkle_tree.root, prev_hash, signer_id, signature, None, header_version, chain_root)
+        self._header_digest = unsigned.header_digest()
+        self._merkle_tree = merkle_tree  # Store the complete merkle tree
+        self.tree_loader = None
+
+    # Rebuild a stored block from its fields without signing it again
+    @classmethod
+    def restore(cls, index, timestamp, merkle_tree, prev_hash, signer_id, signature, hash, header_version=HEADER_VERSION, chain_root=None):
+        block = cls.__new__(cls)
+        BlockHeader.__init__(block, index, timestamp, merkle_tree.root, prev_hash, signer_id, signature, hash, header_version, chain_root)
+        block._merkle_tree = merkle_tree
+        block.tree_loader = None
+        return block
+
+    # Wrap a header as a block whose Merkle tree is loaded on demand
+    @classmethod
+    def from_header(cls, header, tree_loader):
+        block = cls.__new__(cls)
+        BlockHeader.__init__(
+            block, header.index, header.timestamp, header.merkle_root, header.prev_hash,
+            header.signer_id, header.signature, header.hash, header.header_version, header.chain_root
+        )
+        block._merkle_tree = None
+        block.tree_loader = tree_loader
+        return block
+
+    # The block's Merkle tree, loaded if it is not held in memory
+    @property
+    def merkle_tree(self):
+        if self._merkle_tree is not None:
+            return self._merkle_tree
+        return self.tree_loader()
+
+    # Whether the Merkle tree is held in memory
+    @property
+    def has_tree(self):
+        return self._merkle_tree is not None
 
     # Verify if a file hash exists in the block's merkle tree
     def verify_file_in_block(self, file_hash):
@@ -64,4 +225,11 @@ class Block:
         try:
             return self.merkle_tree.generate_proof(file_hash, self.merkle_tree.leaves)
         except ValueError:
-            return None
\ No newline at end of file
+            return None
+
+    # Get one merkle multiproof covering several file hashes of the block
+    def get_multiproof(self, file_hashes):
+        try:
+            return self.merkle_tree.generate_multiproof(file_hashes)
+        except ValueError:
+            return None
@@ -1,13 +1,19 @@
-from crypto.hash_utils import sha256
-from storage.ipfs_client import add_file
+from crypto.hash_utils import sha256, sha256_file
 from blockchain.merkle_tree import MerkleTree
 from blockchain.block import Block
-from crypto.signer import sign_block
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
 import time
 
-# Prepare a block for the blockchain
-def prepare_block(file_paths, prev_hash, index, signer_id, private_key):
-    merkle_tree = MerkleTree(hash_files(file_paths))
+# Default number of threads hashing files at once; hashing releases the GIL, so I/O and hashing overlap
+HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Prepare a block for the blockchain from a directory or a list of files;
+# chain_root is the chain's root before the block, from Blockchain.get_chain_root()
+def prepare_block(file_paths, prev_hash, index, signer_id, private_key, chain_root=None, workers=HASH_WORKERS):
+    merkle_tree = MerkleTree(hash_files_parallel(file_paths, workers))
 
     block = Block(
         index=index,
@@ -16,16 +22,46 @@ def prepare_block(file_paths, prev_hash, index, signer_id, private_key):
         prev_hash=prev_hash,
         signer_id=signer_id,
         private_key=private_key,
+        chain_root=chain_root,
     )
 
     return block
 
 # Hash a file
 def hash_file(file_path):
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-        return sha256(file_data)
-    
+    return sha256_file(file_path)
+
 # Hash a list of files
 def hash_files(file_paths):
-    return [hash_file(file_path) for file_path in file_paths]
\ No newline at end of file
+    return [hash_file(file_path) for file_path in file_paths]
+
+# Hash a file through a read-only memory map
+def hash_file_mmap(file_path):
+    with open(file_path, 'rb') as f:
+        # Empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return sha256(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).digest()
+
+# Expand a directory into its files in a stable order, or return a list of paths unchanged
+def collect_paths(file_paths):
+    if isinstance(file_paths, (str, os.PathLike)):
+        if not os.path.isdir(file_paths):
+            return [file_paths]
+
+        found = []
+        for root, dirs, files in os.walk(file_paths):
+            dirs.sort()
+            found.extend(os.path.join(root, name) for name in sorted(files))
+        return found
+    return list(file_paths)
+
+# Hash a directory or a list of files on a thread pool, returning digests in path order
+def hash_files_parallel(file_paths, workers=HASH_WORKERS):
+    paths = collect_paths(file_paths)
+    if workers <= 1 or len(paths) <= 1:
+        return [hash_file_mmap(path) for path in paths]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(hash_file_mmap, paths))
@@ -1,19 +1,123 @@
 from blockchain.block import Block
 import time
-from crypto.key_manager import get_public_key_from_id, generate_keypair
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from crypto.key_manager import get_public_key_from_id, get_private_key_from_id, generate_keypair
+from crypto.signer import verify_signatures
 from blockchain.merkle_tree import MerkleTree
+from blockchain.mmr import MerkleMountainRange, verify_mmr_proof
+
+# Directory the genesis key pair is written to when a chain is created
+KEYS_PATH = "./keys"
+
+# Trust a new checkpoint every this many blocks added to the chain
+CHECKPOINT_INTERVAL = 1000
+
+# Ranges shorter than this are validated in-process even when workers are configured
+PARALLEL_MIN_BLOCKS = 64
+
+# Check that a block hash is committed to by the chain root signed into a tip header.
+# The tip's own signature must be checked as well, e.g. with tip.verify_block_signature.
+def verify_block_proof(proof, block_hash, tip):
+    return tip.commits_chain and proof['leaf_count'] == tip.index and verify_mmr_proof(proof, block_hash, tip.chain_root)
+
 
 class Blockchain:
-    # Initialize empty blockchain with genesis block
-    def __init__(self):
-        self.chain = []
-        self.create_starting_block()
+    # Initialize blockchain with genesis block, or reopen the blocks of a persistent store
+    def __init__(self, store=None, checkpoint_interval=CHECKPOINT_INTERVAL, validation_workers=None):
+        self.store = store
+        self.chain = store if store is not None else []
+        self.checkpoint_interval = checkpoint_interval
+        # Worker processes used for signature checks; None or 1 validates in-process
+        self.validation_workers = validation_workers
+        self.executor = None
+        # Trusted (chain position, block hash) pairs, oldest first
+        self.checkpoints = store.load_checkpoints() if store is not None else []
+        # Maps a file hash to the (chain position, leaf position) of its first occurrence
+        self._file_index = {} if len(self.chain) == 0 else None
+        # Merkle mountain range over the block hashes, committing to the whole chain up to the tip
+        self._mmr = MerkleMountainRange() if len(self.chain) == 0 else None
+        if len(self.chain) == 0:
+            self.create_starting_block()
+
+    # File index, loaded from the store's persisted file index the first time it is needed after a restart
+    @property
+    def file_index(self):
+        if self._file_index is None:
+            self._file_index = self.store.load_file_index()
+        return self._file_index
+
+    # Pick up blocks that other processes added to a shared store, returning whether any changed.
+    # The store's thread lock is held until the indexes have caught up, so a thread sealing
+    # through exclusive() never signs against an MMR that is missing the new blocks.
+    def refresh(self):
+        if self.store is None:
+            return False
+        with self.store.thread_lock:
+            length = len(self.chain)
+            first = self.store.refresh()
+            if first is None:
+                return False
+
+            if first < length:
+                # The chain was rewritten elsewhere, so reload the indexes when next needed
+                self._file_index = None
+                self._mmr = None
+            else:
+                for position in range(first, len(self.chain)):
+                    if self._file_index is not None:
+                        self.index_leaves(self.store.get_leaves(position), position)
+                    if self._mmr is not None:
+                        self._mmr.append(self.chain[position].hash)
+            self.checkpoints = self.store.load_checkpoints()
+            return True
+
+    # Hold the store's write lock, up to date with every other writer, while extending the chain
+    @contextmanager
+    def exclusive(self):
+        if self.store is None:
+            yield self
+            return
+        with self.store.writer():
+            self.refresh()
+            yield self
+
+    # Block hash MMR, read from the store (or rebuilt from the blocks) the first time it is needed after a restart
+    @property
+    def mmr(self):
+        if self._mmr is None:
+            if self.store is not None:
+                self._mmr = self.store.load_mmr()
+            else:
+                self._mmr = MerkleMountainRange(block.hash for block in self.chain)
+        return self._mmr
+
+    # Record a block appended at the tip in the MMR, unless it has yet to be built
+    def commit_block_hash(self, block):
+        if self._mmr is not None:
+            self._mmr.append(block.hash)
 
-    # Create and add the first block (genesis block)
+    # Hash committing to every block up to the current tip, signed into the next block's header
+    def get_chain_root(self):
+        return self.mmr.root
+
+    # Prove that the block at a chain position is committed to by the chain root signed into a later
+    # tip block (the latest block by default), raising IndexError unless position < tip
+    def get_block_proof(self, position, tip=None):
+        if tip is None:
+            tip = len(self.chain) - 1
+        return self.mmr.generate_proof(position, tip)
+
+    # Create and add the first block (genesis block), reusing the genesis key if one is registered
     def create_starting_block(self):
-        priv_key, _ = generate_keypair("./keys", "genesis")
+        try:
+            priv_key = get_private_key_from_id("genesis")
+        except (KeyError, FileNotFoundError):
+            priv_key, _ = generate_keypair(KEYS_PATH, "genesis", replace=True)
         start = Block(0, time.time(), MerkleTree([]), 0, "genesis", priv_key)
         self.chain.append(start)
+        self.index_block(start, 0)
+        self.commit_block_hash(start)
 
     # Return the most recent block in the chain
     def get_latest_block(self):
@@ -21,65 +125,225 @@ class Blockchain:
 
     # Add a new block after validation
     def add_block(self, block):
-        if self.get_latest_block().compute_hash() != block.prev_hash:
+        if self.get_latest_block().hash != block.prev_hash:
+            return False
+
+        if block.commits_chain and block.chain_root != self.get_chain_root():
             return False
         
-        pub_key = get_public_key_from_id(block.signer_id)
-        if not block.verify_block_signature(pub_key):
+        pub_key = self.get_signer_key(block.signer_id)
+        if pub_key is None or not block.verify_block_signature(pub_key):
             return False
 
         if block.compute_hash() != block.hash:
             return False
         
         self.chain.append(block)
+        position = len(self.chain) - 1
+        self.index_block(block, position)
+        self.commit_block_hash(block)
+        if self.checkpoint_interval and position % self.checkpoint_interval == 0:
+            self.add_checkpoint(position)
         return True
+
+    # Trust the block at a position of this chain (the tip by default) as a validation checkpoint
+    def add_checkpoint(self, position=None):
+        if position is None:
+            position = len(self.chain) - 1
+        if self.checkpoints and self.checkpoints[-1][0] >= position:
+            return False
+
+        self.checkpoints.append((position, self.chain[position].hash))
+        if self.store is not None:
+            self.store.save_checkpoints(self.checkpoints)
+        return True
+
+    # Record the leaves of a block in the file index, keeping earlier occurrences
+    def index_block(self, block, position):
+        self.index_leaves(block.merkle_tree.leaves or [], position)
+
+    # Record leaf hashes found at a chain position in the file index
+    def index_leaves(self, leaves, position):
+        file_index = self.file_index
+        for leaf_position, leaf in enumerate(leaves):
+            file_index.setdefault(leaf, (position, leaf_position))
+
+    # Drop index entries for blocks from a chain position onwards and index the new blocks
+    def reindex_from(self, position, old_blocks, new_blocks):
+        for block in old_blocks:
+            for leaf in block.merkle_tree.leaves or []:
+                location = self.file_index.get(leaf)
+                if location is not None and location[0] >= position:
+                    del self.file_index[leaf]
+
+        for offset, block in enumerate(new_blocks):
+            self.index_block(block, position + offset)
         
     # Validate the integrity of a blockchain
     def is_valid_chain(self, chain):
         if not chain or len(chain) == 0:
             return False
-        
-        prev = 0
-        for i in range(len(chain)):
+
+        # Blocks up to the newest checkpoint the chain reaches are already trusted
+        start, prev = 0, 0
+        for position, checkpoint_hash in reversed(self.checkpoints):
+            if position < len(chain):
+                block = chain[position]
+                if block.hash != checkpoint_hash or block.compute_hash() != checkpoint_hash:
+                    return False
+                start, prev = position + 1, checkpoint_hash
+                break
+
+        return self.validate_blocks(chain, start, prev)
+
+    # Check signatures, hash links and chain roots of chain[start:], given the hash of the block before start.
+    # chain[:start] is always a prefix of this chain (shared with a peer, or up to a checkpoint),
+    # so this chain's MMR supplies the chain root the first checked block must commit to.
+    def validate_blocks(self, chain, start, prev):
+        if self.validation_workers and self.validation_workers > 1 and len(chain) - start >= PARALLEL_MIN_BLOCKS:
+            return self.validate_blocks_parallel(chain, start, prev)
+
+        mmr = self.mmr.copy(start)
+        for i in range(start, len(chain)):
             block = chain[i]
 
-            pub_key = get_public_key_from_id(block.signer_id)
-            if not block.verify_block_signature(pub_key):
+            pub_key = self.get_signer_key(block.signer_id)
+            if pub_key is None or not block.verify_block_signature(pub_key):
                 return False
 
             if block.prev_hash != prev or block.compute_hash() != block.hash:
                 return False
-            prev = chain[i].compute_hash()
+            if block.commits_chain and block.chain_root != mmr.root:
+                return False
+            prev = block.hash
+            mmr.append(block.hash)
         
         return True
 
+    # Check hash links in order and fan the signature checks out to worker processes
+    def validate_blocks_parallel(self, chain, start, prev):
+        jobs = []
+        public_keys = {}
+        mmr = self.mmr.copy(start)
+        for i in range(start, len(chain)):
+            block = chain[i]
+            if block.prev_hash != prev or block.compute_hash() != block.hash:
+                return False
+            if block.commits_chain and block.chain_root != mmr.root:
+                return False
+            prev = block.hash
+            mmr.append(block.hash)
+
+            if block.signer_id not in public_keys:
+                pub_key = self.get_signer_key(block.signer_id)
+                if pub_key is None:
+                    return False
+                public_keys[block.signer_id] = pub_key.to_string()
+            jobs.append((block.header_digest(), block.signature, public_keys[block.signer_id], block.prehashed))
+
+        return all(verify_signatures(jobs, self.get_executor()))
+
+    # Public key of a block's signer, or None if the signer is not registered
+    def get_signer_key(self, signer_id):
+        try:
+            return get_public_key_from_id(signer_id)
+        except (KeyError, FileNotFoundError):
+            return None
+
+    # Process pool for signature checks, created on first use
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.validation_workers)
+        return self.executor
+
+    # Stop the signature worker processes
+    def shutdown_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    # Number of leading blocks a peer chain shares with this one, found by binary search
+    def shared_prefix_length(self, chain):
+        low, high = 0, min(len(self.chain), len(chain))
+        while low < high:
+            mid = (low + high) // 2
+            if self.chain[mid].hash == chain[mid].hash:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
     # Replace current chain with longest valid chain from peers
     def resolve_forks(self, peerChains):
-        longest_found = self.chain
+        longest_found = None
+        longest_shared = 0
         max_length = len(self.chain)
 
         for chain in peerChains:
-            if self.is_valid_chain(chain) and len(chain) > max_length:
+            if not chain or len(chain) <= max_length:
+                continue
+
+            # Only blocks after the shared prefix need checking, and none may rewrite a checkpoint
+            shared = self.shared_prefix_length(chain)
+            if self.checkpoints and self.checkpoints[-1][0] >= shared:
+                continue
+
+            prev = self.chain[shared - 1].hash if shared > 0 else 0
+            if self.validate_blocks(chain, shared, prev):
                 longest_found = chain
+                longest_shared = shared
                 max_length = len(chain)
 
-        if max_length > len(self.chain):
-            self.chain = longest_found
-            return True
-        else:
+        if longest_found is None:
             return False
 
+        # Keep our own copy of the shared prefix and take the divergent blocks from the peer
+        new_blocks = list(longest_found[longest_shared:])
+        self.reindex_from(longest_shared, self.chain[longest_shared:], new_blocks)
+        if self._mmr is not None:
+            self._mmr.truncate(longest_shared)
+        if self.store is not None:
+            self.store.replace_from(longest_shared, new_blocks)
+        else:
+            self.chain = self.chain[:longest_shared] + new_blocks
+        for block in new_blocks:
+            self.commit_block_hash(block)
+        return True
+
     # Verify if a file hash exists in the blockchain
     def verify_file_in_blockchain(self, file_hash):
-        for i, block in enumerate(self.chain):
-            if block.verify_file_in_block(file_hash):
-                return True, i
-        return False, -1
+        location = self.file_index.get(file_hash)
+        if location is None:
+            return False, -1
+        return True, location[0]
 
     # Get the merkle proof for a file hash in the blockchain
     def get_file_proof(self, file_hash):
-        for i, block in enumerate(self.chain):
-            proof = block.get_file_proof(file_hash)
-            if proof is not None:
-                return proof, i
-        return None, -1
\ No newline at end of file
+        location = self.file_index.get(file_hash)
+        if location is None:
+            return None, -1
+
+        proof = self.chain[location[0]].get_file_proof(file_hash)
+        if proof is None:
+            return None, -1
+        return proof, location[0]
+
+    # Get merkle proofs for many file hashes, loading each containing block once.
+    # Returns a dict mapping every given hash to (proof, block index), or (None, -1) if absent.
+    def get_file_proofs(self, file_hashes):
+        results = {}
+        by_position = {}
+        file_index = self.file_index
+        for file_hash in set(file_hashes):
+            location = file_index.get(file_hash)
+            if location is None:
+                results[file_hash] = (None, -1)
+            else:
+                by_position.setdefault(location[0], []).append(file_hash)
+
+        for position, found in by_position.items():
+            block = self.chain[position]
+            for file_hash in found:
+                proof = block.get_file_proof(file_hash)
+                results[file_hash] = (proof, position) if proof is not None else (None, -1)
+        return results
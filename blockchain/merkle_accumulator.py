@@ -0,0 +1,110 @@
+import hashlib
+from crypto.hash_utils import sha256
+from blockchain.merkle_builder import level_sizes
+
+# Hash two sibling nodes into their parent
+def combine(left, right):
+    if isinstance(left, bytes) and isinstance(right, bytes):
+        return hashlib.sha256(left + right).digest()
+    return sha256(left + right)
+
+
+class MerkleAccumulator:
+    # Grow a Merkle tree one leaf at a time. Every level keeps its completed nodes, so an append
+    # hashes one node per completed pair (amortized O(1)), and only the right edge, where levels
+    # still have an unpaired node, is hashed when the root or a proof is needed.
+    # Exposes the same level interface as FlatTreeLevels, so MerkleTree can wrap it without rehashing.
+    def __init__(self, hashes=None):
+        self.nodes = [[]]
+        self.edge = None
+        # Maps each leaf to its first position
+        self.positions = {}
+        for leaf in hashes or []:
+            self.add(leaf)
+
+    # Leaves added so far
+    @property
+    def leaves(self):
+        return self.nodes[0]
+
+    def __len__(self):
+        return len(self.nodes[0])
+
+    # Append a leaf, carrying completed pairs up the levels
+    def add(self, leaf):
+        self.edge = None
+        self.positions.setdefault(leaf, len(self.nodes[0]))
+        self.nodes[0].append(leaf)
+        level = 0
+        while len(self.nodes[level]) % 2 == 0:
+            current = self.nodes[level]
+            if level + 1 == len(self.nodes):
+                self.nodes.append([])
+            self.nodes[level + 1].append(combine(current[-2], current[-1]))
+            level += 1
+
+    # Right-edge nodes per level: the node just after the completed ones, or None. Cached until the next add.
+    def right_edge(self):
+        if self.edge is not None:
+            return self.edge
+
+        edge = []
+        carry = None
+        level = 0
+        while True:
+            completed = self.nodes[level] if level < len(self.nodes) else []
+            count = len(completed) + (carry is not None)
+            edge.append(carry)
+            if count <= 1:
+                break
+
+            last = carry if carry is not None else completed[-1]
+            if count % 2 != 0:
+                # The unpaired last node is hashed with a copy of itself
+                carry = combine(last, last)
+            elif carry is not None:
+                carry = combine(completed[-1], carry)
+            else:
+                carry = None
+            level += 1
+
+        self.edge = edge
+        return edge
+
+    # Number of levels including the leaves and the root
+    @property
+    def height(self):
+        return len(self.right_edge()) if self.nodes[0] else 0
+
+    # Slots in each level, counting the copy that pads an odd level
+    @property
+    def sizes(self):
+        return level_sizes(len(self))
+
+    # Root hash of the tree, or None when there are no leaves
+    @property
+    def root(self):
+        if not self.nodes[0]:
+            return None
+        return self.node(self.height - 1, 0)
+
+    # Return the node at a level and index, treating the padding slot as a copy of the last node
+    def node(self, level, index):
+        completed = self.nodes[level] if level < len(self.nodes) else []
+        edge = self.right_edge()[level]
+        if index < len(completed):
+            return completed[index]
+        if edge is not None:
+            return edge
+        return completed[-1]
+
+    # Return a level as a list of hashes
+    def level(self, level):
+        return [self.node(level, i) for i in range(self.sizes[level])]
+
+    # First position of a leaf hash, or None if it is not a leaf
+    def index_of(self, hash):
+        try:
+            return self.positions.get(hash)
+        except TypeError:
+            return None
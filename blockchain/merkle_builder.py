@@ -0,0 +1,187 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+from crypto.hash_utils import sha256
+
+# Size in bytes of every node slot in a flat tree
+DIGEST_SIZE = 32
+
+# Number of slots in each level, padding odd levels with a copy of their last node
+def level_sizes(leaf_count):
+    sizes = []
+    count = leaf_count
+    while count > 1:
+        if count % 2 != 0:
+            count += 1
+        sizes.append(count)
+        count //= 2
+    if count == 1:
+        sizes.append(1)
+    return sizes
+
+# Check whether every leaf fits a fixed digest slot
+def is_digest_list(hashes):
+    return all(isinstance(h, (bytes, bytearray)) and len(h) == DIGEST_SIZE for h in hashes)
+
+
+class FlatLeaves(Sequence):
+    # Read-only view of the leaf slots of a flat tree, so the tree keeps no list of leaf objects
+    def __init__(self, levels):
+        self.levels = levels
+
+    def __len__(self):
+        return self.levels.leaf_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("leaf index out of range")
+        return self.levels.node(0, index)
+
+    def __contains__(self, hash):
+        return self.levels.index_of(hash) is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, FlatLeaves)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+
+class FlatTreeLevels:
+    # Build every level of the tree into one contiguous buffer of 32-byte slots
+    def __init__(self, hashes):
+        self.leaf_count = len(hashes)
+        self.sizes = level_sizes(self.leaf_count)
+        self.offsets = []
+        # Leaf indices sorted by leaf hash (4 bytes per leaf), built on the first lookup
+        self.order = None
+
+        total = 0
+        for size in self.sizes:
+            self.offsets.append(total)
+            total += size
+
+        self.buffer = bytearray(total * DIGEST_SIZE)
+        self.view = memoryview(self.buffer)
+
+        for i, leaf in enumerate(hashes):
+            self.buffer[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] = leaf
+
+        self.build()
+
+    # Hash each level into the next one, iterating from the leaves up to the root
+    def build(self):
+        view = self.view
+        count = self.leaf_count
+        for level in range(len(self.sizes) - 1):
+            start = self.offsets[level] * DIGEST_SIZE
+            size = self.sizes[level]
+            if count < size:
+                last = start + (count - 1) * DIGEST_SIZE
+                view[last + DIGEST_SIZE:last + 2 * DIGEST_SIZE] = view[last:last + DIGEST_SIZE]
+
+            parent = self.offsets[level + 1] * DIGEST_SIZE
+            for pair in range(0, size * DIGEST_SIZE, 2 * DIGEST_SIZE):
+                view[parent:parent + DIGEST_SIZE] = hashlib.sha256(view[start + pair:start + pair + 2 * DIGEST_SIZE]).digest()
+                parent += DIGEST_SIZE
+            count = size // 2
+
+    # Number of levels including the leaves and the root
+    @property
+    def height(self):
+        return len(self.sizes)
+
+    # Root hash of the tree
+    @property
+    def root(self):
+        return self.node(self.height - 1, 0)
+
+    # Return the node stored at a level and index
+    def node(self, level, index):
+        start = (self.offsets[level] + index) * DIGEST_SIZE
+        return bytes(self.view[start:start + DIGEST_SIZE])
+
+    # Return a level as a list of hashes
+    def level(self, level):
+        return [self.node(level, i) for i in range(self.sizes[level])]
+
+    # Leaf hashes, read from the buffer
+    @property
+    def leaves(self):
+        return FlatLeaves(self)
+
+    # First position of a leaf hash, or None if it is not a leaf. Sorting is stable, so the
+    # leftmost match in the sorted indices is the first occurrence.
+    def index_of(self, hash):
+        if not isinstance(hash, (bytes, bytearray)) or len(hash) != DIGEST_SIZE:
+            return None
+        if self.order is None:
+            self.order = array('I', sorted(range(self.leaf_count), key=self.leaf))
+        hash = bytes(hash)
+        position = bisect_left(self.order, hash, key=self.leaf)
+        if position < len(self.order) and self.leaf(self.order[position]) == hash:
+            return self.order[position]
+        return None
+
+    # Leaf hash at an index
+    def leaf(self, index):
+        return self.node(0, index)
+
+
+class ListTreeLevels:
+    # Build the tree level by level for leaves that are not fixed-size digests
+    def __init__(self, hashes):
+        self.leaves = hashes
+        # Maps each leaf to its first position, built on the first lookup
+        self.positions = None
+        self.levels = []
+        current = list(hashes)
+        while len(current) > 1:
+            if len(current) % 2 != 0:
+                current.append(current[-1])
+            self.levels.append(current)
+            current = [sha256(current[i] + current[i + 1]) for i in range(0, len(current), 2)]
+        self.levels.append(current)
+
+    # Number of levels including the leaves and the root
+    @property
+    def height(self):
+        return len(self.levels)
+
+    # Root hash of the tree
+    @property
+    def root(self):
+        return self.levels[-1][0]
+
+    # Return the node stored at a level and index
+    def node(self, level, index):
+        return self.levels[level][index]
+
+    # Return a level as a list of hashes
+    def level(self, level):
+        return list(self.levels[level])
+
+    # First position of a leaf hash, or None if it is not a leaf
+    def index_of(self, hash):
+        if self.positions is None:
+            positions = {}
+            for i, leaf in enumerate(self.leaves):
+                positions.setdefault(leaf, i)
+            self.positions = positions
+        try:
+            return self.positions.get(hash)
+        except TypeError:
+            return None
+
+
+# Build tree levels, using the flat layout whenever the leaves are digests
+def build_levels(hashes):
+    if not hashes:
+        return None
+    if is_digest_list(hashes):
+        return FlatTreeLevels(hashes)
+    return ListTreeLevels(hashes)
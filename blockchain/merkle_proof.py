@@ -0,0 +1,132 @@
+import base64
+import hashlib
+import struct
+from blockchain.merkle_tree import LEFT, RIGHT
+from blockchain.merkle_builder import DIGEST_SIZE
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Format version written at the start of every compact proof
+PROOF_VERSION = 1
+
+# Compact proof header: format version and number of siblings after the leaf
+PROOF_HEADER = struct.Struct('<BB')
+
+# A compact proof is the header, a bitmask with bit i set when entry i (leaf first) is a right node,
+# then the leaf and every sibling as 32-byte digests in proof order.
+
+# Encode a proof from MerkleTree.generate_proof into compact bytes
+def encode_proof(merkle_proof):
+    if not merkle_proof:
+        raise ValueError("Cannot encode an empty proof")
+
+    mask = bytearray((len(merkle_proof) + 7) // 8)
+    digests = []
+    for i, entry in enumerate(merkle_proof):
+        digest = entry['hash']
+        if not isinstance(digest, (bytes, bytearray)) or len(digest) != DIGEST_SIZE:
+            raise ValueError("Compact proofs only hold 32-byte digests")
+        if entry['direction'] == RIGHT:
+            mask[i // 8] |= 1 << (i % 8)
+        digests.append(bytes(digest))
+
+    return PROOF_HEADER.pack(PROOF_VERSION, len(merkle_proof) - 1) + bytes(mask) + b''.join(digests)
+
+# Split compact proof bytes into the entry count, direction bitmask and digest area
+def parse_proof(data):
+    if len(data) < PROOF_HEADER.size:
+        raise ValueError("Compact proof is truncated")
+    version, siblings = PROOF_HEADER.unpack_from(data)
+    if version != PROOF_VERSION:
+        raise ValueError(f"Unsupported compact proof version {version}")
+
+    count = siblings + 1
+    mask_end = PROOF_HEADER.size + (count + 7) // 8
+    if len(data) != mask_end + count * DIGEST_SIZE:
+        raise ValueError("Compact proof has the wrong length")
+    view = memoryview(data)
+    return count, view[PROOF_HEADER.size:mask_end], view[mask_end:]
+
+# Decode compact proof bytes back into the list form used by MerkleTree
+def decode_proof(data):
+    count, mask, digests = parse_proof(data)
+    return [
+        {
+            'hash': bytes(digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]),
+            'direction': RIGHT if mask[i // 8] >> (i % 8) & 1 else LEFT
+        } for i in range(count)
+    ]
+
+# Reconstruct the root straight from compact proof bytes, without decoding the entries
+def root_from_proof(data):
+    count, mask, digests = parse_proof(data)
+    current = bytes(digests[:DIGEST_SIZE])
+    for i in range(1, count):
+        sibling = digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+        if mask[i // 8] >> (i % 8) & 1:
+            current = hashlib.sha256(current + sibling).digest()
+        else:
+            current = hashlib.sha256(sibling.tobytes() + current).digest()
+    return current
+
+# Check that a compact proof starts at a leaf and reconstructs the expected root
+def verify_proof(data, leaf, root):
+    _, _, digests = parse_proof(data)
+    return digests[:DIGEST_SIZE] == leaf and root_from_proof(data) == root
+
+# Compact multiproof header: format version, leaf count, proven leaf count, sibling count
+MULTIPROOF_HEADER = struct.Struct('<BIII')
+
+# Encode a multiproof from MerkleTree.generate_multiproof as the header, the proven leaf
+# indices as 32-bit integers, then the proven leaves and the siblings as 32-byte digests
+def encode_multiproof(multiproof):
+    digests = multiproof['leaves'] + multiproof['siblings']
+    if not all(isinstance(digest, (bytes, bytearray)) and len(digest) == DIGEST_SIZE for digest in digests):
+        raise ValueError("Compact proofs only hold 32-byte digests")
+
+    indices = multiproof['indices']
+    header = MULTIPROOF_HEADER.pack(PROOF_VERSION, multiproof['leaf_count'], len(indices), len(multiproof['siblings']))
+    return header + struct.pack(f'<{len(indices)}I', *indices) + b''.join(bytes(digest) for digest in digests)
+
+# Decode compact multiproof bytes back into the dict form used by MerkleTree
+def decode_multiproof(data):
+    if len(data) < MULTIPROOF_HEADER.size:
+        raise ValueError("Compact multiproof is truncated")
+    version, leaf_count, proven, siblings = MULTIPROOF_HEADER.unpack_from(data)
+    if version != PROOF_VERSION:
+        raise ValueError(f"Unsupported compact proof version {version}")
+
+    digest_start = MULTIPROOF_HEADER.size + 4 * proven
+    if len(data) != digest_start + (proven + siblings) * DIGEST_SIZE:
+        raise ValueError("Compact multiproof has the wrong length")
+    digests = [
+        bytes(data[offset:offset + DIGEST_SIZE])
+        for offset in range(digest_start, len(data), DIGEST_SIZE)
+    ]
+    return {
+        'leaf_count': leaf_count,
+        'indices': list(struct.unpack_from(f'<{proven}I', data, MULTIPROOF_HEADER.size)),
+        'leaves': digests[:proven],
+        'siblings': digests[proven:]
+    }
+
+# Wrap compact proof bytes as base64 text for JSON payloads
+def proof_to_base64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def proof_from_base64(text):
+    return base64.b64decode(text, validate=True)
+
+# Wrap compact proof bytes in CBOR; needs the optional cbor2 package
+def proof_to_cbor(data):
+    if cbor2 is None:
+        raise RuntimeError("CBOR proofs need the cbor2 package")
+    return cbor2.dumps({'v': PROOF_VERSION, 'proof': data})
+
+def proof_from_cbor(payload):
+    if cbor2 is None:
+        raise RuntimeError("CBOR proofs need the cbor2 package")
+    return cbor2.loads(payload)['proof']
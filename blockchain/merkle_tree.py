@@ -1,66 +1,141 @@
+import threading
+from collections import OrderedDict
 from crypto.hash_utils import sha256
+from blockchain.merkle_builder import build_levels
 
 LEFT = 'left'
 RIGHT = 'right'
 
+# Maximum number of proofs memoized per tree
+PROOF_CACHE_SIZE = 1024
+
+# Number of real nodes in each level of a tree with leaf_count leaves, before padding
+def level_counts(leaf_count):
+    counts = [leaf_count]
+    while counts[-1] > 1:
+        counts.append((counts[-1] + 1) // 2)
+    return counts
+
+# Rebuild the root from a multiproof, hashing each internal node it covers exactly once
+def get_root_from_multiproof(multiproof):
+    if not multiproof or not multiproof['indices'] or len(multiproof['indices']) != len(multiproof['leaves']):
+        return None
+
+    counts = level_counts(multiproof['leaf_count'])
+    nodes = dict(zip(multiproof['indices'], multiproof['leaves']))
+    if len(nodes) != len(multiproof['indices']) or max(nodes) >= counts[0] or min(nodes) < 0:
+        return None
+
+    siblings = iter(multiproof['siblings'])
+    for count in counts[:-1]:
+        parents = {}
+        for index in sorted(nodes):
+            parent = index // 2
+            if parent in parents:
+                continue
+            sibling_index = index ^ 1
+            if sibling_index in nodes:
+                sibling = nodes[sibling_index]
+            elif sibling_index >= count:
+                sibling = nodes[index]
+            else:
+                sibling = next(siblings, None)
+                if sibling is None:
+                    return None
+            if index % 2 == 0:
+                parents[parent] = sha256(nodes[index] + sibling)
+            else:
+                parents[parent] = sha256(sibling + nodes[index])
+        nodes = parents
+
+    # Every sibling must have been used
+    if next(siblings, None) is not None:
+        return None
+    return nodes.get(0)
+
+# Check that a multiproof covers the given leaves and reconstructs the expected root
+def verify_multiproof(multiproof, hashes, root):
+    if not multiproof or set(hashes) - set(multiproof['leaves']):
+        return False
+    return get_root_from_multiproof(multiproof) == root
+
 class MerkleTree():
     # Initialize Merkle tree with leaf hashes
-    def __init__(self, hashes):
+    def __init__(self, hashes, proof_cache_size=PROOF_CACHE_SIZE):
         self.leaves = hashes
-        self.tree = None
+        self.levels = None
         self.root = None
+        self.proof_cache = OrderedDict()
+        self.proof_cache_size = proof_cache_size
+        self.proof_cache_lock = threading.Lock()
 
         self.generate_merkle_tree(hashes)
 
+    # Wrap the levels of a MerkleAccumulator as a tree without hashing them again
+    @classmethod
+    def from_accumulator(cls, accumulator, proof_cache_size=PROOF_CACHE_SIZE):
+        tree = cls([], proof_cache_size)
+        tree.leaves = accumulator.leaves
+        if len(accumulator) > 0:
+            tree.levels = accumulator
+            tree.root = accumulator.root
+        return tree
+
     # Determine if a leaf hash is positioned left or right
     def get_leaf_direction(self, hash):
-        hash_index = self.tree[0].index(hash)
+        hash_index = self.get_leaf_index(hash)
         
         if hash_index % 2 == 0:
             return LEFT
         else:
             return RIGHT
+
+    # Look up the position of a leaf hash, raising ValueError if it is not in the tree
+    def get_leaf_index(self, hash):
+        position = self.levels.index_of(hash) if self.levels is not None else None
+        if position is None:
+            raise ValueError(f"{hash!r} is not a leaf of this tree")
+        return position
     
     # Duplicate last hash if odd number of hashes
     def make_even(self, hashes):
         if len(hashes) % 2 != 0:
             hashes.append(hashes[-1])
 
-    # Recursively build tree levels by pairing and hashing
-    def generate_tree(self, hashes, tree):
-            if len(hashes) == 1:
-                return hashes
-            
-            self.make_even(hashes)
-            combined = []
-
-            for i in range(0, len(hashes), 2):
-                concat_hashes = hashes[i] + hashes[i + 1]
-                combined.append(sha256(concat_hashes))
-
-            tree.append(combined)
-            return self.generate_tree(combined, tree)
-
     # Generate complete Merkle tree and set root
     def generate_merkle_tree(self, hashes):
         if not hashes or len(hashes) == 0:
             return None
 
-        tree = [hashes]
-        self.generate_tree(hashes, tree)
-        self.tree = tree
-        self.root = tree[-1][0]
+        self.levels = build_levels(hashes)
+        self.root = self.levels.root
+        # Flat trees read their leaves from the level buffer, so the caller's list is not kept
+        self.leaves = self.levels.leaves
+
+    # Tree levels as lists of hashes, from the padded leaves up to the root
+    @property
+    def tree(self):
+        if self.levels is None:
+            return None
+        return [self.levels.level(level) for level in range(self.levels.height)]
     
     # Generate proof path for a specific hash
     def generate_proof(self, hash, hashes):
         if not hash or not hashes or len(hashes) == 0:
             return None
+
+        # Trees are shared by request threads, so the lookup and its LRU update happen together
+        with self.proof_cache_lock:
+            cached = self.proof_cache.get(hash)
+            if cached is not None:
+                self.proof_cache.move_to_end(hash)
+                return list(cached)
         
-        tree = self.tree
-        merkle_proof = [{'hash': hash, 'direction': self.get_leaf_direction(hash)}]
-        hash_index = tree[0].index(hash)
+        levels = self.levels
+        hash_index = self.get_leaf_index(hash)
+        merkle_proof = [{'hash': hash, 'direction': LEFT if hash_index % 2 == 0 else RIGHT}]
 
-        for level in range(len(tree) - 1):
+        for level in range(levels.height - 1):
             is_left = hash_index % 2 == 0
             sibling_direction = None
             sibling_index = None
@@ -71,10 +146,47 @@ class MerkleTree():
                 sibling_direction = LEFT
                 sibling_index = hash_index - 1
 
-            merkle_proof.append({'hash': tree[level][sibling_index], 'direction': sibling_direction})
+            merkle_proof.append({'hash': levels.node(level, sibling_index), 'direction': sibling_direction})
             hash_index = hash_index // 2
-        
-        return merkle_proof
+
+        self.cache_proof(hash, merkle_proof)
+        return list(merkle_proof)
+
+    # Generate one proof for several leaves, sending only the siblings the verifier cannot compute itself.
+    # Leaves are proven at their first position; siblings are listed level by level, left to right.
+    def generate_multiproof(self, hashes):
+        if self.levels is None or not hashes:
+            return None
+
+        levels = self.levels
+        indices = sorted({self.get_leaf_index(hash) for hash in hashes})
+        counts = level_counts(len(self.leaves))
+        siblings = []
+        known = indices
+        for level in range(levels.height - 1):
+            known_set = set(known)
+            for index in known:
+                sibling_index = index ^ 1
+                # A padded last node is its own sibling, and known nodes are computed by the verifier
+                if sibling_index not in known_set and sibling_index < counts[level]:
+                    siblings.append(levels.node(level, sibling_index))
+            known = sorted({index // 2 for index in known})
+
+        return {
+            'leaf_count': len(self.leaves),
+            'indices': indices,
+            'leaves': [levels.node(0, index) for index in indices],
+            'siblings': siblings
+        }
+
+    # Memoize a proof, evicting the least recently used one when the cache is full
+    def cache_proof(self, hash, merkle_proof):
+        if self.proof_cache_size <= 0:
+            return
+        with self.proof_cache_lock:
+            self.proof_cache[hash] = merkle_proof
+            if len(self.proof_cache) > self.proof_cache_size:
+                self.proof_cache.popitem(last=False)
 
     # Calculate root hash from Merkle proof
     def get_root_from_merkle_proof(self, merkle_proof):
@@ -91,17 +203,24 @@ class MerkleTree():
         
         return current['hash']
     
+    # Calculate root hash from a multiproof, or None if it is malformed
+    def get_root_from_multiproof(self, multiproof):
+        return get_root_from_multiproof(multiproof)
+
     # Verify if hash exists in tree using proof verification
     def verify(self, hash, root=None):
-        if not root: 
-            root = self.root
-        
         # First check if the hash exists in the leaves
-        if hash not in self.leaves:
+        try:
+            self.get_leaf_index(hash)
+        except ValueError:
             return False
+
+        # Every leaf of this tree reconstructs its own root, so no hashing is needed
+        if not root or root == self.root:
+            return True
             
         try:
             proof = self.generate_proof(hash, self.leaves)
             return root == self.get_root_from_merkle_proof(proof)
         except ValueError:
-            return False
\ No newline at end of file
+            return False
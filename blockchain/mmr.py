@@ -0,0 +1,154 @@
+from blockchain.merkle_accumulator import combine
+
+
+# Heights of the mountains of a range with leaf_count leaves, from the leftmost (tallest) one
+def mountain_heights(leaf_count):
+    return [height for height in range(leaf_count.bit_length() - 1, -1, -1) if leaf_count >> height & 1]
+
+# Number of nodes, leaves included, of a range with leaf_count leaves
+def node_count(leaf_count):
+    return 2 * leaf_count - bin(leaf_count).count('1')
+
+# Append a leaf to a range of leaf_count leaves known only by its peaks, updating the peaks in place.
+# Returns the new nodes in the order append creates them: the leaf, then the parents it completes.
+def append_to_peaks(peaks, leaf_count, leaf):
+    nodes = [leaf]
+    node = leaf
+    while leaf_count & 1:
+        node = combine(peaks.pop(), node)
+        nodes.append(node)
+        leaf_count >>= 1
+    peaks.append(node)
+    return nodes
+
+# Fold peaks from the right into a single root
+def bag_peaks(peaks):
+    if not peaks:
+        return None
+    root = peaks[-1]
+    for peak in reversed(peaks[:-1]):
+        root = combine(peak, root)
+    return root
+
+
+class MerkleMountainRange:
+    # Append-only list of perfect Merkle trees ("mountains") over a sequence of leaves. Every level
+    # keeps its completed nodes, so appending hashes O(1) nodes amortized, and an inclusion proof
+    # is the path inside the leaf's mountain plus the peaks of the range.
+    def __init__(self, leaves=None):
+        self.nodes = [[]]
+        for leaf in leaves or []:
+            self.append(leaf)
+
+    # Range of leaf_count leaves rebuilt without hashing from its nodes, given in the order
+    # append creates them (as append_to_peaks returns them)
+    @classmethod
+    def from_nodes(cls, nodes, leaf_count):
+        mmr = cls()
+        nodes = iter(nodes)
+        for _ in range(leaf_count):
+            mmr.nodes[0].append(next(nodes))
+            level = 0
+            while len(mmr.nodes[level]) % 2 == 0:
+                if level + 1 == len(mmr.nodes):
+                    mmr.nodes.append([])
+                mmr.nodes[level + 1].append(next(nodes))
+                level += 1
+        return mmr
+
+    def __len__(self):
+        return len(self.nodes[0])
+
+    # Append a leaf, merging equal-height mountains
+    def append(self, leaf):
+        self.nodes[0].append(leaf)
+        level = 0
+        while len(self.nodes[level]) % 2 == 0:
+            current = self.nodes[level]
+            if level + 1 == len(self.nodes):
+                self.nodes.append([])
+            self.nodes[level + 1].append(combine(current[-2], current[-1]))
+            level += 1
+        return len(self.nodes[0]) - 1
+
+    # Drop every leaf from a position onwards, along with the nodes above them
+    def truncate(self, leaf_count):
+        for level in range(len(self.nodes)):
+            del self.nodes[level][leaf_count >> level:]
+
+    # Independent range holding the first leaf_count leaves (all of them by default), sharing no lists
+    def copy(self, leaf_count=None):
+        if leaf_count is None:
+            leaf_count = len(self)
+        mmr = MerkleMountainRange()
+        mmr.nodes = [level[:leaf_count >> height] for height, level in enumerate(self.nodes)]
+        return mmr
+
+    # Root node of each mountain, left to right, of the range at its current size or an earlier one.
+    # Mountains of an earlier size are complete nodes that are kept, so no hashing is needed.
+    def peaks(self, leaf_count=None):
+        if leaf_count is None:
+            leaf_count = len(self)
+        return [self.nodes[height][(leaf_count >> height) - 1] for height in mountain_heights(leaf_count)]
+
+    # Single hash committing to every leaf, or None when the range is empty
+    @property
+    def root(self):
+        return bag_peaks(self.peaks())
+
+    # Prove that the leaf at a position is in the range at its current size, or at an earlier size
+    def generate_proof(self, position, leaf_count=None):
+        if leaf_count is None:
+            leaf_count = len(self)
+        if not 0 <= leaf_count <= len(self):
+            raise IndexError(f"Range never held {leaf_count} leaves")
+        if not 0 <= position < leaf_count:
+            raise IndexError(f"Position {position} is outside the range of {leaf_count} leaves")
+
+        # Mountains are aligned to their size, so a leaf's mountain is the first one ending after it
+        start = 0
+        for height in mountain_heights(leaf_count):
+            if position < start + (1 << height):
+                break
+            start += 1 << height
+
+        siblings = [self.nodes[level][(position >> level) ^ 1] for level in range(height)]
+        return {
+            'position': position,
+            'leaf_count': leaf_count,
+            'siblings': siblings,
+            'peaks': self.peaks(leaf_count)
+        }
+
+
+# Rebuild the root of a range from an inclusion proof for a leaf, or None if the proof is malformed
+def get_root_from_mmr_proof(proof, leaf):
+    position = proof['position']
+    leaf_count = proof['leaf_count']
+    if not 0 <= position < leaf_count:
+        return None
+
+    start = 0
+    for mountain, height in enumerate(mountain_heights(leaf_count)):
+        if position < start + (1 << height):
+            break
+        start += 1 << height
+
+    peaks = proof['peaks']
+    if len(proof['siblings']) != height or len(peaks) != len(mountain_heights(leaf_count)):
+        return None
+
+    node = leaf
+    for level, sibling in enumerate(proof['siblings']):
+        if position >> level & 1:
+            node = combine(sibling, node)
+        else:
+            node = combine(node, sibling)
+
+    if node != peaks[mountain]:
+        return None
+    return bag_peaks(peaks)
+
+# Check that a leaf is committed to by an MMR root
+def verify_mmr_proof(proof, leaf, root):
+    return root is not None and get_root_from_mmr_proof(proof, leaf) == root
@@ -1,9 +1,49 @@
 from cryptography.hazmat.primitives import hashes
 
+# Number of bytes read at a time when hashing files and streams
+CHUNK_SIZE = 1024 * 1024
+
 # Generate a sha256 hash of some data
 def sha256(data):
     if isinstance(data, str):
         data = data.encode("utf-8")
     hash = hashes.Hash(hashes.SHA256())
     hash.update(data)
-    return hash.finalize()
\ No newline at end of file
+    return hash.finalize()
+
+# Hash a readable binary stream in fixed-size chunks, optionally copying each chunk to a sink
+def sha256_stream(stream, sink=None, chunk_size=CHUNK_SIZE):
+    hash = hashes.Hash(hashes.SHA256())
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        hash.update(chunk)
+        if sink is not None:
+            sink.write(chunk)
+    return hash.finalize()
+
+# Hash a file on disk without loading it into memory
+def sha256_file(file_path, chunk_size=CHUNK_SIZE):
+    with open(file_path, 'rb') as f:
+        return sha256_stream(f, chunk_size=chunk_size)
+
+class HashingFile:
+    # Writable file wrapper that hashes everything written through it, so data is hashed
+    # as it streams in rather than in a second pass. Other file methods go to the wrapped file.
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashes.Hash(hashes.SHA256())
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    # SHA256 of the data written so far
+    def digest(self):
+        return self.hash.copy().finalize()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
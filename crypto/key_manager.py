@@ -1,12 +1,136 @@
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
+from ecdsa.ellipticcurve import PointJacobi
+from contextlib import contextmanager
 import os
 import json
+import sqlite3
+import tempfile
+import threading
 
 SCRIPT_DIR = os.path.dirname(__file__)
 PARENT_DIR = os.path.dirname(SCRIPT_DIR)
+# Legacy JSON registry, imported once into the SQLite registry
+KEY_REGISTRY_PATH = os.path.join(PARENT_DIR, "key_registry.json")
+KEY_REGISTRY_DB_PATH = os.path.join(PARENT_DIR, "key_registry.db")
+
+# Loaded keys, replaced whenever another connection commits to the registry
+_key_cache = None
+
+# Registry connection shared by the threads of one process, reopened after a fork
+_connection = None
+_connection_pid = None
+_registry_lock = threading.RLock()
+
+# Open the registry database in WAL mode, creating and migrating it on first use
+def _get_connection():
+    global _connection, _connection_pid, _key_cache
+    if _connection is not None and _connection_pid == os.getpid():
+        return _connection
+
+    connection = sqlite3.connect(KEY_REGISTRY_DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS signers ("
+        "signer_id TEXT PRIMARY KEY, public_path TEXT NOT NULL, private_path TEXT NOT NULL)"
+    )
+    connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    _migrate_json_registry(connection)
+
+    _connection = connection
+    _connection_pid = os.getpid()
+    _key_cache = None
+    return connection
+
+# Import the legacy key_registry.json the first time any process opens the database
+def _migrate_json_registry(connection):
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is None:
+            data = {}
+            if os.path.exists(KEY_REGISTRY_PATH):
+                with open(KEY_REGISTRY_PATH, "r") as f:
+                    data = json.load(f)
+            connection.executemany(
+                "INSERT OR IGNORE INTO signers VALUES (?, ?, ?)",
+                [(str(signer_id),) + tuple(paths.split(",", 1)) for signer_id, paths in data.items()]
+            )
+            connection.execute("INSERT INTO meta VALUES ('json_migrated', '1')")
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+
+# Close the registry connection (it is reopened on next use)
+def close_registry():
+    global _connection, _connection_pid
+    with _registry_lock:
+        if _connection is not None and _connection_pid == os.getpid():
+            _connection.close()
+        _connection = None
+        _connection_pid = None
+        clear_key_cache()
+
+# Atomically add the key paths of a signer. An existing signer is only replaced when asked,
+# since blocks it already signed could no longer be verified.
+def register_signer(signer_id, public_path, private_path, replace=False):
+    with _claim_signer(signer_id, public_path, private_path, replace):
+        pass
+
+# Insert a signer's row and keep its transaction open for the body, which runs only for the
+# registration that won the row; the row is committed once the body has finished
+@contextmanager
+def _claim_signer(signer_id, public_path, private_path, replace=False):
+    with _registry_lock:
+        connection = _get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO signers VALUES (?, ?, ?)" if replace else "INSERT INTO signers VALUES (?, ?, ?)",
+                (str(signer_id), public_path, private_path)
+            )
+            yield
+            connection.execute("COMMIT")
+        except sqlite3.IntegrityError:
+            connection.execute("ROLLBACK")
+            raise ValueError(f"Signer {signer_id} is already registered")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            clear_key_cache()
+
+# Whether a signer id is in the registry
+def is_registered(signer_id):
+    try:
+        lookup_signer(signer_id)
+        return True
+    except KeyError:
+        return False
+
+# Return the (public, private) key paths of a signer, raising KeyError if it is unknown
+def lookup_signer(signer_id):
+    with _registry_lock:
+        row = _get_connection().execute(
+            "SELECT public_path, private_path FROM signers WHERE signer_id = ?",
+            (str(signer_id),)
+        ).fetchone()
+    if row is None:
+        raise KeyError(signer_id)
+    return row
+
+# Remove every signer from the registry
+def reset_registry():
+    with _registry_lock:
+        _get_connection().execute("DELETE FROM signers")
+        clear_key_cache()
+
+# Generate an ecdsa key pair at the output path, raising ValueError if the signer is
+# already registered unless replace is set
+def generate_keypair(output_path, signer_id, replace=False):
+    if not replace and is_registered(signer_id):
+        raise ValueError(f"Signer {signer_id} is already registered")
 
-# Generate an ecdsa key pair at the output path
-def generate_keypair(output_path, signer_id):
     private_key = SigningKey.generate(curve=SECP256k1)
     public_key = private_key.verifying_key
 
@@ -18,28 +142,23 @@ def generate_keypair(output_path, signer_id):
 
     os.makedirs(output_path, exist_ok=True)
 
-    with open(private_path, "wb") as f:
-        f.write(private_pem)
-
-    with open(public_path, "wb") as f:
-        f.write(public_pem)
-
-    key_registry_path = os.path.join(PARENT_DIR, "key_registry.json")
-
+    # Write the keys under unique names and move them into place only once the registry row
+    # is claimed, so a concurrent registration of the same signer cannot overwrite them
+    temp_paths = []
     try:
-        with open(key_registry_path, 'x') as f:
-            json.dump({}, f)
-    except FileExistsError:
-        pass
-    
-    data = None
-    with open(os.path.join(PARENT_DIR, "key_registry.json"), "r") as f:
-        data = json.load(f)
-    
-    data[signer_id] = public_path + "," + private_path
-
-    with open(os.path.join(PARENT_DIR, "key_registry.json"), 'w') as f:
-        json.dump(data, f, indent=4)
+        for path, pem in ((private_path, private_pem), (public_path, public_pem)):
+            fd, temp_path = tempfile.mkstemp(dir=output_path, prefix=os.path.basename(path) + ".", suffix=".tmp")
+            temp_paths.append(temp_path)
+            with os.fdopen(fd, "wb") as f:
+                f.write(pem)
+
+        with _claim_signer(signer_id, public_path, private_path, replace):
+            os.replace(temp_paths[0], private_path)
+            os.replace(temp_paths[1], public_path)
+    finally:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
     return private_key, public_key
 
@@ -53,21 +172,55 @@ def load_public_key(public_key_path):
     with open(public_key_path) as f:
         return VerifyingKey.from_pem(f.read())
 
+# Forget every cached registry entry and key
+def clear_key_cache():
+    global _key_cache
+    _key_cache = None
+
+# Return the key cache, dropping it when another connection has committed registry changes
+def _registry_cache():
+    global _key_cache
+    with _registry_lock:
+        stamp = _get_connection().execute("PRAGMA data_version").fetchone()[0]
+        cache = _key_cache
+        if cache is not None and cache['stamp'] == stamp:
+            return cache
+
+        cache = {'stamp': stamp, 'public': {}, 'private': {}}
+        _key_cache = cache
+        return cache
+
+# Rebuild a verifying key on a point that knows the curve order, so precompute() can build its tables
+def precompute_public_key(public_key):
+    point = public_key.pubkey.point
+    curve = public_key.curve
+    jacobi = PointJacobi(curve.curve, point.x(), point.y(), 1, curve.order, generator=True)
+    precomputed = VerifyingKey.from_public_point(jacobi, curve=curve)
+    precomputed.precompute()
+    return precomputed
+
 # Load the public key from a signer id
 def get_public_key_from_id(signer_id):
-    data = None
-    with open(os.path.join(PARENT_DIR, "key_registry.json"), "r") as f:
-        data = json.load(f)
+    signer_id = str(signer_id)
+    cache = _registry_cache()
+    public_keys = cache['public']
+    if signer_id in public_keys:
+        return public_keys[signer_id]
 
-    key_paths = data[str(signer_id)].split(",")
-    return load_public_key(key_paths[0])
+    public_path, _ = lookup_signer(signer_id)
+    public_key = precompute_public_key(load_public_key(public_path))
+    public_keys[signer_id] = public_key
+    return public_key
 
 # Load the private key from a signer id
 def get_private_key_from_id(signer_id):
-    data = None
-    with open(os.path.join(PARENT_DIR, "key_registry.json"), "r") as f:
-        data = json.load(f)
-
-    keys = data[str(signer_id)].split(",")
-    return load_private_key(keys[1])
-
+    signer_id = str(signer_id)
+    cache = _registry_cache()
+    private_keys = cache['private']
+    if signer_id in private_keys:
+        return private_keys[signer_id]
+
+    _, private_path = lookup_signer(signer_id)
+    private_key = load_private_key(private_path)
+    private_keys[signer_id] = private_key
+    return private_key
@@ -1,9 +1,17 @@
 from hashlib import sha256
-from ecdsa import BadSignatureError
+from ecdsa import BadSignatureError, VerifyingKey, SECP256k1
 from ecdsa.util import sigencode_der, sigdecode_der
+from crypto.key_manager import precompute_public_key
+
+# Verifying keys rebuilt inside worker processes, keyed by their raw encoding
+_worker_keys = {}
+
+# Sign a block header using the user's private key.
+# A prehashed digest is signed as is; otherwise it is hashed again first, as older headers were.
+def sign_digest(digest, private_key, prehashed=False):
+    if prehashed:
+        return private_key.sign_digest_deterministic(digest, hashfunc=sha256, sigencode=sigencode_der)
 
-# Sign a block header using the user's private key
-def sign_digest(digest, private_key):
     sig = private_key.sign_deterministic(
         digest,
         hashfunc=sha256,
@@ -13,11 +21,26 @@ def sign_digest(digest, private_key):
     return sig
 
 # Verify signature was signed by intended user by using their public key
-def verify_signature(digest, signature, public_key):
+def verify_signature(digest, signature, public_key, prehashed=False):
     try:
-        isValid = public_key.verify(signature, digest, sha256, sigdecode=sigdecode_der)
+        if prehashed:
+            isValid = public_key.verify_digest(signature, digest, sigdecode=sigdecode_der)
+        else:
+            isValid = public_key.verify(signature, digest, sha256, sigdecode=sigdecode_der)
         assert isValid
         return True
     except BadSignatureError:
         return False
 
+# Verify one (digest, signature, raw public key, prehashed) job inside a worker process
+def _verify_job(job):
+    digest, signature, key_bytes, prehashed = job
+    public_key = _worker_keys.get(key_bytes)
+    if public_key is None:
+        public_key = precompute_public_key(VerifyingKey.from_string(key_bytes, curve=SECP256k1))
+        _worker_keys[key_bytes] = public_key
+    return verify_signature(digest, signature, public_key, prehashed)
+
+# Verify many signatures on a process pool, returning one result per job in order
+def verify_signatures(jobs, executor, chunksize=16):
+    return list(executor.map(_verify_job, jobs, chunksize=chunksize))
@@ -0,0 +1,714 @@
+import os
+import mmap
+import glob
+import json
+import struct
+import zlib
+import bisect
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from blockchain.block import Block, BlockHeader, HEADER_V1, HEADER_LAYOUT, pack_value, unpack_value
+from blockchain.merkle_tree import MerkleTree
+from blockchain.merkle_builder import DIGEST_SIZE
+from blockchain.mmr import MerkleMountainRange, append_to_peaks, mountain_heights, node_count
+
+try:
+    import fcntl
+except ImportError:
+    # Without flock the write lock only serializes threads of one process
+    fcntl = None
+
+# Format version written at the start of every block record.
+# Version 3 adds the chain root and version 2 the block header version; version 1 records all
+# hold JSON (version 1) headers.
+RECORD_VERSION = 3
+
+# Segments are rotated once they grow past this many bytes
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Number of appends grouped into a single fsync
+SYNC_EVERY = 32
+
+# Number of decoded block headers kept in memory
+BLOCK_CACHE_SIZE = 256
+
+# Number of Merkle trees kept in memory for proofs
+TREE_CACHE_SIZE = 64
+
+# Record frame: payload length and CRC32 of the payload
+FRAME = struct.Struct('<II')
+
+# Offset index entry: segment number and byte offset of a record
+INDEX_ENTRY = struct.Struct('<IQ')
+
+# Fixed part of a record payload: version, block index, timestamp (the binary header layout)
+HEADER = HEADER_LAYOUT
+
+# Block header version, following the fixed part in version 2 records
+HEADER_VERSION_FIELD = struct.Struct('<B')
+
+# File index entry: leaf hash, block position and leaf position, appended in block order
+FILE_ENTRY = struct.Struct(f'<{DIGEST_SIZE}sII')
+
+SEGMENT_PATTERN = 'segment-*.dat'
+INDEX_FILE = 'blocks.idx'
+FILE_INDEX_FILE = 'files.idx'
+# Nodes of the MMR over the block hashes, DIGEST_SIZE bytes each, in the order they were appended
+MMR_FILE = 'mmr.idx'
+CHECKPOINT_FILE = 'checkpoints.json'
+LOCK_FILE = 'write.lock'
+# Bumped whenever blocks are truncated, so other processes know to reload the whole index
+GENERATION_FILE = 'generation'
+
+
+class ChainStoreError(Exception):
+    pass
+
+
+# Serialize a block into a compact binary record payload
+def encode_block(block):
+    leaves = block.merkle_tree.leaves or []
+    leaf_size = len(leaves[0]) if leaves else 0
+    if any(len(leaf) != leaf_size for leaf in leaves):
+        raise ChainStoreError("Stored blocks must have leaves of equal size")
+    # The file index and the MMR file hold fixed-size hashes
+    if leaves and leaf_size != DIGEST_SIZE:
+        raise ChainStoreError(f"Stored leaves must be {DIGEST_SIZE}-byte hashes")
+    if len(block.hash) != DIGEST_SIZE:
+        raise ChainStoreError(f"Stored block hashes must be {DIGEST_SIZE} bytes")
+
+    parts = [
+        HEADER.pack(RECORD_VERSION, block.index, float(block.timestamp)),
+        HEADER_VERSION_FIELD.pack(block.header_version),
+        pack_value(block.merkle_root),
+        pack_value(block.prev_hash),
+        pack_value(block.signer_id),
+        pack_value(block.signature),
+        pack_value(block.hash),
+        pack_value(block.chain_root),
+        struct.pack('<IH', len(leaves), leaf_size),
+    ]
+    parts.extend(bytes(leaf) for leaf in leaves)
+    return b''.join(parts)
+
+# File index entries for the leaves of the block at a position
+def file_entries(leaves, position):
+    if leaves and len(leaves[0]) != DIGEST_SIZE:
+        raise ChainStoreError(f"Stored leaves must be {DIGEST_SIZE}-byte hashes")
+    return b''.join(FILE_ENTRY.pack(bytes(leaf), position, leaf_position) for leaf_position, leaf in enumerate(leaves))
+
+# Split a record payload into its header fields and, unless skipped, its raw leaves
+def decode_fields(payload, with_leaves=True):
+    version, index, timestamp = HEADER.unpack_from(payload, 0)
+    offset = HEADER.size
+    if version == 1:
+        header_version = HEADER_V1
+    elif version in (2, RECORD_VERSION):
+        header_version, = HEADER_VERSION_FIELD.unpack_from(payload, offset)
+        offset += HEADER_VERSION_FIELD.size
+    else:
+        raise ChainStoreError(f"Unsupported record version {version}")
+
+    merkle_root, offset = unpack_value(payload, offset)
+    prev_hash, offset = unpack_value(payload, offset)
+    signer_id, offset = unpack_value(payload, offset)
+    signature, offset = unpack_value(payload, offset)
+    block_hash, offset = unpack_value(payload, offset)
+    chain_root = None
+    if version == RECORD_VERSION:
+        chain_root, offset = unpack_value(payload, offset)
+    leaves = None
+    if with_leaves:
+        leaf_count, leaf_size = struct.unpack_from('<IH', payload, offset)
+        offset += 6
+        leaves = [bytes(payload[offset + i * leaf_size:offset + (i + 1) * leaf_size]) for i in range(leaf_count)]
+    return {
+        'index': index,
+        'timestamp': timestamp,
+        'merkle_root': merkle_root,
+        'prev_hash': prev_hash,
+        'signer_id': signer_id,
+        'signature': signature,
+        'hash': block_hash,
+        'header_version': header_version,
+        'chain_root': chain_root,
+        'leaves': leaves,
+    }
+
+# Rebuild only the header of a block from a record payload, skipping its leaves
+def decode_header(payload):
+    fields = decode_fields(payload, with_leaves=False)
+    return BlockHeader(
+        fields['index'],
+        fields['timestamp'],
+        fields['merkle_root'],
+        fields['prev_hash'],
+        fields['signer_id'],
+        fields['signature'],
+        fields['hash'],
+        fields['header_version'],
+        fields['chain_root'],
+    )
+
+# Rebuild a block from a record payload without re-signing it
+def decode_block(payload):
+    fields = decode_fields(payload)
+    return Block.restore(
+        fields['index'],
+        fields['timestamp'],
+        MerkleTree(fields['leaves']),
+        fields['prev_hash'],
+        fields['signer_id'],
+        fields['signature'],
+        fields['hash'],
+        fields['header_version'],
+        fields['chain_root'],
+    )
+
+
+class ChainStore:
+    # Open (or create) a store directory and recover its offset and file indexes
+    def __init__(self, path, segment_size=SEGMENT_SIZE, sync_every=SYNC_EVERY, cache_size=BLOCK_CACHE_SIZE, tree_cache_size=TREE_CACHE_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.tree_cache_size = tree_cache_size
+        self.trees = OrderedDict()
+        self.maps = {}
+        self.unsynced = 0
+        self.thread_lock = threading.RLock()
+        self.lock_file = None
+        self.lock_pid = None
+        self.lock_depth = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.index_path = os.path.join(path, INDEX_FILE)
+        self.files_path = os.path.join(path, FILE_INDEX_FILE)
+        self.mmr_path = os.path.join(path, MMR_FILE)
+        # Peaks of the block hash MMR, read from the MMR file when next appended to
+        self.mmr_peaks = None
+        self.generation_path = os.path.join(path, GENERATION_FILE)
+        with self.locked():
+            self.generation = self.read_generation()
+            with open(self.index_path, 'ab'):
+                pass
+            self.index = self.read_index()
+
+            self.recover()
+
+            self.segment, _ = self.tail()
+            self.segment_file = open(self.segment_path(self.segment), 'ab')
+            self.index_file = open(self.index_path, 'ab')
+
+            self.recover_file_index()
+            # Unbuffered, so a block's file entries reach the file before its offset index entry
+            self.files_file = open(self.files_path, 'ab', buffering=0)
+
+            self.recover_mmr()
+            self.mmr_file = open(self.mmr_path, 'ab', buffering=0)
+
+    # Complete entries of the index file from a byte offset on
+    def read_index(self, start=0):
+        with open(self.index_path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        return bytearray(data[:len(data) - len(data) % INDEX_ENTRY.size])
+
+    # Truncation counter shared by every process using the store
+    def read_generation(self):
+        try:
+            with open(self.generation_path, 'r') as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    # Hold the store's write lock, shared by the threads of this process and, through flock,
+    # by every other process using the same directory
+    @contextmanager
+    def locked(self):
+        with self.thread_lock:
+            if self.lock_depth == 0 and fcntl is not None:
+                # flock locks belong to the open file, so a forked worker must open its own
+                if self.lock_pid != os.getpid():
+                    self.lock_file = open(os.path.join(self.path, LOCK_FILE), 'a')
+                    self.lock_pid = os.getpid()
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield self
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    # Hold the write lock while appending; the appends are synced before other processes may read them
+    @contextmanager
+    def writer(self):
+        with self.locked():
+            try:
+                yield self
+            finally:
+                if self.lock_depth == 1:
+                    self.sync()
+
+    # Pick up blocks that other processes wrote since this store last looked.
+    # Returns the first position whose block may have changed, or None if nothing did.
+    def refresh(self):
+        with self.thread_lock:
+            generation = self.read_generation()
+            entries = None
+            if generation == self.generation:
+                entries = self.read_index(len(self.index))
+                if not entries:
+                    return None
+                # A truncation that landed while reading means the entries may not follow ours
+                if self.read_generation() != generation:
+                    entries = None
+
+            self.mmr_peaks = None
+            if entries is not None:
+                first = len(self)
+                self.index += entries
+            else:
+                # Blocks were truncated elsewhere, so every position may have changed
+                self.generation = self.read_generation()
+                self.index = self.read_index()
+                self.cache.clear()
+                self.trees.clear()
+                for mapped in self.maps.values():
+                    mapped.close()
+                self.maps = {}
+                first = 0
+
+            # Keep appending at the tail other writers left behind
+            segment, _ = self.tail()
+            if segment != self.segment or self.segment_file.closed:
+                self.segment_file.close()
+                self.segment = segment
+                self.segment_file = open(self.segment_path(segment), 'ab')
+            else:
+                self.segment_file.seek(0, os.SEEK_END)
+            return first
+
+    # Path of a segment file by number
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"segment-{segment:08d}.dat")
+
+    # Numbers of the segment files on disk, in order
+    def segment_numbers(self):
+        names = glob.glob(os.path.join(self.path, SEGMENT_PATTERN))
+        return sorted(int(os.path.basename(name)[8:-4]) for name in names)
+
+    # Location of an indexed record
+    def entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)
+
+    # Segment and offset just past the last indexed record
+    def tail(self):
+        if len(self) == 0:
+            return 0, 0
+        segment, offset = self.entry(len(self) - 1)
+        length, _ = FRAME.unpack(self.read_exact(segment, offset, FRAME.size))
+        return segment, offset + FRAME.size + length
+
+    # Read a byte range straight from a segment file
+    def read_exact(self, segment, offset, size):
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    # Check that a complete, uncorrupted record starts at an offset
+    def record_at(self, segment, offset):
+        path = self.segment_path(segment)
+        if not os.path.exists(path):
+            return None
+        file_size = os.path.getsize(path)
+        if offset + FRAME.size > file_size:
+            return None
+        length, checksum = FRAME.unpack(self.read_exact(segment, offset, FRAME.size))
+        if offset + FRAME.size + length > file_size:
+            return None
+        payload = self.read_exact(segment, offset + FRAME.size, length)
+        if zlib.crc32(payload) != checksum:
+            return None
+        return length
+
+    # Reconcile the index with the segments after an unclean shutdown
+    def recover(self):
+        changed = False
+
+        # Drop index entries that point at torn or missing records
+        while len(self) > 0 and self.record_at(*self.entry(len(self) - 1)) is None:
+            del self.index[-INDEX_ENTRY.size:]
+            changed = True
+
+        # Index complete records that were written after the last index sync
+        segment, offset = self.tail()
+        for number in self.segment_numbers():
+            if number < segment:
+                continue
+            if number > segment:
+                # Only continue into the next segment once the current one is fully indexed
+                if number != segment + 1 or offset != os.path.getsize(self.segment_path(segment)):
+                    break
+                segment, offset = number, 0
+            while True:
+                length = self.record_at(segment, offset)
+                if length is None:
+                    break
+                self.index += INDEX_ENTRY.pack(segment, offset)
+                offset += FRAME.size + length
+                changed = True
+
+        # Cut off any partial record at the tail and discard later segments
+        segment, offset = self.tail()
+        path = self.segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) > offset:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        for number in self.segment_numbers():
+            if number > segment:
+                os.remove(self.segment_path(number))
+
+        if changed:
+            with open(self.index_path, 'wb') as f:
+                f.write(self.index)
+                f.flush()
+                os.fsync(f.fileno())
+
+    # Number of complete entries in the file index
+    def file_entry_count(self):
+        return os.path.getsize(self.files_path) // FILE_ENTRY.size
+
+    # Block position of a file index entry
+    def file_entry_block(self, f, number):
+        f.seek(number * FILE_ENTRY.size)
+        return FILE_ENTRY.unpack(f.read(FILE_ENTRY.size))[1]
+
+    # Number of the first file index entry for a block at or after a position
+    def first_file_entry(self, position):
+        low, high = 0, self.file_entry_count()
+        with open(self.files_path, 'rb') as f:
+            while low < high:
+                middle = (low + high) // 2
+                if self.file_entry_block(f, middle) < position:
+                    low = middle + 1
+                else:
+                    high = middle
+        return low
+
+    # Bring the file index in line with the stored blocks, after an unclean shutdown or for a
+    # store written before the index existed. Entries past the last block are dropped, and the
+    # last indexed block, whose entries may be incomplete, is indexed again with every later one.
+    def recover_file_index(self):
+        with open(self.files_path, 'ab'):
+            pass
+        start = 0
+        count = self.file_entry_count()
+        if count:
+            with open(self.files_path, 'rb') as f:
+                start = min(self.file_entry_block(f, count - 1), len(self))
+        cut = self.first_file_entry(start)
+        entries = b''.join(file_entries(self.get_leaves(position), position) for position in range(start, len(self)))
+
+        with open(self.files_path, 'r+b') as f:
+            f.seek(cut * FILE_ENTRY.size)
+            if f.read() == entries:
+                return
+            f.truncate(cut * FILE_ENTRY.size)
+            f.seek(0, os.SEEK_END)
+            f.write(entries)
+            f.flush()
+            os.fsync(f.fileno())
+
+    # Map each stored file hash to the (block position, leaf position) of its first occurrence,
+    # read from the file index rather than the block records
+    def load_file_index(self):
+        with self.thread_lock:
+            length = len(self)
+            with open(self.files_path, 'rb') as f:
+                data = f.read()
+        file_index = {}
+        for leaf, position, leaf_position in FILE_ENTRY.iter_unpack(memoryview(data)[:len(data) - len(data) % FILE_ENTRY.size]):
+            # Entries of blocks that are not indexed yet (or were truncated) are skipped
+            if position >= length:
+                break
+            file_index.setdefault(leaf, (position, leaf_position))
+        return file_index
+
+    # Peaks of the block hash MMR over the first leaf_count blocks, read from the MMR file
+    def read_mmr_peaks(self, leaf_count):
+        peaks = []
+        start = 0
+        with open(self.mmr_path, 'rb') as f:
+            for height in mountain_heights(leaf_count):
+                start += 1 << height
+                f.seek((node_count(start) - 1) * DIGEST_SIZE)
+                peaks.append(f.read(DIGEST_SIZE))
+        return peaks
+
+    # Bring the MMR file in line with the stored blocks. Nodes past the last block are dropped, and
+    # blocks without all of their nodes (after an unclean shutdown, or in a store written before
+    # the file existed) have them computed again from their headers.
+    def recover_mmr(self):
+        with open(self.mmr_path, 'ab'):
+            pass
+        stored = os.path.getsize(self.mmr_path) // DIGEST_SIZE
+        count = bisect.bisect_right(range(len(self) + 1), stored, key=node_count) - 1
+        peaks = self.read_mmr_peaks(count)
+        nodes = []
+        for position in range(count, len(self)):
+            nodes.extend(append_to_peaks(peaks, position, decode_fields(self.payload(position), with_leaves=False)['hash']))
+
+        size = node_count(count) * DIGEST_SIZE
+        if not nodes and os.path.getsize(self.mmr_path) == size:
+            return
+        with open(self.mmr_path, 'r+b') as f:
+            f.truncate(size)
+            f.seek(0, os.SEEK_END)
+            f.write(b''.join(nodes))
+            f.flush()
+            os.fsync(f.fileno())
+
+    # MMR over the stored block hashes, read from the MMR file rather than the block records
+    def load_mmr(self):
+        with self.thread_lock:
+            length = len(self)
+            with open(self.mmr_path, 'rb') as f:
+                data = f.read(node_count(length) * DIGEST_SIZE)
+        return MerkleMountainRange.from_nodes(
+            (data[offset:offset + DIGEST_SIZE] for offset in range(0, len(data), DIGEST_SIZE)), length
+        )
+
+    # Number of stored blocks
+    def __len__(self):
+        return len(self.index) // INDEX_ENTRY.size
+
+    # Decode a block by position, or a list of blocks for a slice.
+    # Blocks hold only their header; the Merkle tree is loaded through get_tree when it is used.
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+
+        # Reads share the lock with appends, refreshes and truncations, which remap segments and clear the caches
+        with self.thread_lock:
+            if position < 0:
+                position += len(self)
+            if position < 0 or position >= len(self):
+                raise IndexError("block position out of range")
+
+            block = self.cache.get(position)
+            if block is not None:
+                self.cache.move_to_end(position)
+                return block
+
+            header = decode_header(self.payload(position))
+            block = Block.from_header(header, lambda: self.get_tree(position))
+            self.cache[position] = block
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return block
+
+    # Merkle tree of a stored block, kept in a small LRU cache of recently used trees
+    def get_tree(self, position):
+        with self.thread_lock:
+            tree = self.trees.get(position)
+            if tree is not None:
+                self.trees.move_to_end(position)
+                return tree
+
+        # The tree is built outside the lock; the leaves are already copied out of the segment
+        tree = MerkleTree(self.get_leaves(position))
+        self.cache_tree(position, tree)
+        return tree
+
+    # Remember the tree of a block position, evicting the least recently used one
+    def cache_tree(self, position, tree):
+        if self.tree_cache_size <= 0:
+            return
+        with self.thread_lock:
+            self.trees[position] = tree
+            if len(self.trees) > self.tree_cache_size:
+                self.trees.popitem(last=False)
+
+    # Iterate over the stored blocks in order
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    # Memory-mapped view of a segment, remapped when it has grown. Callers hold thread_lock.
+    def segment_map(self, segment, needed):
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < needed:
+            if mapped is not None:
+                mapped.close()
+            with open(self.segment_path(segment), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mapped
+        return mapped
+
+    # Raw record payload for a block position, copied out of the segment map.
+    # The lock keeps another thread from closing the map while it is read.
+    def payload(self, position):
+        with self.thread_lock:
+            segment, offset = self.entry(position)
+            if segment == self.segment:
+                self.segment_file.flush()
+            mapped = self.segment_map(segment, offset + FRAME.size)
+            length, _ = FRAME.unpack_from(mapped, offset)
+            mapped = self.segment_map(segment, offset + FRAME.size + length)
+            start = offset + FRAME.size
+            return mapped[start:start + length]
+
+    # Raw leaves of a stored block, without building its Merkle tree
+    def get_leaves(self, position):
+        return decode_fields(self.payload(position))['leaves']
+
+    # Append a block record and its index entry
+    def append(self, block):
+        payload = encode_block(block)
+        record = FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+        # Readers flush and map the current segment, so rotating it must not race them
+        with self.thread_lock:
+            # Everything is built before the first write, so a rejected block leaves no trace
+            entries = file_entries(block.merkle_tree.leaves or [], len(self))
+            if self.mmr_peaks is None:
+                self.mmr_peaks = self.read_mmr_peaks(len(self))
+            peaks = list(self.mmr_peaks)
+            nodes = b''.join(append_to_peaks(peaks, len(self), block.hash))
+
+            offset = self.segment_file.tell()
+            if offset > 0 and offset + len(record) > self.segment_size:
+                self.sync()
+                self.segment_file.close()
+                self.segment += 1
+                self.segment_file = open(self.segment_path(self.segment), 'ab')
+                offset = 0
+
+            self.segment_file.write(record)
+            self.files_file.write(entries)
+            self.mmr_file.write(nodes)
+            entry = INDEX_ENTRY.pack(self.segment, offset)
+            self.index_file.write(entry)
+            self.index += entry
+            self.mmr_peaks = peaks
+
+            # Newly added blocks are the most likely to be asked for proofs
+            if block.has_tree:
+                self.cache_tree(len(self) - 1, block.merkle_tree)
+
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self.sync()
+
+    # Flush buffered appends and fsync segments, the file index and the MMR before the offset index
+    def sync(self):
+        with self.thread_lock:
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            os.fsync(self.files_file.fileno())
+            os.fsync(self.mmr_file.fileno())
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+            self.unsynced = 0
+
+    # Drop every block from a position onwards
+    def truncate(self, position):
+        with self.locked():
+            if position >= len(self):
+                return
+            self.sync()
+            segment, offset = self.entry(position)
+
+            self.segment_file.close()
+            self.index_file.close()
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+            self.cache.clear()
+            self.trees.clear()
+
+            for number in self.segment_numbers():
+                if number > segment:
+                    os.remove(self.segment_path(number))
+            with open(self.segment_path(segment), 'r+b') as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+            self.files_file.close()
+            with open(self.files_path, 'r+b') as f:
+                f.truncate(self.first_file_entry(position) * FILE_ENTRY.size)
+                os.fsync(f.fileno())
+            self.files_file = open(self.files_path, 'ab', buffering=0)
+
+            self.mmr_file.close()
+            with open(self.mmr_path, 'r+b') as f:
+                f.truncate(node_count(position) * DIGEST_SIZE)
+                os.fsync(f.fileno())
+            self.mmr_file = open(self.mmr_path, 'ab', buffering=0)
+            self.mmr_peaks = None
+
+            del self.index[position * INDEX_ENTRY.size:]
+            with open(self.index_path, 'wb') as f:
+                f.write(self.index)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.generation += 1
+            temp_path = self.generation_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(str(self.generation))
+            os.replace(temp_path, self.generation_path)
+
+            self.segment = segment
+            self.segment_file = open(self.segment_path(segment), 'ab')
+            self.index_file = open(self.index_path, 'ab')
+
+    # Replace the blocks from a position onwards with new ones
+    def replace_from(self, position, blocks):
+        with self.writer():
+            self.truncate(position)
+            for block in blocks:
+                self.append(block)
+
+    # Trusted (position, block hash) checkpoints saved alongside the segments
+    def load_checkpoints(self):
+        path = os.path.join(self.path, CHECKPOINT_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return [(position, bytes.fromhex(block_hash)) for position, block_hash in data if position < len(self)]
+
+    # Atomically replace the saved checkpoints
+    def save_checkpoints(self, checkpoints):
+        # Checkpoints must never point past blocks that are durably stored
+        self.sync()
+        path = os.path.join(self.path, CHECKPOINT_FILE)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump([[position, block_hash.hex()] for position, block_hash in checkpoints], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    # Sync outstanding appends and release file handles
+    def close(self):
+        if self.segment_file.closed:
+            return
+        self.sync()
+        self.segment_file.close()
+        self.index_file.close()
+        self.files_file.close()
+        self.mmr_file.close()
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+            self.lock_pid = None
@@ -3,41 +3,267 @@ import time
 import os
 import signal
 import atexit
+import http.client
+import json
+import queue
+import threading
+import uuid
+from urllib.parse import urlencode
+
+# Address of the daemon's HTTP RPC API
+DEFAULT_API_ADDR = "/ip4/127.0.0.1/tcp/5001"
+
+# Bytes read from disk per chunk of a streamed upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Longest time to wait for a freshly started daemon to answer
+STARTUP_TIMEOUT = 30
+
+# Backoff between readiness probes, doubling from the initial delay up to the maximum
+PROBE_INITIAL_DELAY = 0.05
+PROBE_MAX_DELAY = 1.0
+
+# Errors raised when a reused keep-alive connection was closed by the daemon
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
 
 class IPFSDaemon:
-    def __init__(self):
+    def __init__(self, multiaddr=DEFAULT_API_ADDR):
         self.process = None
+        # Short timeouts so a probe never holds up startup
+        self.probe_client = IPFSHTTPClient(multiaddr, pool_size=1, timeout=1)
+        self.ready = threading.Event()
+        self.reused = False
         atexit.register(self.cleanup)
 
-    def start(self):
-        if self.process is None:
-            try:
-                # Start IPFS daemon
-                self.process = subprocess.Popen(
-                    ['ipfs', 'daemon'],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    preexec_fn=os.setsid
-                )
-                # Wait for daemon to start
-                time.sleep(5)
+    # Check whether a daemon is answering on the API port
+    def is_running(self):
+        try:
+            self.probe_client.call('version')
+            return True
+        except (OSError, IPFSAPIError):
+            return False
+
+    # Start the daemon unless one is already running, optionally waiting for readiness in the background
+    def start(self, background=False, timeout=STARTUP_TIMEOUT):
+        if self.process is not None or self.ready.is_set():
+            return True
+
+        if self.is_running():
+            self.reused = True
+            self.ready.set()
+            return True
+
+        try:
+            # Start IPFS daemon
+            self.process = subprocess.Popen(
+                ['ipfs', 'daemon'],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=os.setsid
+            )
+        except Exception as e:
+            print(f"Failed to start IPFS daemon: {e}")
+            return False
+
+        if background:
+            threading.Thread(target=self.wait_until_ready, args=(timeout,), daemon=True).start()
+            return True
+        return self.wait_until_ready(timeout)
+
+    # Poll the API with backoff until it answers, the daemon exits, or the deadline passes
+    def wait_until_ready(self, timeout=STARTUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        delay = PROBE_INITIAL_DELAY
+        while True:
+            if self.is_running():
+                self.ready.set()
                 return True
-            except Exception as e:
-                print(f"Failed to start IPFS daemon: {e}")
+            if self.process is not None and self.process.poll() is not None:
+                print(f"IPFS daemon exited with code {self.process.returncode}")
                 return False
-        return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"IPFS daemon was not ready after {timeout} seconds")
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, PROBE_MAX_DELAY)
 
     def stop(self):
         if self.process:
             try:
                 os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
                 self.process = None
+                self.ready.clear()
             except Exception as e:
                 print(f"Failed to stop IPFS daemon: {e}")
 
     def cleanup(self):
         self.stop()
 
+class IPFSAPIError(Exception):
+    pass
+
+
+# Split an /ip4/<host>/tcp/<port> multiaddr into host and port
+def parse_multiaddr(multiaddr):
+    parts = multiaddr.strip('/').split('/')
+    if len(parts) != 4 or parts[0] not in ('ip4', 'ip6', 'dns', 'dns4', 'dns6') or parts[2] != 'tcp':
+        raise ValueError(f"Unsupported IPFS API address: {multiaddr}")
+    return parts[1], int(parts[3])
+
+
+class IPFSHTTPClient:
+    # Client for the daemon's /api/v0 RPC endpoints over pooled keep-alive connections
+    def __init__(self, multiaddr=DEFAULT_API_ADDR, pool_size=4, timeout=60):
+        self.host, self.port = parse_multiaddr(multiaddr)
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=pool_size)
+
+    # Take an idle connection from the pool, or open a new one
+    def acquire(self):
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    # Return a connection to the pool, closing it if the pool is full
+    def release(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    # POST to an RPC endpoint and pass the response to a handler before the connection is reused
+    def call(self, endpoint, params=None, body=None, headers=None, handler=None):
+        url = f"/api/v0/{endpoint}"
+        if params:
+            url += "?" + urlencode(params)
+
+        while True:
+            connection, reused = self.acquire()
+            try:
+                connection.request("POST", url, body=body() if body else None, headers=headers or {})
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if reused:
+                    # The daemon closed an idle connection; retry once on a fresh one
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            break
+
+        try:
+            if response.status != 200:
+                message = response.read().decode('utf-8', 'replace')
+                raise IPFSAPIError(f"{endpoint} failed with HTTP {response.status}: {message}")
+            result = handler(response) if handler else response.read()
+            response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+        return result
+
+    # Call an endpoint that answers with a JSON object
+    def call_json(self, endpoint, params=None):
+        return json.loads(self.call(endpoint, params))
+
+    # Stream a file to the daemon as a multipart upload and return its CID
+    def add(self, file_path, pin=True):
+        boundary = uuid.uuid4().hex
+        filename = os.path.basename(file_path).replace('"', '')
+        preamble = (
+            f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode('utf-8')
+        epilogue = f"\r\n--{boundary}--\r\n".encode('utf-8')
+        length = len(preamble) + os.path.getsize(file_path) + len(epilogue)
+
+        def body():
+            yield preamble
+            with open(file_path, 'rb') as f:
+                while True:
+                    chunk = f.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            yield epilogue
+
+        headers = {
+            'Content-Type': f"multipart/form-data; boundary={boundary}",
+            'Content-Length': str(length),
+        }
+        params = {'pin': 'true' if pin else 'false', 'progress': 'false'}
+        output = self.call('add', params, body=body, headers=headers)
+        # The daemon reports one JSON object per line; the last one is the added file
+        lines = [line for line in output.decode('utf-8').splitlines() if line.strip()]
+        return json.loads(lines[-1])['Hash']
+
+    # Stream the contents of a CID into a file
+    def cat(self, cid, output_path):
+        def handler(response):
+            with open(output_path, 'wb') as f:
+                while True:
+                    chunk = response.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            return True
+
+        return self.call('cat', {'arg': cid}, handler=handler)
+
+    # Pin a CID and describe the result like the CLI does
+    def pin_add(self, cid):
+        pins = self.call_json('pin/add', {'arg': cid}).get('Pins', [])
+        return "\n".join(f"pinned {pin} recursively" for pin in pins)
+
+    # Unpin a CID and describe the result like the CLI does
+    def pin_rm(self, cid):
+        pins = self.call_json('pin/rm', {'arg': cid}).get('Pins', [])
+        return "\n".join(f"unpinned {pin}" for pin in pins)
+
+    # Resolve a name or path to an /ipfs path
+    def resolve(self, cid):
+        return self.call_json('resolve', {'arg': cid})['Path']
+
+    # Close every idle connection
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# Client shared by the module-level helpers
+_client = IPFSHTTPClient()
+
+# Point the module-level helpers at a daemon's API address
+def connect_api(multiaddr=DEFAULT_API_ADDR):
+    global _client
+    _client.close()
+    _client = IPFSHTTPClient(multiaddr)
+    return _client
+
+# Run an operation over the HTTP API, falling back to the CLI when the daemon cannot be reached
+def call_api(operation, fallback):
+    try:
+        return operation(_client)
+    except IPFSAPIError as e:
+        print(f"IPFS API call failed: {e}")
+        return None
+    except OSError:
+        return fallback()
+
 def run_ipfs_command(command):
     """Run an IPFS command and return the output"""
     try:
@@ -49,11 +275,21 @@ def run_ipfs_command(command):
 
 # Add a file to IPFS
 def add_file(file_path):
-    result = run_ipfs_command(['add', '-Q', file_path])
-    return result
+    return call_api(
+        lambda client: client.add(file_path),
+        lambda: run_ipfs_command(['add', '-Q', file_path])
+    )
 
 # Get a file from IPFS
 def get_file(cid, output_path):
+    result = call_api(
+        lambda client: client.cat(cid, output_path),
+        lambda: get_file_with_cli(cid, output_path)
+    )
+    return bool(result)
+
+# Get a file from IPFS through the CLI
+def get_file_with_cli(cid, output_path):
     try:
         result = subprocess.run(['ipfs', 'get', cid, '-o', output_path], check=True)
         return True
@@ -63,12 +299,21 @@ def get_file(cid, output_path):
 
 # Pin a file to IPFS
 def pin_file(cid):
-    return run_ipfs_command(['pin', 'add', cid])
+    return call_api(
+        lambda client: client.pin_add(cid),
+        lambda: run_ipfs_command(['pin', 'add', cid])
+    )
 
 # Unpin a file from IPFS
 def unpin_file(cid):
-    return run_ipfs_command(['pin', 'rm', cid])
+    return call_api(
+        lambda client: client.pin_rm(cid),
+        lambda: run_ipfs_command(['pin', 'rm', cid])
+    )
 
 # Resolve a path to a CID
 def resolve_path(cid):
-    return run_ipfs_command(['resolve', cid])
\ No newline at end of file
+    return call_api(
+        lambda client: client.resolve(cid),
+        lambda: run_ipfs_command(['resolve', cid])
+    )
@@ -0,0 +1,132 @@
+import os
+import queue
+import threading
+from collections import OrderedDict
+from storage.ipfs_client import add_file
+
+# Number of threads uploading to IPFS at the same time
+UPLOAD_WORKERS = 4
+
+# Largest number of queued files a worker takes in one go
+UPLOAD_BATCH_SIZE = 8
+
+# Number of finished (uploaded or failed) document entries kept for status lookups
+FINISHED_DOCUMENTS = 10000
+
+# Upload states recorded on each document
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+
+
+class UploadQueue:
+    # Upload documents to IPFS on worker threads, filling in each document's CID once it is known
+    def __init__(self, uploader=add_file, workers=UPLOAD_WORKERS, batch_size=UPLOAD_BATCH_SIZE, finished_size=FINISHED_DOCUMENTS):
+        self.uploader = uploader
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        # Map a file hash to its document entry: every pending upload is kept, while finished
+        # ones are kept in an LRU cache of finished_size entries
+        self.pending = {}
+        self.finished = OrderedDict()
+        self.finished_size = finished_size
+        self.outstanding = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # Queue a file for upload and return its document entry with a pending CID.
+    # The queue takes ownership of the file and deletes it once it has been uploaded.
+    def submit(self, file_hash, file_path):
+        document = {'hash': file_hash, 'ipfs_hash': None, 'status': PENDING}
+        with self.lock:
+            if not self.threads:
+                raise RuntimeError("Upload queue is closed")
+            self.pending[file_hash] = document
+            self.finished.pop(file_hash, None)
+            self.outstanding += 1
+        self.jobs.put((document, file_path))
+        return document
+
+    # Return the document entry recorded for a file hash, or None if it was never queued
+    # or has been evicted since it finished
+    def get(self, file_hash):
+        with self.lock:
+            document = self.pending.get(file_hash)
+            if document is None:
+                document = self.finished.get(file_hash)
+                if document is not None:
+                    self.finished.move_to_end(file_hash)
+            return document
+
+    # Take a job and up to batch_size - 1 more already waiting, and upload them in turn
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    # Leave the stop marker for the next loop
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+
+            for document, file_path in batch:
+                self.upload(document, file_path)
+
+    # Upload one file and record the resulting CID
+    def upload(self, document, file_path):
+        try:
+            cid = self.uploader(file_path)
+        except Exception as e:
+            print(f"Failed to upload {file_path} to IPFS: {e}")
+            cid = None
+        finally:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+        with self.lock:
+            document['ipfs_hash'] = cid
+            document['status'] = UPLOADED if cid else FAILED
+            self.finish(document)
+            self.outstanding -= 1
+            self.idle.notify_all()
+
+    # Move a finished document from the pending entries to the LRU cache, evicting the least
+    # recently used one when it is full. Called with the lock held.
+    def finish(self, document):
+        file_hash = document['hash']
+        # A later submission of the same hash is still pending and takes over the entry
+        if self.pending.get(file_hash) is not document:
+            return
+        del self.pending[file_hash]
+        if self.finished_size <= 0:
+            return
+        self.finished[file_hash] = document
+        if len(self.finished) > self.finished_size:
+            self.finished.popitem(last=False)
+
+    # Block until every queued upload has finished, returning False on timeout
+    def wait(self, timeout=None):
+        with self.lock:
+            return self.idle.wait_for(lambda: self.outstanding == 0, timeout)
+
+    # Finish the queued uploads and stop the workers
+    def close(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,24 @@
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from crypto import key_manager
+from blockchain import chain
+
+
+# Point the key registry and the genesis key directory at a scratch directory for the rest
+# of a test, so tests never touch the signers and keys of the working tree
+def use_temp_registry(test):
+    temp_dir = tempfile.mkdtemp()
+    key_manager.close_registry()
+    patches = [
+        patch.object(key_manager, 'KEY_REGISTRY_PATH', os.path.join(temp_dir, "key_registry.json")),
+        patch.object(key_manager, 'KEY_REGISTRY_DB_PATH', os.path.join(temp_dir, "key_registry.db")),
+        patch.object(chain, 'KEYS_PATH', os.path.join(temp_dir, "keys")),
+    ]
+    for p in patches:
+        p.start()
+        test.addCleanup(p.stop)
+    test.addCleanup(shutil.rmtree, temp_dir)
+    test.addCleanup(key_manager.close_registry)
+    return temp_dir
@@ -0,0 +1,418 @@
+import os
+import io
+import json
+import atexit
+import asyncio
+import shutil
+import tempfile
+import tarfile
+import zipfile
+import threading
+import unittest
+from unittest.mock import Mock, patch
+from flask import request, session
+from crypto import key_manager
+from crypto.hash_utils import sha256
+from blockchain import chain
+
+# The app opens its chain store and genesis key when it is imported, so the whole module
+# runs against a scratch chain directory and key registry
+temp_dir = None
+patches = []
+app = None
+
+
+def setUpModule():
+    global temp_dir, app
+    temp_dir = tempfile.mkdtemp()
+    key_manager.close_registry()
+    patches.extend([
+        patch.object(key_manager, 'KEY_REGISTRY_PATH', os.path.join(temp_dir, "key_registry.json")),
+        patch.object(key_manager, 'KEY_REGISTRY_DB_PATH', os.path.join(temp_dir, "key_registry.db")),
+        patch.object(chain, 'KEYS_PATH', os.path.join(temp_dir, "keys")),
+        patch.dict(os.environ, {'CHAIN_DATA_DIR': os.path.join(temp_dir, "chain_data")}),
+    ])
+    for p in patches:
+        p.start()
+    import app as app_module
+    app = app_module
+
+
+def tearDownModule():
+    # Run the app's exit handlers now, while the scratch registry still exists
+    for cleanup in (app.batcher.flush_all, app.blocking_executor.shutdown, app.upload_queue.close, app.chain_store.close):
+        cleanup()
+        atexit.unregister(cleanup)
+    for p in reversed(patches):
+        p.stop()
+    key_manager.close_registry()
+    shutil.rmtree(temp_dir)
+
+
+class AppTestCase(unittest.TestCase):
+    signer_id = "app_tester"
+
+    def setUp(self):
+        if not key_manager.is_registered(self.signer_id):
+            key_manager.generate_keypair(os.path.join(temp_dir, "keys"), self.signer_id)
+        self.client = app.app.test_client()
+
+        # Batches are sealed by document count only, so tests never race a deadline
+        for name, value in (('max_docs', 2), ('max_bytes', 1 << 30), ('max_delay_ms', None)):
+            p = patch.object(app.batcher, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(app.batcher.flush_all)
+
+        # Uploads are recorded instead of sent to IPFS, once released
+        self.uploaded = {}
+        self.release_uploads = threading.Event()
+        self.release_uploads.set()
+        p = patch.object(app.upload_queue, 'uploader', self.upload)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def upload(self, path):
+        self.release_uploads.wait(5)
+        with open(path, 'rb') as f:
+            self.uploaded[path] = f.read()
+        return "Qm" + os.path.basename(path)
+
+    # Sign the test client in as the test signer
+    def sign_in(self):
+        with self.client.session_transaction() as session:
+            session['signer_id'] = self.signer_id
+
+
+class TestIngestDocuments(AppTestCase):
+    def ingest(self, **kwargs):
+        return self.client.post('/api/v1/documents:batch', **kwargs)
+
+    def test_receipts_follow_batch_boundaries(self):
+        hashes = [sha256(f"ingest{i}") for i in range(5)]
+        tip = app.blockchain.get_latest_block().index
+        response = self.ingest(json={'signer_id': self.signer_id, 'hashes': [h.hex() for h in hashes]})
+        self.assertEqual(response.status_code, 200)
+
+        # Batches of two seal blocks tip + 1 and tip + 2; the fifth document waits for tip + 3
+        receipts = response.get_json()['documents']
+        self.assertEqual([receipt['hash'] for receipt in receipts], [h.hex() for h in hashes])
+        self.assertEqual([receipt['sealed'] for receipt in receipts], [True, True, True, True, False])
+        self.assertEqual([receipt['pending_block_index'] for receipt in receipts], [tip + 1, tip + 1, tip + 2, tip + 2, tip + 3])
+        self.assertEqual(app.blockchain.get_latest_block().index, tip + 2)
+        self.assertEqual(app.blockchain.verify_file_in_blockchain(hashes[2]), (True, tip + 2))
+        self.assertEqual(app.batcher.pending_count(self.signer_id), 1)
+
+        # The held-back document is sealed into the block its receipt named
+        app.batcher.flush_all()
+        self.assertEqual(app.blockchain.verify_file_in_blockchain(hashes[4]), (True, tip + 3))
+
+    def test_session_signer_is_used(self):
+        self.sign_in()
+        response = self.ingest(json={'hashes': [sha256("session").hex()]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['signer_id'], self.signer_id)
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.ingest(json={'signer_id': "unregistered", 'hashes': [sha256("a").hex()]}).status_code, 401)
+        self.assertEqual(self.ingest(json={'hashes': [sha256("a").hex()]}).status_code, 401)
+
+        for hashes in ("not a list", ["not hex"], [sha256("a").hex()[:-2]], [7]):
+            response = self.ingest(json={'signer_id': self.signer_id, 'hashes': hashes})
+            self.assertEqual(response.status_code, 400, hashes)
+            self.assertIn('error', response.get_json())
+
+        # Bodies that are JSON but not an object
+        for payload in ([sha256("a").hex()], "hashes", 7):
+            response = self.ingest(json=payload)
+            self.assertEqual(response.status_code, 400, payload)
+            self.assertIn('error', response.get_json())
+
+        response = self.ingest(json={'signer_id': self.signer_id, 'hashes': []})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(app.batcher.pending_count(self.signer_id), 0)
+
+    def test_files_are_handed_to_the_upload_queue(self):
+        contents = [b"first file", b"second file"]
+        self.release_uploads.clear()
+        response = self.ingest(data={
+            'signer_id': self.signer_id,
+            'hashes': sha256("alongside").hex(),
+            'files': [(io.BytesIO(content), f"doc{i}.txt") for i, content in enumerate(contents)],
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+
+        receipts = response.get_json()['documents']
+        self.assertEqual([receipt['hash'] for receipt in receipts], [sha256(data).hex() for data in [b"alongside"] + contents])
+        self.assertIsNone(receipts[0]['ipfs_status'])
+        self.assertEqual([receipt['ipfs_status'] for receipt in receipts[1:]], ['pending', 'pending'])
+
+        # The spooled temp files are uploaded as they are, then removed by the queue
+        self.release_uploads.set()
+        self.assertTrue(app.upload_queue.wait(5))
+        self.assertEqual(sorted(self.uploaded.values()), sorted(contents))
+        self.assertFalse(any(os.path.exists(path) for path in self.uploaded))
+        for content in contents:
+            self.assertEqual(app.upload_queue.get(sha256(content))['status'], 'uploaded')
+
+
+class TestVerifyDocuments(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # Two documents fill one batch, so both are sealed into a block. The chain outlives each
+        # test, so the contents are unique to the test.
+        self.contents = {name: f"{self.id()} {name}".encode() for name in ("a.txt", "docs/b.txt")}
+        response = self.client.post('/api/v1/documents:batch', json={
+            'signer_id': self.signer_id,
+            'hashes': [sha256(content).hex() for content in self.contents.values()]
+        })
+        self.block_index = response.get_json()['documents'][0]['pending_block_index']
+
+        # Archives are hashed from the spooled upload, never copied to a second temp file
+        p = patch.object(app.tempfile, 'TemporaryFile', side_effect=AssertionError("archive was copied"))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def verify(self, **kwargs):
+        return self.client.post('/api/v1/documents:verify', **kwargs)
+
+    def verify_archive(self, data):
+        return self.verify(data={'archive': (io.BytesIO(data), "archive")}, content_type='multipart/form-data')
+
+    # Check the results for the archive members plus one extra file that was never added
+    def assert_archive_results(self, response):
+        self.assertEqual(response.status_code, 200)
+        results = {result['name']: result for result in response.get_json()['documents']}
+        self.assertEqual(set(results), set(self.contents) | {"missing.txt"})
+        for name, content in self.contents.items():
+            self.assertEqual(results[name]['hash'], sha256(content).hex())
+            self.assertTrue(results[name]['verified'])
+            self.assertEqual(results[name]['block_index'], self.block_index)
+        self.assertFalse(results["missing.txt"]['verified'])
+
+    def test_json_hashes(self):
+        found = sha256(self.contents["a.txt"])
+        missing = sha256("never added")
+        response = self.verify(json={'hashes': [found.hex(), missing.hex()]})
+        self.assertEqual(response.status_code, 200)
+
+        found_result, missing_result = response.get_json()['documents']
+        self.assertEqual(found_result['hash'], found.hex())
+        self.assertTrue(found_result['verified'])
+        self.assertEqual(found_result['block_index'], self.block_index)
+        self.assertEqual(found_result['merkle_proof'][0]['hash'], found.hex())
+        self.assertEqual(missing_result, {'verified': False, 'hash': missing.hex()})
+
+        # Compact proofs come back as base64 strings
+        response = self.verify(json={'hashes': [found.hex()]}, query_string={'proof_format': 'compact'})
+        self.assertIsInstance(response.get_json()['documents'][0]['merkle_proof'], str)
+
+    def test_zip_archive(self):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as zip_file:
+            zip_file.writestr("docs/", b"")
+            for name, content in self.contents.items():
+                zip_file.writestr(name, content)
+            zip_file.writestr("missing.txt", b"not in the chain")
+        self.assert_archive_results(self.verify_archive(data.getvalue()))
+
+    def test_tar_archive(self):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as tar_file:
+            directory = tarfile.TarInfo("docs")
+            directory.type = tarfile.DIRTYPE
+            tar_file.addfile(directory)
+            for name, content in list(self.contents.items()) + [("missing.txt", b"not in the chain")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar_file.addfile(info, io.BytesIO(content))
+        self.assert_archive_results(self.verify_archive(data.getvalue()))
+
+    def test_rejects_bad_requests(self):
+        response = self.verify_archive(b"neither a tar nor a zip file")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'error': 'archive must be a tar or zip file'})
+
+        for payload in ({'hashes': "not a list"}, {'hashes': ["not hex"]}, {}, [sha256("a").hex()], "hashes"):
+            self.assertEqual(self.verify(json=payload).status_code, 400, payload)
+        self.assertEqual(self.verify(data={}, content_type='multipart/form-data').status_code, 400)
+
+
+class TestChainPages(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # Seal a few blocks so every listing spans several pages
+        while len(app.blockchain.chain) < 6:
+            self.add_block()
+
+    # Seal one block of two documents unique to this call
+    def add_block(self):
+        hashes = [sha256(f"{self.id()} {len(app.blockchain.chain)} {i}").hex() for i in range(2)]
+        response = self.client.post('/api/v1/documents:batch', json={'signer_id': self.signer_id, 'hashes': hashes})
+        self.assertTrue(all(receipt['sealed'] for receipt in response.get_json()['documents']))
+
+    def expected_hashes(self, start, end):
+        return [app.blockchain.chain[position].hash.hex() for position in range(start, end)]
+
+    def test_json_pages_follow_next_cursor(self):
+        blocks = []
+        params = {'limit': 4}
+        while True:
+            response = self.client.get('/api/v1/blocks', query_string=params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertNotIn('X-Next-Cursor', response.headers)
+            page = response.get_json()
+            self.assertLessEqual(len(page['blocks']), 4)
+            blocks.extend(page['blocks'])
+            if page['next_cursor'] is None:
+                break
+            self.assertEqual(page['next_cursor'], page['blocks'][-1]['index'])
+            params['after'] = page['next_cursor']
+
+        length = len(app.blockchain.chain)
+        self.assertEqual([block['index'] for block in blocks], list(range(length)))
+        self.assertEqual([block['hash'] for block in blocks], self.expected_hashes(0, length))
+
+    def test_page_limits_are_clamped(self):
+        self.assertEqual(len(self.client.get('/api/v1/blocks?limit=0').get_json()['blocks']), 1)
+        with patch.object(app, 'MAX_PAGE_SIZE', 3):
+            self.assertEqual(len(self.client.get('/api/v1/blocks?limit=100').get_json()['blocks']), 3)
+        # Malformed cursors start from the oldest block
+        self.assertEqual(self.client.get('/api/v1/blocks?after=oops&limit=1').get_json()['blocks'][0]['index'], 0)
+
+    def test_ndjson_pages(self):
+        length = len(app.blockchain.chain)
+        for request_args in ({'query_string': {'format': 'ndjson', 'limit': 3}},
+                             {'query_string': {'limit': 3}, 'headers': {'Accept': 'application/x-ndjson'}}):
+            response = self.client.get('/api/v1/blocks', **request_args)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            blocks = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual([block['hash'] for block in blocks], self.expected_hashes(0, 3))
+            self.assertEqual(response.headers['X-Next-Cursor'], '2')
+
+        # The last page has no cursor
+        response = self.client.get('/api/v1/blocks', query_string={'format': 'ndjson', 'after': length - 3})
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 2)
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_etag_answers_not_modified_until_a_block_is_added(self):
+        for path in ('/api/v1/blocks?limit=2', '/chain?limit=2'):
+            response = self.client.get(path)
+            etag = response.headers['ETag']
+
+            response = self.client.get(path, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.get_data(), b"")
+
+            # Another page of the same chain has a tag of its own
+            other = self.client.get(path + '&after=1&before=3')
+            self.assertNotEqual(other.headers['ETag'], etag)
+
+        etags = [self.client.get(path).headers['ETag'] for path in ('/api/v1/blocks?limit=2', '/chain?limit=2')]
+        self.add_block()
+        for path, etag in zip(('/api/v1/blocks?limit=2', '/chain?limit=2'), etags):
+            response = self.client.get(path, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_chain_view_pages_newest_first(self):
+        # Each row starts with the block's index cell
+        def rows(html):
+            return [position for position in range(len(app.blockchain.chain)) if f"<td>{position}</td>" in html]
+
+        length = len(app.blockchain.chain)
+        html = self.client.get('/chain?limit=2').get_data(as_text=True)
+        self.assertEqual(rows(html), [length - 2, length - 1])
+        self.assertLess(html.index(f"<td>{length - 1}</td>"), html.index(f"<td>{length - 2}</td>"))
+        self.assertIn(app.blockchain.chain[length - 1].hash.hex(), html)
+        self.assertIn(f"before={length - 2}&amp;limit=2", html)
+        self.assertNotIn("Newer blocks", html)
+
+        # The oldest page links back to newer blocks only
+        html = self.client.get('/chain?before=2&limit=2').get_data(as_text=True)
+        self.assertEqual(rows(html), [0, 1])
+        self.assertIn("before=4&amp;limit=2", html)
+        self.assertNotIn("Older blocks", html)
+
+class TestAsyncViews(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sign_in()
+
+        # Record every temp file uploads are spooled to
+        self.spooled = []
+        named_temporary_file = tempfile.NamedTemporaryFile
+
+        def spool(*args, **kwargs):
+            file = named_temporary_file(*args, **kwargs)
+            self.spooled.append(file.name)
+            return file
+
+        for target, name, value in ((app.tempfile, 'NamedTemporaryFile', spool),
+                                    # Uploads are hashed as they are spooled, never in a second pass
+                                    (app, 'sha256_stream', Mock(side_effect=AssertionError("file was read again")))):
+            p = patch.object(target, name, value)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def post_file(self, path, content, **data):
+        data['file'] = (io.BytesIO(content), "doc.txt")
+        return self.client.post(path, data=data, content_type='multipart/form-data')
+
+    def test_upload_is_hashed_while_spooled(self):
+        content = f"{self.id()} upload".encode()
+        self.release_uploads.clear()
+        response = self.post_file('/upload', content)
+        self.assertEqual(response.status_code, 302)
+
+        # The claimed temp file goes to the upload queue under the hash computed while spooling
+        self.assertEqual(len(self.spooled), 1)
+        document = app.upload_queue.get(sha256(content))
+        self.assertEqual(document['status'], 'pending')
+        self.assertTrue(os.path.exists(self.spooled[0]))
+        self.assertEqual(app.batcher.pending[self.signer_id].size, len(content))
+
+        self.release_uploads.set()
+        self.assertTrue(app.upload_queue.wait(5))
+        self.assertEqual(self.uploaded, {self.spooled[0]: content})
+        self.assertFalse(os.path.exists(self.spooled[0]))
+
+    def test_verify_removes_its_spooled_upload(self):
+        content = f"{self.id()} verify".encode()
+        self.post_file('/upload', content)
+        block = app.batcher.flush_all()[0]
+
+        html = self.post_file('/verify', content).get_data(as_text=True)
+        self.assertIn(f"Block Index: {block.index}", html)
+        self.assertIn("Document not found", self.post_file('/verify', b"never uploaded").get_data(as_text=True))
+
+        # Nobody claims the files posted for verification, so closing the request removes them
+        self.assertEqual(len(self.spooled), 3)
+        self.assertFalse(any(os.path.exists(path) for path in self.spooled[1:]))
+
+    def test_unclaimed_uploads_are_removed(self):
+        response = self.client.post('/api/v1/documents:batch', data={
+            'signer_id': self.signer_id,
+            'hashes': "not hex",
+            'files': [(io.BytesIO(b"rejected"), "rejected.txt")],
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.spooled), 1)
+        self.assertFalse(os.path.exists(self.spooled[0]))
+        self.assertIsNone(app.upload_queue.get(sha256(b"rejected")))
+
+    def test_run_blocking_keeps_request_context(self):
+        def blocking():
+            return request.args['q'], session['signer_id'], threading.get_ident()
+
+        with app.app.test_request_context('/?q=value'):
+            session['signer_id'] = self.signer_id
+            value, signer_id, thread = asyncio.run(app.run_blocking(blocking))
+        self.assertEqual((value, signer_id), ('value', self.signer_id))
+        self.assertNotEqual(thread, threading.get_ident())
+
+
+if __name__ == "__main__":
+    unittest.main()
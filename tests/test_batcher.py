@@ -0,0 +1,83 @@
+import unittest
+import threading
+from crypto.hash_utils import sha256
+from blockchain.batcher import BlockBatcher
+from blockchain.merkle_tree import MerkleTree
+
+
+class TestBlockBatcher(unittest.TestCase):
+    def setUp(self):
+        self.sealed = []
+
+    # Record sealed batches and return a stand-in block
+    def seal(self, signer_id, documents, accumulator=None):
+        self.sealed.append((signer_id, list(documents)))
+        return len(self.sealed)
+
+    def test_seals_on_document_count(self):
+        batcher = BlockBatcher(self.seal, max_docs=3, max_bytes=10**9, max_delay_ms=None)
+        self.assertIsNone(batcher.add("alice", "a1"))
+        self.assertIsNone(batcher.add("alice", "a2"))
+        self.assertEqual(batcher.add("alice", "a3"), 1)
+        self.assertEqual(self.sealed, [("alice", ["a1", "a2", "a3"])])
+        self.assertEqual(batcher.pending_count("alice"), 0)
+
+    def test_seals_on_byte_size(self):
+        batcher = BlockBatcher(self.seal, max_docs=100, max_bytes=1000, max_delay_ms=None)
+        self.assertIsNone(batcher.add("alice", "a1", 600))
+        self.assertEqual(batcher.add("alice", "a2", 600), 1)
+        self.assertEqual(self.sealed, [("alice", ["a1", "a2"])])
+
+    def test_seals_after_delay(self):
+        done = threading.Event()
+
+        def seal(signer_id, documents, accumulator):
+            self.seal(signer_id, documents)
+            done.set()
+            return True
+
+        batcher = BlockBatcher(seal, max_docs=100, max_bytes=10**9, max_delay_ms=50)
+        batcher.add("alice", "a1")
+        batcher.add("alice", "a2")
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.sealed, [("alice", ["a1", "a2"])])
+        self.assertEqual(batcher.pending_count("alice"), 0)
+
+    def test_signers_are_batched_separately(self):
+        batcher = BlockBatcher(self.seal, max_docs=2, max_bytes=10**9, max_delay_ms=None)
+        batcher.add("alice", "a1")
+        batcher.add("bob", "b1")
+        self.assertEqual(batcher.pending_count("alice"), 1)
+        batcher.add("bob", "b2")
+        self.assertEqual(self.sealed, [("bob", ["b1", "b2"])])
+
+        self.assertEqual(batcher.flush_all(), [2])
+        self.assertEqual(self.sealed[-1], ("alice", ["a1"]))
+
+    def test_failed_seal_keeps_documents(self):
+        batcher = BlockBatcher(lambda signer_id, documents, accumulator: None, max_docs=2, max_bytes=10**9, max_delay_ms=None)
+        batcher.add("alice", "a1")
+        self.assertIsNone(batcher.add("alice", "a2"))
+        self.assertEqual(batcher.pending_count("alice"), 2)
+
+        batcher.seal = self.seal
+        self.assertEqual(batcher.flush("alice"), 1)
+        self.assertEqual(self.sealed, [("alice", ["a1", "a2"])])
+
+
+    def test_batches_accumulate_leaves(self):
+        roots = []
+
+        def seal(signer_id, documents, accumulator):
+            roots.append(accumulator.root)
+            return True
+
+        batcher = BlockBatcher(seal, max_docs=3, max_bytes=10**9, max_delay_ms=None, leaf=lambda document: document['hash'])
+        documents = [{'hash': sha256(f"doc{i}")} for i in range(3)]
+        for document in documents:
+            batcher.add("alice", document)
+        self.assertEqual(roots, [MerkleTree([document['hash'] for document in documents]).root])
+
+
+if __name__ == "__main__":
+    unittest.main()
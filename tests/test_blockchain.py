@@ -1,11 +1,30 @@
 import time
 import json
+import struct
 import unittest
 import os
-from blockchain.block import Block
-from blockchain.chain import Blockchain
+import shutil
+import tempfile
+import threading
+from unittest.mock import patch
+from blockchain.block import Block, HEADER_V1, HEADER_V2, HEADER_V3
+from blockchain.chain import Blockchain, verify_block_proof
 from crypto.hash_utils import sha256
-from blockchain.merkle_tree import MerkleTree, LEFT, RIGHT
+from blockchain.merkle_tree import MerkleTree, LEFT, RIGHT, get_root_from_multiproof, verify_multiproof
+from blockchain.merkle_builder import FlatTreeLevels, level_sizes, DIGEST_SIZE
+from blockchain.mmr import MerkleMountainRange, get_root_from_mmr_proof, verify_mmr_proof
+from blockchain.merkle_accumulator import MerkleAccumulator, combine as combine_pair
+from blockchain.merkle_proof import (
+    encode_proof, decode_proof, root_from_proof, verify_proof, encode_multiproof, decode_multiproof,
+    proof_to_base64, proof_from_base64, proof_to_cbor, proof_from_cbor, cbor2
+)
+from blockchain.builder import prepare_block, hash_file, hash_files, hash_files_parallel, collect_paths
+from tests.registry import use_temp_registry
+
+
+# Chain root that a block appended after these blocks commits to
+def chain_root_of(blocks):
+    return MerkleMountainRange(block.hash for block in blocks).root
 
 
 class TestMerkleTree(unittest.TestCase):
@@ -85,6 +104,294 @@ class TestMerkleTree(unittest.TestCase):
         missing = sha256("missing")
         self.assertFalse(self.mt.verify(missing))
 
+    def test_leaf_positions(self):
+        # Duplicated padding leaf keeps its first position
+        self.assertEqual([self.mt.get_leaf_index(leaf) for leaf in self.leaves], [0, 1, 2])
+        for missing in (sha256("missing"), "not a digest", None):
+            with self.assertRaises(ValueError):
+                self.mt.get_leaf_index(missing)
+
+        # Repeated leaves resolve to their first position in flat, list and accumulated trees
+        digests = [sha256(f"leaf{i % 5}") for i in range(13)]
+        strings = [f"leaf{i % 5}" for i in range(13)]
+        for tree, leaves in ((MerkleTree(digests), digests), (MerkleTree(strings), strings),
+                             (MerkleTree.from_accumulator(MerkleAccumulator(digests)), digests)):
+            self.assertEqual([tree.get_leaf_index(leaf) for leaf in leaves], [i % 5 for i in range(13)])
+
+    def test_proof_cache_is_bounded(self):
+        mt = MerkleTree([sha256(str(i)) for i in range(8)], proof_cache_size=2)
+        for i in range(4):
+            mt.generate_proof(sha256(str(i)), mt.leaves)
+        self.assertEqual(list(mt.proof_cache), [sha256("2"), sha256("3")])
+
+        # Cached proofs are returned unchanged and still reconstruct the root
+        first = mt.generate_proof(sha256("3"), mt.leaves)
+        second = mt.generate_proof(sha256("3"), mt.leaves)
+        self.assertEqual(first, second)
+        self.assertEqual(mt.get_root_from_merkle_proof(second), mt.root)
+
+    def test_proof_cache_is_shared_by_threads(self):
+        leaves = [sha256(str(i)) for i in range(64)]
+        mt = MerkleTree(leaves, proof_cache_size=4)
+        errors = []
+
+        def prove(offset):
+            try:
+                for i in range(500):
+                    leaf = leaves[(i * 7 + offset) % len(leaves)]
+                    self.assertEqual(mt.get_root_from_merkle_proof(mt.generate_proof(leaf, leaves)), mt.root)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=prove, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(mt.proof_cache), 4)
+
+    def test_verify_against_other_root(self):
+        self.assertTrue(self.mt.verify(self.leaf_a, self.mt.root))
+        self.assertFalse(self.mt.verify(self.leaf_a, sha256("other-root")))
+
+    def test_leaves_are_not_mutated(self):
+        leaves = [self.leaf_a, self.leaf_b, self.leaf_c]
+        mt = MerkleTree(leaves)
+        self.assertEqual(leaves, [self.leaf_a, self.leaf_b, self.leaf_c])
+        # Digest leaves are read back from the tree's buffer rather than kept as the caller's list
+        self.assertIsNot(mt.leaves, leaves)
+        self.assertEqual(mt.leaves, leaves)
+        self.assertEqual(list(mt.leaves), leaves)
+        self.assertEqual(mt.leaves[-1], self.leaf_c)
+        self.assertIn(self.leaf_b, mt.leaves)
+
+
+class TestFlatTreeLevels(unittest.TestCase):
+    # Reference implementation of the duplicate-last pairing rule
+    def reference_levels(self, leaves):
+        levels = []
+        current = list(leaves)
+        while len(current) > 1:
+            if len(current) % 2 != 0:
+                current.append(current[-1])
+            levels.append(current)
+            current = [sha256(current[i] + current[i + 1]) for i in range(0, len(current), 2)]
+        levels.append(current)
+        return levels
+
+    def test_matches_reference_levels(self):
+        for count in range(1, 18):
+            leaves = [sha256(str(i)) for i in range(count)]
+            flat = FlatTreeLevels(leaves)
+            expected = self.reference_levels(leaves)
+            self.assertEqual(flat.height, len(expected))
+            self.assertEqual([flat.level(level) for level in range(flat.height)], expected)
+            self.assertEqual(flat.root, expected[-1][0])
+
+    def test_level_sizes(self):
+        self.assertEqual(level_sizes(0), [])
+        self.assertEqual(level_sizes(1), [1])
+        self.assertEqual(level_sizes(3), [4, 2, 1])
+        self.assertEqual(level_sizes(5), [6, 4, 2, 1])
+
+    def test_buffer_uses_fixed_slots(self):
+        leaves = [sha256(str(i)) for i in range(5)]
+        flat = FlatTreeLevels(leaves)
+        self.assertEqual(len(flat.buffer), sum(level_sizes(5)) * DIGEST_SIZE)
+
+    def test_proofs_match_flat_layout(self):
+        leaves = [sha256(str(i)) for i in range(11)]
+        mt = MerkleTree(leaves)
+        self.assertIsInstance(mt.levels, FlatTreeLevels)
+        for leaf in leaves:
+            proof = mt.generate_proof(leaf, leaves)
+            self.assertEqual(mt.get_root_from_merkle_proof(proof), mt.root)
+
+
+class TestMerkleAccumulator(unittest.TestCase):
+    def test_matches_merkle_tree(self):
+        accumulator = MerkleAccumulator()
+        leaves = []
+        for count in range(1, 34):
+            leaf = sha256(f"leaf{count}")
+            accumulator.add(leaf)
+            leaves.append(leaf)
+
+            reference = MerkleTree(list(leaves))
+            self.assertEqual(accumulator.root, reference.root, count)
+            self.assertEqual(accumulator.height, reference.levels.height)
+            for level in range(reference.levels.height):
+                self.assertEqual(accumulator.level(level), reference.levels.level(level))
+
+    def test_proofs_match_merkle_tree(self):
+        leaves = [sha256(f"leaf{i}") for i in range(13)]
+        reference = MerkleTree(list(leaves))
+        tree = MerkleTree.from_accumulator(MerkleAccumulator(leaves))
+        self.assertEqual(tree.root, reference.root)
+        for leaf in leaves:
+            self.assertEqual(tree.generate_proof(leaf, tree.leaves), reference.generate_proof(leaf, leaves))
+            self.assertTrue(tree.verify(leaf, reference.root))
+
+    def test_string_leaves(self):
+        leaves = ["a", "b", "c", "d", "e"]
+        self.assertEqual(MerkleAccumulator(leaves).root, MerkleTree(list(leaves)).root)
+
+    def test_appends_hash_completed_pairs_once(self):
+        accumulator = MerkleAccumulator()
+        with patch("blockchain.merkle_accumulator.combine", wraps=combine_pair) as counted:
+            for i in range(64):
+                accumulator.add(sha256(f"leaf{i}"))
+        # A complete tree of 64 leaves has 63 internal nodes
+        self.assertEqual(counted.call_count, 63)
+
+    def test_empty(self):
+        accumulator = MerkleAccumulator()
+        self.assertIsNone(accumulator.root)
+        tree = MerkleTree.from_accumulator(accumulator)
+        self.assertIsNone(tree.root)
+        self.assertEqual(tree.leaves, [])
+
+
+class TestMultiproof(unittest.TestCase):
+    def test_multiproof_reconstructs_root(self):
+        for count in (1, 2, 3, 7, 8, 13):
+            leaves = [sha256(f"leaf{i}") for i in range(count)]
+            mt = MerkleTree(leaves)
+            for chosen in ([0], [count - 1], leaves[::2], leaves[1::3] or leaves, leaves):
+                if isinstance(chosen[0], int):
+                    chosen = [leaves[i] for i in chosen]
+                multiproof = mt.generate_multiproof(chosen)
+                self.assertEqual(get_root_from_multiproof(multiproof), mt.root)
+                self.assertTrue(verify_multiproof(multiproof, chosen, mt.root))
+
+    def test_multiproof_shares_siblings(self):
+        leaves = [sha256(f"leaf{i}") for i in range(16)]
+        mt = MerkleTree(leaves)
+        chosen = leaves[:8]
+        multiproof = mt.generate_multiproof(chosen)
+        # The first half of the tree is fully known, so only the right subtree root is needed
+        self.assertEqual(multiproof['siblings'], [mt.tree[3][1]])
+        self.assertEqual(mt.generate_multiproof(leaves)['siblings'], [])
+
+    def test_tampered_multiproof_fails(self):
+        leaves = [sha256(f"leaf{i}") for i in range(9)]
+        mt = MerkleTree(leaves)
+        multiproof = mt.generate_multiproof([leaves[1], leaves[4]])
+
+        tampered = dict(multiproof, leaves=[sha256("x"), multiproof['leaves'][1]])
+        self.assertFalse(verify_multiproof(tampered, [sha256("x")], mt.root))
+        self.assertIsNone(get_root_from_multiproof(dict(multiproof, siblings=multiproof['siblings'][:-1])))
+        self.assertIsNone(get_root_from_multiproof(dict(multiproof, siblings=multiproof['siblings'] + [sha256("x")])))
+        self.assertFalse(verify_multiproof(multiproof, [leaves[2]], mt.root))
+
+    def test_missing_leaf_raises(self):
+        mt = MerkleTree([sha256("a"), sha256("b")])
+        with self.assertRaises(ValueError):
+            mt.generate_multiproof([sha256("c")])
+
+    def test_compact_multiproof_round_trip(self):
+        leaves = [sha256(f"leaf{i}") for i in range(11)]
+        mt = MerkleTree(leaves)
+        multiproof = mt.generate_multiproof([leaves[0], leaves[5], leaves[10]])
+        decoded = decode_multiproof(encode_multiproof(multiproof))
+        self.assertEqual(decoded, multiproof)
+        self.assertEqual(get_root_from_multiproof(decoded), mt.root)
+
+
+class TestMerkleProofCodec(unittest.TestCase):
+    def setUp(self):
+        self.leaves = [sha256(f"leaf{i}") for i in range(11)]
+        self.mt = MerkleTree(self.leaves)
+
+    def test_round_trip(self):
+        for leaf in self.leaves:
+            proof = self.mt.generate_proof(leaf, self.leaves)
+            decoded = decode_proof(encode_proof(proof))
+            self.assertEqual(decoded, proof)
+            self.assertEqual(self.mt.get_root_from_merkle_proof(decoded), self.mt.root)
+
+    def test_root_from_compact_bytes(self):
+        for leaf in self.leaves:
+            data = encode_proof(self.mt.generate_proof(leaf, self.leaves))
+            self.assertEqual(root_from_proof(data), self.mt.root)
+            self.assertTrue(verify_proof(data, leaf, self.mt.root))
+            self.assertFalse(verify_proof(data, sha256("other"), self.mt.root))
+
+    def test_compact_proof_is_smaller(self):
+        proof = self.mt.generate_proof(self.leaves[0], self.leaves)
+        data = encode_proof(proof)
+        # Header, one bitmask byte and a slot per entry
+        self.assertEqual(len(data), 2 + 1 + DIGEST_SIZE * len(proof))
+        as_json = json.dumps([{'hash': p['hash'].hex(), 'direction': p['direction']} for p in proof])
+        self.assertLess(len(proof_to_base64(data)), len(as_json) / 2)
+
+    def test_base64_round_trip(self):
+        data = encode_proof(self.mt.generate_proof(self.leaves[3], self.leaves))
+        self.assertEqual(proof_from_base64(proof_to_base64(data)), data)
+
+    def test_rejects_malformed_proofs(self):
+        data = encode_proof(self.mt.generate_proof(self.leaves[3], self.leaves))
+        with self.assertRaises(ValueError):
+            decode_proof(data[:-1])
+        with self.assertRaises(ValueError):
+            decode_proof(b'\x09' + data[1:])
+        with self.assertRaises(ValueError):
+            encode_proof([{'hash': 'abc', 'direction': LEFT}])
+
+    @unittest.skipIf(cbor2 is None, "cbor2 is not installed")
+    def test_cbor_round_trip(self):
+        data = encode_proof(self.mt.generate_proof(self.leaves[5], self.leaves))
+        self.assertEqual(proof_from_cbor(proof_to_cbor(data)), data)
+
+
+class TestBuilder(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_dir, "nested"))
+        self.contents = {
+            "b.txt": b"second file",
+            "a.txt": b"first file" * 1000,
+            "empty.txt": b"",
+            os.path.join("nested", "c.txt"): b"nested file",
+        }
+        for name, data in self.contents.items():
+            with open(os.path.join(self.temp_dir, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_collect_paths_from_directory(self):
+        paths = collect_paths(self.temp_dir)
+        names = [os.path.relpath(path, self.temp_dir) for path in paths]
+        self.assertEqual(names, ["a.txt", "b.txt", "empty.txt", os.path.join("nested", "c.txt")])
+
+    def test_parallel_hashes_match_sequential(self):
+        paths = collect_paths(self.temp_dir)
+        expected = hash_files(paths)
+        self.assertEqual(hash_files_parallel(paths, workers=4), expected)
+        self.assertEqual(hash_files_parallel(self.temp_dir, workers=1), expected)
+        self.assertEqual(expected[2], sha256(b""))
+
+    def test_prepare_block_from_directory(self):
+        from crypto.key_manager import generate_keypair
+        use_temp_registry(self)
+        keys_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, keys_path)
+        private_key, public_key = generate_keypair(keys_path, "builder")
+        with patch('blockchain.chain.KEYS_PATH', keys_path):
+            blockchain = Blockchain()
+
+        latest = blockchain.get_latest_block()
+        block = prepare_block(self.temp_dir, latest.hash, latest.index + 1, "builder", private_key,
+                              chain_root=blockchain.get_chain_root())
+        expected_root = MerkleTree(hash_files(collect_paths(self.temp_dir))).root
+        self.assertEqual(block.merkle_root, expected_root)
+        self.assertTrue(block.verify_block_signature(public_key))
+        self.assertTrue(blockchain.add_block(block))
+        self.assertTrue(blockchain.verify_file_in_blockchain(hash_file(os.path.join(self.temp_dir, "b.txt")))[0])
+
 
 class TestBlock(unittest.TestCase):
     def setUp(self):
@@ -94,13 +401,8 @@ class TestBlock(unittest.TestCase):
         self.test_output_path = './tests/keys'
         os.makedirs(self.test_output_path, exist_ok=True)
         
-        # Backup existing key_registry.json if it exists
-        self.registry_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "key_registry.json")
-        if os.path.exists(self.registry_path):
-            with open(self.registry_path, 'r') as f:
-                self.original_registry = json.load(f)
-        else:
-            self.original_registry = {}
+        # Keep registered signers out of the working tree's registry
+        use_temp_registry(self)
             
         generate_keypair(output_path=self.test_output_path, signer_id=self.signer_id)
         self.priv_key = load_private_key('./tests/keys/private_key_test.pem')
@@ -112,13 +414,12 @@ class TestBlock(unittest.TestCase):
         self.test_file_hashes = [sha256("file1"), sha256("file2"), sha256("file3")]
         self.test_merkle_tree = MerkleTree(self.test_file_hashes)
         self.test_prev_hash = "def456"
+        self.test_chain_root = sha256("chain")
         # include private key in block creation
-        self.block = Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key)
+        self.block = Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key,
+                           chain_root=self.test_chain_root)
 
     def tearDown(self):
-        # Restore original key_registry.json
-        with open(self.registry_path, 'w') as f:
-            json.dump(self.original_registry, f, indent=4)
         # Clean up test keys
         for key_file in os.listdir(self.test_output_path):
             if (key_file.startswith("private_key_") or key_file.startswith("public_key_")) and \
@@ -146,22 +447,88 @@ class TestBlock(unittest.TestCase):
 
     def test_compute_hash_different_data(self):
         # Different block data should produce different hashes
-        block2 = Block(2, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key)
+        block2 = Block(2, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key,
+                       chain_root=self.test_chain_root)
         self.assertNotEqual(self.block.hash, block2.hash)
 
     def test_hash_matches_manual_computation(self):
-        # Verify hash computation matches expected SHA256 result
+        # Version 1 headers hash a JSON object of the fields
+        block = Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key, header_version=HEADER_V1)
         expected_data = {
             'index': self.test_index,
             'timestamp': self.test_timestamp,
-            'merkle_root': self.block.merkle_root.hex() if isinstance(self.block.merkle_root, bytes) else self.block.merkle_root,
+            'merkle_root': block.merkle_root.hex() if isinstance(block.merkle_root, bytes) else block.merkle_root,
             'prev_hash': self.test_prev_hash.hex() if isinstance(self.test_prev_hash, bytes) else self.test_prev_hash,
-            'signer_id': self.block.signer_id,
-            'signature': self.block.signature.hex() if isinstance(self.block.signature, bytes) else self.block.signature
+            'signer_id': block.signer_id,
+            'signature': block.signature.hex() if isinstance(block.signature, bytes) else block.signature
         }
         expected_serialized = json.dumps(expected_data)
         expected_hash = sha256(expected_serialized)
-        self.assertEqual(self.block.hash, expected_hash)
+        self.assertEqual(block.hash, expected_hash)
+        self.assertTrue(block.verify_block_signature(self.pub_key))
+
+    def test_binary_header_hash(self):
+        # Version 2 headers hash a fixed binary layout followed by the signature
+        block = Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key, header_version=HEADER_V2)
+        header = struct.pack('<Bqd', HEADER_V2, self.test_index, self.test_timestamp)
+        header += struct.pack('<BI', 2, len(block.merkle_root)) + block.merkle_root
+        # String fields carry their own tag, so "def456" never collides with its bytes
+        for value in (self.test_prev_hash, self.signer_id):
+            header += struct.pack('<BI', 3, len(value)) + value.encode('utf-8')
+
+        self.assertEqual(block.header_bytes(), header)
+        self.assertEqual(block.header_digest(), sha256(header))
+        signature = struct.pack('<BI', 2, len(block.signature)) + block.signature
+        self.assertEqual(block.hash, sha256(header + signature))
+        self.assertTrue(block.verify_block_signature(self.pub_key))
+
+    def test_chain_root_is_signed(self):
+        # Version 3 headers append the chain root to the version 2 layout
+        chain_root = self.test_chain_root
+        block = Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key, chain_root=chain_root)
+        header = struct.pack('<Bqd', HEADER_V3, self.test_index, self.test_timestamp)
+        header += struct.pack('<BI', 2, len(block.merkle_root)) + block.merkle_root
+        for value in (self.test_prev_hash, self.signer_id):
+            header += struct.pack('<BI', 3, len(value)) + value.encode('utf-8')
+        header += struct.pack('<BI', 2, len(chain_root)) + chain_root
+
+        self.assertEqual(block.header_version, HEADER_V3)
+        self.assertTrue(block.commits_chain)
+        self.assertEqual(block.header_bytes(), header)
+        self.assertTrue(block.verify_block_signature(self.pub_key))
+
+        # A different chain root breaks the signature
+        forged = Block.restore(block.index, block.timestamp, block.merkle_tree, block.prev_hash, block.signer_id,
+                               block.signature, None, chain_root=sha256("other"))
+        self.assertFalse(forged.verify_block_signature(self.pub_key))
+
+        # Older header versions have no room for a chain root
+        with self.assertRaises(ValueError):
+            Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key, header_version=HEADER_V2, chain_root=chain_root)
+        # and version 3 blocks after genesis must commit to the chain before them
+        with self.assertRaises(ValueError):
+            Block(self.test_index, self.test_timestamp, self.test_merkle_tree, self.test_prev_hash, self.signer_id, self.priv_key)
+
+    def test_hashes_are_computed_once(self):
+        restored = Block.restore(self.block.index, self.block.timestamp, self.block.merkle_tree, self.block.prev_hash,
+                                 self.block.signer_id, self.block.signature, self.block.hash, chain_root=self.test_chain_root)
+        with patch.object(Block, 'header_bytes', wraps=restored.header_bytes) as header_bytes:
+            self.assertEqual(restored.compute_hash(), self.block.hash)
+            self.assertEqual(restored.compute_hash(), self.block.hash)
+            self.assertTrue(restored.verify_block_signature(self.pub_key))
+            self.assertTrue(restored.verify_block_signature(self.pub_key))
+        self.assertEqual(header_bytes.call_count, 2)
+
+    def test_signed_fields_are_fixed(self):
+        restored = Block.restore(self.block.index, self.block.timestamp, self.block.merkle_tree, self.block.prev_hash,
+                                 self.block.signer_id, self.block.signature, self.block.hash, chain_root=self.test_chain_root)
+        for block in (self.block, restored, Block.from_header(restored, lambda: self.test_merkle_tree)):
+            for field, value in [('merkle_root', sha256("evil")), ('prev_hash', sha256("evil")), ('index', 7),
+                                 ('signature', b'forged'), ('hash', sha256("evil"))]:
+                with self.assertRaises(AttributeError):
+                    setattr(block, field, value)
+            self.assertEqual(block.merkle_root, self.test_merkle_tree.root)
+            self.assertTrue(block.verify_block_signature(self.pub_key))
 
     def test_sign_and_verify(self):
         # Verify that block.verify_block_signature works
@@ -214,13 +581,8 @@ class TestBlockchain(unittest.TestCase):
         os.makedirs(self.test_output_path, exist_ok=True)
         os.makedirs(self.main_keys_path, exist_ok=True)
         
-        # Backup existing key_registry.json if it exists
-        self.registry_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "key_registry.json")
-        if os.path.exists(self.registry_path):
-            with open(self.registry_path, 'r') as f:
-                self.original_registry = json.load(f)
-        else:
-            self.original_registry = {}
+        # Keep registered signers out of the working tree's registry
+        use_temp_registry(self)
             
         generate_keypair(output_path=self.test_output_path, signer_id=self.signer_id)
         self.blockchain = Blockchain()
@@ -232,9 +594,6 @@ class TestBlockchain(unittest.TestCase):
         self.test_merkle_tree = MerkleTree(self.test_file_hashes)
 
     def tearDown(self):
-        # Restore original key_registry.json
-        with open(self.registry_path, 'w') as f:
-            json.dump(self.original_registry, f, indent=4)
             
         # Clean up test keys in both directories
         for directory in [self.test_output_path, self.main_keys_path]:
@@ -258,7 +617,7 @@ class TestBlockchain(unittest.TestCase):
     def test_add_valid_block(self):
         latest = self.blockchain.get_latest_block()
         # Create new block with merkle tree
-        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key)
+        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
 
         result = self.blockchain.add_block(new_block)
         self.assertTrue(result)
@@ -267,7 +626,7 @@ class TestBlockchain(unittest.TestCase):
 
     def test_add_invalid_block(self):
         # Create invalid block with merkle tree but wrong prev_hash
-        invalid_block = Block(1, time.time(), self.test_merkle_tree, "wrong_hash", self.signer_id, self.priv_key)
+        invalid_block = Block(1, time.time(), self.test_merkle_tree, "wrong_hash", self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
         
         result = self.blockchain.add_block(invalid_block)
         self.assertFalse(result)
@@ -279,7 +638,7 @@ class TestBlockchain(unittest.TestCase):
 
         # Add valid block and test again
         latest = self.blockchain.get_latest_block()
-        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key)
+        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
         self.blockchain.add_block(new_block)
         self.assertTrue(self.blockchain.is_valid_chain(self.blockchain.chain))
 
@@ -287,6 +646,26 @@ class TestBlockchain(unittest.TestCase):
         self.assertFalse(self.blockchain.is_valid_chain([]))
         self.assertFalse(self.blockchain.is_valid_chain(None))
 
+    def test_unknown_signer_is_invalid(self):
+        from ecdsa import SigningKey, SECP256k1
+        latest = self.blockchain.get_latest_block()
+        stranger = Block(1, time.time(), self.test_merkle_tree, latest.hash, "stranger", SigningKey.generate(curve=SECP256k1), chain_root=self.blockchain.get_chain_root())
+        self.assertFalse(self.blockchain.add_block(stranger))
+        self.assertFalse(self.blockchain.is_valid_chain([latest, stranger]))
+
+        self.blockchain.validation_workers = 2
+        with patch("blockchain.chain.PARALLEL_MIN_BLOCKS", 1):
+            self.assertFalse(self.blockchain.is_valid_chain([latest, stranger]))
+        self.blockchain.shutdown_executor()
+
+    def test_new_chain_reuses_genesis_key(self):
+        from crypto.key_manager import get_public_key_from_id
+        genesis_key = get_public_key_from_id("genesis").to_string()
+        other = Blockchain()
+        self.assertEqual(get_public_key_from_id("genesis").to_string(), genesis_key)
+        self.assertTrue(self.blockchain.is_valid_chain(self.blockchain.chain))
+        self.assertTrue(other.is_valid_chain(other.chain))
+
     def test_resolve_forks(self):
         # Create longer valid chain
         longer_chain = [self.blockchain.chain[0]]
@@ -295,7 +674,7 @@ class TestBlockchain(unittest.TestCase):
         for i in range(1, 3):
             # Create merkle tree for each block
             block_merkle = MerkleTree([sha256(f"file{i}")])
-            block = Block(i, time.time(), block_merkle, prev_hash, self.signer_id, self.priv_key)
+            block = Block(i, time.time(), block_merkle, prev_hash, self.signer_id, self.priv_key, chain_root=chain_root_of(longer_chain))
             longer_chain.append(block)
             prev_hash = block.compute_hash()
 
@@ -316,7 +695,7 @@ class TestBlockchain(unittest.TestCase):
 
         # Add a block with test files
         latest = self.blockchain.get_latest_block()
-        new_block = Block(1, time.time(), test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key)
+        new_block = Block(1, time.time(), test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
         self.assertTrue(self.blockchain.add_block(new_block))  # Verify block was added successfully
         self.assertEqual(len(self.blockchain.chain), 2)  # Verify chain length
 
@@ -335,7 +714,7 @@ class TestBlockchain(unittest.TestCase):
     def test_get_file_proof(self):
         # Add a block with test files
         latest = self.blockchain.get_latest_block()
-        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key)
+        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
         self.blockchain.add_block(new_block)
 
         # Test getting proofs for files that exist
@@ -355,6 +734,204 @@ class TestBlockchain(unittest.TestCase):
         self.assertIsNone(proof)
         self.assertEqual(block_index, -1)
 
+    def test_get_file_proofs(self):
+        latest = self.blockchain.get_latest_block()
+        first = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
+        self.assertTrue(self.blockchain.add_block(first))
+        second = Block(2, time.time(), MerkleTree([sha256("other")]), first.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
+        self.assertTrue(self.blockchain.add_block(second))
+
+        missing = sha256("not_in_blockchain")
+        queried = self.test_file_hashes + [sha256("other"), missing]
+        results = self.blockchain.get_file_proofs(queried)
+        self.assertEqual(set(results), set(queried))
+
+        # Each result matches the single-hash lookup
+        for file_hash in queried:
+            self.assertEqual(results[file_hash], self.blockchain.get_file_proof(file_hash))
+        self.assertEqual(results[missing], (None, -1))
+        self.assertEqual(results[sha256("other")][1], 2)
+
+    def test_file_index_updated_on_add_block(self):
+        latest = self.blockchain.get_latest_block()
+        new_block = Block(1, time.time(), self.test_merkle_tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
+        self.assertTrue(self.blockchain.add_block(new_block))
+
+        for position, file_hash in enumerate([sha256("file1"), sha256("file2"), sha256("file3")]):
+            self.assertEqual(self.blockchain.file_index[file_hash], (1, position))
+
+        # A later block containing the same hash keeps the first occurrence
+        repeat_block = Block(2, time.time(), MerkleTree([self.test_file_hashes[0]]), new_block.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
+        self.assertTrue(self.blockchain.add_block(repeat_block))
+        self.assertEqual(self.blockchain.file_index[self.test_file_hashes[0]], (1, 0))
+
+    def test_file_index_updated_on_resolve_forks(self):
+        latest = self.blockchain.get_latest_block()
+        local_block = Block(1, time.time(), MerkleTree([sha256("local")]), latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
+        self.assertTrue(self.blockchain.add_block(local_block))
+
+        peer_chain = [self.blockchain.chain[0]]
+        for i in range(1, 3):
+            block = Block(i, time.time(), MerkleTree([sha256(f"peer{i}")]), peer_chain[-1].compute_hash(), self.signer_id, self.priv_key, chain_root=chain_root_of(peer_chain))
+            peer_chain.append(block)
+
+        self.assertTrue(self.blockchain.resolve_forks([peer_chain]))
+        self.assertNotIn(sha256("local"), self.blockchain.file_index)
+        self.assertEqual(self.blockchain.verify_file_in_blockchain(sha256("peer2")), (True, 2))
+        proof, block_index = self.blockchain.get_file_proof(sha256("peer1"))
+        self.assertEqual(block_index, 1)
+        self.assertEqual(proof[0]["hash"], sha256("peer1"))
+
+    # Append blocks with one leaf each to the test blockchain
+    def add_blocks(self, count, prefix="file"):
+        for i in range(count):
+            latest = self.blockchain.get_latest_block()
+            block = Block(latest.index + 1, time.time(), MerkleTree([sha256(f"{prefix}{i}")]), latest.compute_hash(), self.signer_id, self.priv_key, chain_root=self.blockchain.get_chain_root())
+            self.assertTrue(self.blockchain.add_block(block))
+
+    def test_checkpoint_limits_validation(self):
+        from crypto.key_manager import get_public_key_from_id
+        self.add_blocks(4)
+        self.assertTrue(self.blockchain.add_checkpoint(3))
+        self.assertEqual(self.blockchain.checkpoints, [(3, self.blockchain.chain[3].hash)])
+
+        with patch('blockchain.chain.get_public_key_from_id', wraps=get_public_key_from_id) as lookup:
+            self.assertTrue(self.blockchain.is_valid_chain(self.blockchain.chain))
+        # Only the block after the checkpoint has its signature checked
+        self.assertEqual(lookup.call_count, 1)
+
+        # Older checkpoints are ignored
+        self.assertFalse(self.blockchain.add_checkpoint(2))
+
+    def test_checkpoint_mismatch_rejects_chain(self):
+        self.add_blocks(2)
+        self.blockchain.add_checkpoint(2)
+
+        other_chain = [self.blockchain.chain[0], self.blockchain.chain[1]]
+        latest = other_chain[-1]
+        other_chain.append(Block(2, time.time(), MerkleTree([sha256("other")]), latest.compute_hash(), self.signer_id, self.priv_key, chain_root=chain_root_of(other_chain)))
+        self.assertFalse(self.blockchain.is_valid_chain(other_chain))
+
+    def test_automatic_checkpoints(self):
+        blockchain = Blockchain(checkpoint_interval=2)
+        self.blockchain = blockchain
+        self.add_blocks(5)
+        self.assertEqual([position for position, _ in blockchain.checkpoints], [2, 4])
+
+    def test_resolve_forks_checks_only_divergent_blocks(self):
+        from crypto.key_manager import get_public_key_from_id
+        self.add_blocks(3)
+
+        peer_chain = list(self.blockchain.chain)
+        for i in range(2):
+            latest = peer_chain[-1]
+            peer_chain.append(Block(latest.index + 1, time.time(), MerkleTree([sha256(f"peer{i}")]), latest.compute_hash(), self.signer_id, self.priv_key, chain_root=chain_root_of(peer_chain)))
+
+        with patch('blockchain.chain.get_public_key_from_id', wraps=get_public_key_from_id) as lookup:
+            self.assertTrue(self.blockchain.resolve_forks([peer_chain]))
+        self.assertEqual(lookup.call_count, 2)
+        self.assertEqual(len(self.blockchain.chain), 6)
+
+    @patch('blockchain.chain.PARALLEL_MIN_BLOCKS', 1)
+    def test_parallel_validation(self):
+        from ecdsa import SigningKey, SECP256k1
+        blockchain = Blockchain(validation_workers=2)
+        self.blockchain = blockchain
+        self.add_blocks(3)
+        try:
+            self.assertTrue(blockchain.is_valid_chain(blockchain.chain))
+
+            # A block signed with a key that does not belong to its signer is rejected
+            forged_chain = list(blockchain.chain)
+            latest = forged_chain[-1]
+            other_key = SigningKey.generate(curve=SECP256k1)
+            forged_chain.append(Block(latest.index + 1, time.time(), MerkleTree([sha256("forged")]), latest.compute_hash(), self.signer_id, other_key, chain_root=chain_root_of(forged_chain)))
+            self.assertFalse(blockchain.is_valid_chain(forged_chain))
+            self.assertFalse(blockchain.resolve_forks([forged_chain]))
+        finally:
+            blockchain.shutdown_executor()
+
+    def test_resolve_forks_rejects_rewriting_checkpoint(self):
+        self.add_blocks(2, prefix="local")
+        self.blockchain.add_checkpoint()
+
+        peer_chain = [self.blockchain.chain[0]]
+        for i in range(1, 5):
+            latest = peer_chain[-1]
+            peer_chain.append(Block(i, time.time(), MerkleTree([sha256(f"peer{i}")]), latest.compute_hash(), self.signer_id, self.priv_key, chain_root=chain_root_of(peer_chain)))
+
+        self.assertFalse(self.blockchain.resolve_forks([peer_chain]))
+        self.assertEqual(len(self.blockchain.chain), 3)
+
+    def test_block_proofs_against_signed_tip(self):
+        self.add_blocks(6)
+        tip = self.blockchain.get_latest_block()
+        for position, block in enumerate(self.blockchain.chain[:-1]):
+            proof = self.blockchain.get_block_proof(position)
+            self.assertTrue(verify_block_proof(proof, block.hash, tip))
+            self.assertFalse(verify_block_proof(proof, sha256("forged"), tip))
+
+        # Proofs against an earlier tip verify with that tip's signed root
+        earlier_tip = self.blockchain.chain[4]
+        proof = self.blockchain.get_block_proof(2, tip=4)
+        self.assertTrue(verify_block_proof(proof, self.blockchain.chain[2].hash, earlier_tip))
+        self.assertFalse(verify_block_proof(proof, self.blockchain.chain[2].hash, tip))
+
+        # A tip that does not commit to a chain root proves nothing
+        self.assertFalse(verify_block_proof(proof, self.blockchain.chain[2].hash, self.blockchain.chain[0]))
+
+    def test_rejects_wrong_chain_root(self):
+        latest = self.blockchain.get_latest_block()
+        block = Block(1, time.time(), self.test_merkle_tree, latest.hash, self.signer_id, self.priv_key, chain_root=sha256("wrong"))
+        self.assertFalse(self.blockchain.add_block(block))
+        self.assertFalse(self.blockchain.is_valid_chain([latest, block]))
+
+        # Blocks with older headers carry no chain root and are still accepted
+        legacy = Block(1, time.time(), self.test_merkle_tree, latest.hash, self.signer_id, self.priv_key, header_version=HEADER_V2)
+        self.assertTrue(self.blockchain.add_block(legacy))
+
+    def test_chain_root_follows_resolve_forks(self):
+        self.add_blocks(2, prefix="local")
+        peer_chain = list(self.blockchain.chain[:2])
+        for i in range(2, 6):
+            latest = peer_chain[-1]
+            peer_chain.append(Block(i, time.time(), MerkleTree([sha256(f"peer{i}")]), latest.compute_hash(), self.signer_id, self.priv_key, chain_root=chain_root_of(peer_chain)))
+
+        self.assertTrue(self.blockchain.resolve_forks([peer_chain]))
+        expected = MerkleMountainRange(block.hash for block in peer_chain)
+        self.assertEqual(self.blockchain.get_chain_root(), expected.root)
+
+
+class TestMerkleMountainRange(unittest.TestCase):
+    def test_proofs_for_every_size(self):
+        for count in range(1, 40):
+            leaves = [sha256(f"block{i}") for i in range(count)]
+            mmr = MerkleMountainRange(leaves)
+            self.assertEqual(len(mmr.peaks()), bin(count).count("1"))
+            for position, leaf in enumerate(leaves):
+                proof = mmr.generate_proof(position)
+                self.assertTrue(verify_mmr_proof(proof, leaf, mmr.root))
+                # Siblings within the mountain plus one peak per mountain
+                self.assertLessEqual(len(proof['siblings']) + len(proof['peaks']), 2 * count.bit_length())
+
+    def test_truncate_matches_rebuild(self):
+        leaves = [sha256(f"block{i}") for i in range(23)]
+        mmr = MerkleMountainRange(leaves)
+        for count in (22, 16, 9, 1):
+            mmr.truncate(count)
+            self.assertEqual(mmr.root, MerkleMountainRange(leaves[:count]).root)
+        self.assertIsNone(MerkleMountainRange().root)
+
+    def test_rejects_malformed_proofs(self):
+        leaves = [sha256(f"block{i}") for i in range(11)]
+        mmr = MerkleMountainRange(leaves)
+        proof = mmr.generate_proof(4)
+        self.assertIsNone(get_root_from_mmr_proof(dict(proof, siblings=proof['siblings'][:-1]), leaves[4]))
+        self.assertIsNone(get_root_from_mmr_proof(dict(proof, position=11), leaves[4]))
+        self.assertFalse(verify_mmr_proof(dict(proof, position=5), leaves[4], mmr.root))
+        with self.assertRaises(IndexError):
+            mmr.generate_proof(11)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
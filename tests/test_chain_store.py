@@ -0,0 +1,470 @@
+import time
+import json
+import struct
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from unittest.mock import patch
+from blockchain.block import Block
+from blockchain.chain import Blockchain
+from crypto.hash_utils import sha256
+from blockchain.mmr import node_count
+from blockchain.merkle_tree import MerkleTree
+from storage.chain_store import ChainStore, ChainStoreError, INDEX_FILE, FILE_INDEX_FILE, FILE_ENTRY, MMR_FILE, HEADER, encode_block, decode_block, decode_header
+from blockchain.block import HEADER_V1, HEADER_V2, HEADER_V3
+from tests.registry import use_temp_registry
+from tests.test_blockchain import chain_root_of
+
+
+class TestChainStore(unittest.TestCase):
+    def setUp(self):
+        from crypto.key_manager import generate_keypair, get_private_key_from_id
+        self.signer_id = 'test'
+        self.test_output_path = './tests/keys'
+        self.main_keys_path = './keys'
+        os.makedirs(self.test_output_path, exist_ok=True)
+
+        # Keep registered signers out of the working tree's registry
+        use_temp_registry(self)
+
+        generate_keypair(output_path=self.test_output_path, signer_id=self.signer_id)
+        self.priv_key = get_private_key_from_id(self.signer_id)
+        self.store_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.store_path)
+
+        # Clean up test keys in both directories
+        for directory in [self.test_output_path, self.main_keys_path]:
+            if os.path.exists(directory):
+                for key_file in os.listdir(directory):
+                    if (key_file.startswith("private_key_") or key_file.startswith("public_key_")) and \
+                       (key_file.endswith("genesis.pem") or key_file.endswith("test.pem")):
+                        os.remove(os.path.join(directory, key_file))
+
+    # Append blocks with one leaf each to a blockchain
+    def add_blocks(self, blockchain, count, prefix="file"):
+        for i in range(count):
+            latest = blockchain.get_latest_block()
+            tree = MerkleTree([sha256(f"{prefix}{latest.index + 1}-{i}")])
+            block = Block(latest.index + 1, time.time(), tree, latest.compute_hash(), self.signer_id, self.priv_key, chain_root=blockchain.get_chain_root())
+            self.assertTrue(blockchain.add_block(block))
+
+    def test_encode_decode_round_trip(self):
+        tree = MerkleTree([sha256("a"), sha256("b"), sha256("c")])
+        block = Block(1, time.time(), tree, sha256("prev"), self.signer_id, self.priv_key, chain_root=sha256("chain"))
+        restored = decode_block(encode_block(block))
+
+        self.assertEqual(restored.index, block.index)
+        self.assertEqual(restored.timestamp, block.timestamp)
+        self.assertEqual(restored.merkle_root, block.merkle_root)
+        self.assertEqual(restored.prev_hash, block.prev_hash)
+        self.assertEqual(restored.signer_id, block.signer_id)
+        self.assertEqual(restored.signature, block.signature)
+        self.assertEqual(restored.hash, block.hash)
+        self.assertEqual(restored.chain_root, block.chain_root)
+        self.assertEqual(restored.compute_hash(), block.hash)
+
+    def test_header_version_is_persisted(self):
+        tree = MerkleTree([sha256("a"), sha256("b")])
+        for header_version in (HEADER_V1, HEADER_V2, HEADER_V3):
+            chain_root = sha256("chain") if header_version == HEADER_V3 else None
+            block = Block(1, time.time(), tree, sha256("prev"), self.signer_id, self.priv_key, header_version=header_version, chain_root=chain_root)
+            restored = decode_block(encode_block(block))
+            self.assertEqual(restored.header_version, header_version)
+            self.assertEqual(restored.chain_root, chain_root)
+            self.assertEqual(restored.compute_hash(), block.hash)
+
+    # Rewrite a current record in an older record version, dropping the fields it did not hold
+    def legacy_record(self, block, version):
+        payload = encode_block(block)
+        # The chain root sits just before the leaf count and the block's single leaf
+        tail = struct.calcsize('<IH') + len(block.merkle_tree.leaves[0])
+        body = payload[HEADER.size:-tail - 1] + payload[-tail:]
+        if version == 1:
+            body = body[1:]
+        return bytes([version]) + payload[1:HEADER.size] + body
+
+    def test_reads_version_1_records(self):
+        # Records written before header versions were stored hold JSON headers
+        block = Block(1, time.time(), MerkleTree([sha256("a")]), sha256("prev"), self.signer_id, self.priv_key, header_version=HEADER_V1)
+        restored = decode_block(self.legacy_record(block, 1))
+        self.assertEqual(restored.header_version, HEADER_V1)
+        self.assertEqual(restored.compute_hash(), block.hash)
+
+    def test_reads_version_2_records(self):
+        # Records written before chain roots were stored hold version 1 or 2 headers
+        block = Block(1, time.time(), MerkleTree([sha256("a")]), sha256("prev"), self.signer_id, self.priv_key, header_version=HEADER_V2)
+        restored = decode_block(self.legacy_record(block, 2))
+        self.assertEqual(restored.header_version, HEADER_V2)
+        self.assertIsNone(restored.chain_root)
+        self.assertEqual(restored.compute_hash(), block.hash)
+
+    def test_reopen_restores_chain_without_new_genesis(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 3)
+        hashes = [block.hash for block in blockchain.chain]
+        chain_root = blockchain.get_chain_root()
+        store.close()
+
+        reopened = Blockchain(store=ChainStore(self.store_path))
+        self.assertEqual(len(reopened.chain), 4)
+        # The block hash MMR is read back from the store
+        self.assertEqual(reopened.get_chain_root(), chain_root)
+        self.assertEqual([block.hash for block in reopened.chain], hashes)
+        self.assertEqual(reopened.chain[0].prev_hash, 0)
+        self.assertTrue(reopened.is_valid_chain(reopened.chain))
+
+        # The file index is loaded from the store's persisted copy
+        exists, block_index = reopened.verify_file_in_blockchain(sha256("file2-1"))
+        self.assertTrue(exists)
+        self.assertEqual(block_index, 2)
+        reopened.store.close()
+
+    def test_blocks_load_trees_lazily(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 4)
+        store.close()
+
+        store = ChainStore(self.store_path, tree_cache_size=2)
+        reopened = Blockchain(store=store)
+        self.assertTrue(reopened.is_valid_chain(reopened.chain))
+        self.assertFalse(any(block.has_tree for block in reopened.chain))
+        self.assertEqual(len(store.trees), 0)
+
+        # Proofs load trees on demand, keeping only the most recently used ones
+        for position in range(1, 5):
+            proof, block_index = reopened.get_file_proof(sha256(f"file{position}-{position - 1}"))
+            self.assertEqual(block_index, position)
+            block = reopened.chain[block_index]
+            self.assertEqual(block.merkle_tree.get_root_from_merkle_proof(proof), block.merkle_root)
+        self.assertEqual(list(store.trees), [3, 4])
+        store.close()
+
+    def test_headers_have_no_instance_dict(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 1)
+        header = decode_header(store.payload(1))
+        self.assertFalse(hasattr(header, '__dict__'))
+        self.assertFalse(hasattr(store[1], '__dict__'))
+        self.assertEqual(header.hash, blockchain.chain[1].hash)
+        self.assertEqual(header.compute_hash(), header.hash)
+        store.close()
+
+    def test_segments_rotate(self):
+        store = ChainStore(self.store_path, segment_size=512)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 5)
+        self.assertGreater(len(store.segment_numbers()), 1)
+        hashes = [block.hash for block in blockchain.chain]
+        store.close()
+
+        reopened = ChainStore(self.store_path, segment_size=512)
+        self.assertEqual([block.hash for block in reopened], hashes)
+        reopened.close()
+
+    def test_concurrent_reads_while_appending(self):
+        # Tiny caches send every read to the segment maps, which the appends keep growing and rotating
+        store = ChainStore(self.store_path, segment_size=2048, cache_size=1, tree_cache_size=1)
+        blockchain = Blockchain(store=store)
+        done = threading.Event()
+        errors = []
+
+        def read():
+            try:
+                while not done.is_set():
+                    for position in range(len(store)):
+                        self.assertEqual(store[position].index, position)
+                        store.get_tree(position)
+            except Exception as error:
+                errors.append(error)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        try:
+            self.add_blocks(blockchain, 40)
+        finally:
+            done.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(errors, [])
+        self.assertGreater(len(store.segment_numbers()), 1)
+        store.close()
+
+    def test_recovers_from_torn_write(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 2)
+        store.close()
+
+        with open(store.segment_path(store.segment), 'ab') as f:
+            f.write(b'\x40\x00\x00\x00partial')
+
+        reopened = ChainStore(self.store_path)
+        self.assertEqual(len(reopened), 3)
+        blockchain = Blockchain(store=reopened)
+        self.add_blocks(blockchain, 1)
+        self.assertEqual(len(blockchain.chain), 4)
+        reopened.close()
+
+    def test_rejected_block_leaves_store_unchanged(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 1)
+        latest = blockchain.get_latest_block()
+        short_leaves = MerkleTree([sha256("short")[:16], sha256("leaves")[:16]])
+        block = Block(latest.index + 1, time.time(), short_leaves, latest.hash, self.signer_id, self.priv_key,
+                      chain_root=blockchain.get_chain_root())
+        with self.assertRaises(ChainStoreError):
+            encode_block(block)
+        with self.assertRaises(ChainStoreError):
+            store.append(block)
+        self.assertEqual(len(store), 2)
+        store.close()
+
+        # Nothing of the rejected block was written, so the store reopens and keeps growing
+        reopened = Blockchain(store=ChainStore(self.store_path))
+        self.assertEqual(len(reopened.chain), 2)
+        self.add_blocks(reopened, 1)
+        self.assertTrue(reopened.is_valid_chain(reopened.chain))
+        reopened.store.close()
+
+    def test_rebuilds_lost_index_entries(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 3)
+        hashes = [block.hash for block in blockchain.chain]
+        store.close()
+
+        # Simulate index writes that never reached the disk
+        with open(os.path.join(self.store_path, INDEX_FILE), 'r+b') as f:
+            f.truncate(12)
+
+        reopened = ChainStore(self.store_path)
+        self.assertEqual([block.hash for block in reopened], hashes)
+        reopened.close()
+
+    def test_file_index_is_persisted(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 4)
+        file_index = dict(blockchain.file_index)
+        store.close()
+
+        # Reopening reads the file index without decoding any block records
+        store = ChainStore(self.store_path)
+        with patch.object(store, 'get_leaves', side_effect=AssertionError("records were read")):
+            self.assertEqual(Blockchain(store=store).file_index, file_index)
+        store.close()
+
+    def test_recovers_file_index(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 3)
+        file_index = dict(blockchain.file_index)
+        store.close()
+        path = os.path.join(self.store_path, FILE_INDEX_FILE)
+
+        # Entries for a block that was never indexed, a torn last entry, and a store from before
+        # the file index existed all end up with the same index
+        def unindexed_block(path):
+            with open(path, 'ab') as f:
+                f.write(FILE_ENTRY.pack(sha256("unindexed"), 4, 0))
+
+        def torn_entry(path):
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - FILE_ENTRY.size // 2)
+
+        for damage in (unindexed_block, torn_entry, os.remove):
+            damage(path)
+            store = ChainStore(self.store_path)
+            self.assertEqual(os.path.getsize(path), 3 * FILE_ENTRY.size)
+            self.assertEqual(Blockchain(store=store).file_index, file_index)
+            store.close()
+
+    def test_mmr_is_persisted(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 5)
+        nodes = blockchain.mmr.nodes
+        chain_root = blockchain.get_chain_root()
+        store.close()
+
+        # Reopening reads the MMR without decoding any block headers
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        with patch('storage.chain_store.decode_header', side_effect=AssertionError("headers were decoded")):
+            self.assertEqual(blockchain.mmr.nodes, nodes)
+            self.assertEqual(blockchain.get_chain_root(), chain_root)
+        self.add_blocks(blockchain, 2)
+        self.assertEqual(os.path.getsize(os.path.join(self.store_path, MMR_FILE)), node_count(8) * 32)
+        store.close()
+
+    def test_recovers_mmr(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 4)
+        chain_root = blockchain.get_chain_root()
+        store.close()
+        path = os.path.join(self.store_path, MMR_FILE)
+
+        # Nodes for a block that was never indexed, a torn last block, and a store from before
+        # the MMR file existed all end up with the same range
+        def unindexed_block(path):
+            with open(path, 'ab') as f:
+                f.write(sha256("unindexed") * 3)
+
+        def torn_block(path):
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - 40)
+
+        for damage in (unindexed_block, torn_block, os.remove):
+            damage(path)
+            store = ChainStore(self.store_path)
+            self.assertEqual(os.path.getsize(path), node_count(5) * 32)
+            self.assertEqual(Blockchain(store=store).get_chain_root(), chain_root)
+            store.close()
+
+    def test_checkpoints_are_persisted(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store, checkpoint_interval=2)
+        self.add_blocks(blockchain, 3)
+        checkpoints = list(blockchain.checkpoints)
+        self.assertEqual([position for position, _ in checkpoints], [2])
+        store.close()
+
+        reopened = Blockchain(store=ChainStore(self.store_path))
+        self.assertEqual(reopened.checkpoints, checkpoints)
+        self.assertTrue(reopened.is_valid_chain(reopened.chain))
+        reopened.store.close()
+
+    def test_resolve_forks_rewrites_store(self):
+        store = ChainStore(self.store_path)
+        blockchain = Blockchain(store=store)
+        self.add_blocks(blockchain, 1, prefix="local")
+
+        peer_chain = [blockchain.chain[0]]
+        for i in range(1, 4):
+            block = Block(i, time.time(), MerkleTree([sha256(f"peer{i}")]), peer_chain[-1].compute_hash(), self.signer_id, self.priv_key, chain_root=chain_root_of(peer_chain))
+            peer_chain.append(block)
+
+        self.assertTrue(blockchain.resolve_forks([peer_chain]))
+        store.close()
+
+        reopened = Blockchain(store=ChainStore(self.store_path))
+        self.assertEqual([block.hash for block in reopened.chain], [block.hash for block in peer_chain])
+        self.assertEqual(reopened.get_chain_root(), chain_root_of(peer_chain))
+        self.assertFalse(reopened.verify_file_in_blockchain(sha256("local1-0"))[0])
+        self.assertTrue(reopened.verify_file_in_blockchain(sha256("peer3"))[0])
+        reopened.store.close()
+
+    def test_refresh_picks_up_appends_from_another_store(self):
+        store = ChainStore(self.store_path)
+        with store.writer():
+            writer = Blockchain(store=store)
+        reader = Blockchain(store=ChainStore(self.store_path))
+        self.assertEqual(len(reader.chain), 1)
+        self.assertIsNone(reader.store.refresh())
+        reader.mmr
+        reader.file_index
+
+        with writer.exclusive():
+            self.add_blocks(writer, 2)
+        self.assertTrue(reader.refresh())
+        self.assertEqual([block.hash for block in reader.chain], [block.hash for block in writer.chain])
+        self.assertEqual(reader.get_chain_root(), writer.get_chain_root())
+        self.assertTrue(reader.verify_file_in_blockchain(sha256("file2-1"))[0])
+        self.assertFalse(reader.refresh())
+
+        # A block added by the reader lands after the writer's blocks
+        with reader.exclusive():
+            self.add_blocks(reader, 1, prefix="reader")
+        writer.refresh()
+        self.assertEqual(len(writer.chain), 4)
+        self.assertTrue(writer.verify_file_in_blockchain(sha256("reader3-0"))[0])
+        writer.store.close()
+        reader.store.close()
+
+    def test_refresh_reloads_after_truncation_elsewhere(self):
+        writer = Blockchain(store=ChainStore(self.store_path))
+        self.add_blocks(writer, 3)
+        writer.store.sync()
+        reader = Blockchain(store=ChainStore(self.store_path))
+        self.assertTrue(reader.verify_file_in_blockchain(sha256("file3-2"))[0])
+        reader.get_chain_root()
+
+        peer_chain = list(writer.chain[:2])
+        for i in range(2, 5):
+            block = Block(i, time.time(), MerkleTree([sha256(f"peer{i}")]), peer_chain[-1].hash, self.signer_id, self.priv_key, chain_root=chain_root_of(peer_chain))
+            peer_chain.append(block)
+        self.assertTrue(writer.resolve_forks([peer_chain]))
+
+        self.assertTrue(reader.refresh())
+        self.assertEqual([block.hash for block in reader.chain], [block.hash for block in peer_chain])
+        self.assertFalse(reader.verify_file_in_blockchain(sha256("file3-2"))[0])
+        self.assertTrue(reader.verify_file_in_blockchain(sha256("peer4"))[0])
+        self.assertEqual(reader.get_chain_root(), writer.get_chain_root())
+        writer.store.close()
+        reader.store.close()
+
+    def test_seal_waits_for_refresh_to_catch_up(self):
+        writer = Blockchain(store=ChainStore(self.store_path))
+        writer.store.sync()
+        reader = Blockchain(store=ChainStore(self.store_path))
+        reader.get_chain_root()
+        self.add_blocks(writer, 1)
+        writer.store.sync()
+
+        # Pause a refreshing thread just after the store has picked up the writer's block
+        paused = threading.Event()
+        release = threading.Event()
+        store_refresh = reader.store.refresh
+
+        def paused_refresh():
+            first = store_refresh()
+            if threading.current_thread().name == "refresher":
+                paused.set()
+                release.wait(5)
+            return first
+
+        results = []
+
+        def seal():
+            with reader.exclusive():
+                latest = reader.get_latest_block()
+                tree = MerkleTree([sha256("sealed")])
+                results.append(reader.add_block(Block(latest.index + 1, time.time(), tree, latest.hash,
+                                                      self.signer_id, self.priv_key, chain_root=reader.get_chain_root())))
+
+        with patch.object(reader.store, 'refresh', paused_refresh):
+            refresher = threading.Thread(target=reader.refresh, name="refresher")
+            refresher.start()
+            self.assertTrue(paused.wait(5))
+            sealer = threading.Thread(target=seal)
+            sealer.start()
+            # Give the sealing thread time to run into the refresh
+            sealer.join(0.2)
+            release.set()
+            refresher.join()
+            sealer.join()
+
+        self.assertEqual(results, [True])
+        self.assertEqual(reader.get_chain_root(), chain_root_of(reader.chain))
+        writer.store.close()
+        reader.store.close()
+
+        reopened = Blockchain(store=ChainStore(self.store_path))
+        self.assertEqual(len(reopened.chain), 3)
+        self.assertTrue(reopened.is_valid_chain(reopened.chain))
+        reopened.store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,22 @@
 import unittest
 import os
 import json
-from crypto.hash_utils import sha256
+import sqlite3
+import tempfile
+import shutil
+import threading
+from unittest.mock import patch
+from crypto import key_manager
+import io
+from crypto.hash_utils import sha256, sha256_stream, sha256_file, HashingFile
+from tests.registry import use_temp_registry
 from crypto.key_manager import (
     generate_keypair,
     load_private_key,
     load_public_key,
     get_public_key_from_id,
-    get_private_key_from_id
+    get_private_key_from_id,
+    precompute_public_key
 )
 from crypto.signer import sign_digest, verify_signature
 
@@ -40,6 +49,38 @@ class TestHashUtils(unittest.TestCase):
         result2 = sha256("world")
         self.assertNotEqual(result1, result2)
 
+    def test_sha256_stream_matches_sha256(self):
+        # Sizes around the chunk boundary hash the same as the whole buffer
+        for size in [0, 1, 7, 8, 9, 100]:
+            data = os.urandom(size)
+            self.assertEqual(sha256_stream(io.BytesIO(data), chunk_size=8), sha256(data))
+
+    def test_sha256_stream_copies_to_sink(self):
+        data = os.urandom(50)
+        sink = io.BytesIO()
+        digest = sha256_stream(io.BytesIO(data), sink, chunk_size=16)
+        self.assertEqual(sink.getvalue(), data)
+        self.assertEqual(digest, sha256(data))
+
+    def test_sha256_file(self):
+        data = os.urandom(1000)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        try:
+            self.assertEqual(sha256_file(f.name, chunk_size=64), sha256(data))
+        finally:
+            os.remove(f.name)
+
+    def test_hashing_file_hashes_writes(self):
+        data = os.urandom(100)
+        file = HashingFile(io.BytesIO())
+        file.write(data[:30])
+        file.write(data[30:])
+        self.assertEqual(file.digest(), sha256(data))
+        self.assertEqual(file.size, 100)
+        file.seek(0)
+        self.assertEqual(file.read(), data)
+
 
 class TestKeyManager(unittest.TestCase):
     def setUp(self):
@@ -47,18 +88,10 @@ class TestKeyManager(unittest.TestCase):
         self.test_signer_id = "test_key_manager"
         # Ensure test directory exists
         os.makedirs(self.test_output_path, exist_ok=True)
-        # Backup existing key_registry.json if it exists
-        self.registry_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "key_registry.json")
-        if os.path.exists(self.registry_path):
-            with open(self.registry_path, 'r') as f:
-                self.original_registry = json.load(f)
-        else:
-            self.original_registry = {}
+        # Keep registered signers out of the working tree's registry
+        use_temp_registry(self)
 
     def tearDown(self):
-        # Restore original key_registry.json
-        with open(self.registry_path, 'w') as f:
-            json.dump(self.original_registry, f, indent=4)
         # Clean up test keys
         for key_file in os.listdir(self.test_output_path):
             if key_file.startswith("private_key_") or key_file.startswith("public_key_"):
@@ -99,12 +132,136 @@ class TestKeyManager(unittest.TestCase):
         loaded_private = get_private_key_from_id(self.test_signer_id)
         self.assertIsNotNone(loaded_private)
 
+    def test_key_cache_reuses_loaded_keys(self):
+        private_key, public_key = generate_keypair(self.test_output_path, self.test_signer_id)
+
+        self.assertIs(get_public_key_from_id(self.test_signer_id), get_public_key_from_id(self.test_signer_id))
+        self.assertIs(get_private_key_from_id(self.test_signer_id), get_private_key_from_id(self.test_signer_id))
+        self.assertEqual(get_public_key_from_id(self.test_signer_id).to_string(), public_key.to_string())
+
+        # Regenerating the keypair replaces the cached keys
+        _, new_public_key = generate_keypair(self.test_output_path, self.test_signer_id, replace=True)
+        self.assertEqual(get_public_key_from_id(self.test_signer_id).to_string(), new_public_key.to_string())
+
+    def test_registered_signer_is_not_replaced(self):
+        _, public_key = generate_keypair(self.test_output_path, self.test_signer_id)
+        with self.assertRaises(ValueError):
+            generate_keypair(self.test_output_path, self.test_signer_id)
+        self.assertEqual(get_public_key_from_id(self.test_signer_id).to_string(), public_key.to_string())
+        self.assertEqual(
+            load_public_key(os.path.join(self.test_output_path, f"public_key_{self.test_signer_id}.pem")).to_string(),
+            public_key.to_string()
+        )
+
+    def test_key_cache_follows_registry_changes(self):
+        generate_keypair(self.test_output_path, self.test_signer_id)
+        get_public_key_from_id(self.test_signer_id)
+
+        # Another connection changing the registry invalidates the cache
+        connection = sqlite3.connect(key_manager.KEY_REGISTRY_DB_PATH)
+        with connection:
+            connection.execute("DELETE FROM signers WHERE signer_id = ?", (self.test_signer_id,))
+        connection.close()
+        with self.assertRaises(KeyError):
+            get_public_key_from_id(self.test_signer_id)
+
+    def test_precomputed_public_key_verifies(self):
+        private_key, public_key = generate_keypair(self.test_output_path, self.test_signer_id)
+        digest = sha256("message")
+        signature = sign_digest(digest, private_key)
+        precomputed = precompute_public_key(public_key)
+        self.assertTrue(verify_signature(digest, signature, precomputed))
+        self.assertFalse(verify_signature(sha256("other"), signature, precomputed))
+
+
+class TestKeyRegistry(unittest.TestCase):
+    def setUp(self):
+        # Point the registry at a scratch directory
+        self.temp_dir = tempfile.mkdtemp()
+        self.json_path = os.path.join(self.temp_dir, "key_registry.json")
+        self.db_path = os.path.join(self.temp_dir, "key_registry.db")
+        key_manager.close_registry()
+        self.patches = [
+            patch.object(key_manager, 'KEY_REGISTRY_PATH', self.json_path),
+            patch.object(key_manager, 'KEY_REGISTRY_DB_PATH', self.db_path),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        key_manager.close_registry()
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def test_migrates_json_registry_once(self):
+        _, public_key = generate_keypair(self.temp_dir, "legacy")
+        key_manager.close_registry()
+        os.remove(self.db_path)
+
+        public_path = os.path.join(self.temp_dir, "public_key_legacy.pem")
+        private_path = os.path.join(self.temp_dir, "private_key_legacy.pem")
+        with open(self.json_path, 'w') as f:
+            json.dump({"legacy": public_path + "," + private_path}, f)
+
+        self.assertEqual(key_manager.lookup_signer("legacy"), (public_path, private_path))
+        self.assertEqual(get_public_key_from_id("legacy").to_string(), public_key.to_string())
+
+        # Later edits to the JSON file are not imported again
+        with open(self.json_path, 'w') as f:
+            json.dump({"other": public_path + "," + private_path}, f)
+        key_manager.close_registry()
+        with self.assertRaises(KeyError):
+            key_manager.lookup_signer("other")
+
+    def test_concurrent_registrations_are_not_lost(self):
+        signer_ids = [f"signer{i}" for i in range(16)]
+        threads = [threading.Thread(target=generate_keypair, args=(self.temp_dir, signer_id)) for signer_id in signer_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for signer_id in signer_ids:
+            self.assertIsNotNone(get_public_key_from_id(signer_id))
+
+    def test_concurrent_registrations_of_one_signer_keep_the_winners_keys(self):
+        keys_path = os.path.join(self.temp_dir, "keys")
+        results = []
+        errors = []
+        def register():
+            try:
+                results.append(generate_keypair(keys_path, "contested"))
+            except ValueError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=register) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(errors), 15)
+        private_key, public_key = results[0]
+        self.assertEqual(get_private_key_from_id("contested").to_string(), private_key.to_string())
+        self.assertEqual(get_public_key_from_id("contested").to_string(), public_key.to_string())
+        # The losing registrations leave no key files behind
+        self.assertEqual(sorted(os.listdir(keys_path)), ["private_key_contested.pem", "public_key_contested.pem"])
+
+    def test_reset_registry(self):
+        generate_keypair(self.temp_dir, "to_reset")
+        self.assertIsNotNone(get_private_key_from_id("to_reset"))
+        key_manager.reset_registry()
+        with self.assertRaises(KeyError):
+            get_private_key_from_id("to_reset")
+
 
 class TestSigner(unittest.TestCase):
     def setUp(self):
         self.test_output_path = "./tests/keys"
         self.test_signer_id = "test_signer"
         os.makedirs(self.test_output_path, exist_ok=True)
+        use_temp_registry(self)
         # Generate test keypair
         self.private_key, self.public_key = generate_keypair(self.test_output_path, self.test_signer_id)
         self.test_message = b"test message"
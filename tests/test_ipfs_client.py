@@ -0,0 +1,219 @@
+import unittest
+from unittest.mock import patch
+import os
+import json
+import tempfile
+import threading
+import time
+from unittest.mock import MagicMock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from storage import ipfs_client
+from storage.ipfs_client import (
+    IPFSDaemon,
+    IPFSHTTPClient,
+    IPFSAPIError,
+    parse_multiaddr,
+    connect_api,
+    add_file,
+    get_file,
+    pin_file,
+    unpin_file,
+    resolve_path
+)
+
+
+class StandInIPFSHandler(BaseHTTPRequestHandler):
+    # Keep-alive responses, like the real daemon
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((url.path, params, body))
+        arg = params.get("arg", [""])[0]
+
+        if url.path == "/api/v0/add":
+            self.reply(200, json.dumps({"Name": "test.txt", "Hash": "QmAdded", "Size": str(len(body))}).encode() + b"\n")
+        elif url.path == "/api/v0/cat":
+            self.reply(200, self.server.files.get(arg, b""), "text/plain")
+        elif url.path in ("/api/v0/pin/add", "/api/v0/pin/rm"):
+            self.reply(200, json.dumps({"Pins": [arg]}).encode())
+        elif url.path == "/api/v0/version":
+            self.reply(200, json.dumps({"Version": "0.0.0-standin"}).encode())
+        elif url.path == "/api/v0/resolve":
+            if arg == "bad":
+                self.reply(500, json.dumps({"Message": "invalid path", "Code": 0}).encode())
+            else:
+                self.reply(200, json.dumps({"Path": f"/ipfs/{arg}"}).encode())
+        else:
+            self.reply(404, b"404 page not found", "text/plain")
+
+
+class TestIPFSHTTPClient(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInIPFSHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.files = {"QmTest123": b"test content"}
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self.thread.start()
+
+        self.multiaddr = f"/ip4/127.0.0.1/tcp/{self.server.server_address[1]}"
+        self.client = connect_api(self.multiaddr)
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.test_file_path = os.path.join(self.temp_dir, "test.txt")
+        with open(self.test_file_path, "wb") as f:
+            f.write(b"test content")
+
+    def tearDown(self):
+        connect_api()
+        self.server.shutdown()
+        self.server.server_close()
+        for name in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, name))
+        os.rmdir(self.temp_dir)
+
+    def test_parse_multiaddr(self):
+        self.assertEqual(parse_multiaddr("/ip4/127.0.0.1/tcp/5001"), ("127.0.0.1", 5001))
+        with self.assertRaises(ValueError):
+            parse_multiaddr("/ip4/127.0.0.1/udp/5001")
+
+    def test_add_file_streams_multipart(self):
+        self.assertEqual(add_file(self.test_file_path), "QmAdded")
+
+        path, params, body = self.server.requests[-1]
+        self.assertEqual(path, "/api/v0/add")
+        self.assertEqual(params["pin"], ["true"])
+        self.assertIn(b'filename="test.txt"', body)
+        self.assertIn(b"\r\n\r\ntest content\r\n--", body)
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            add_file(self.test_file_path)
+            resolve_path("QmTest123")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_get_file(self):
+        output_path = os.path.join(self.temp_dir, "output.txt")
+        self.assertTrue(get_file("QmTest123", output_path))
+        with open(output_path, "rb") as f:
+            self.assertEqual(f.read(), b"test content")
+
+    def test_pin_and_unpin(self):
+        self.assertEqual(pin_file("QmTest123"), "pinned QmTest123 recursively")
+        self.assertEqual(unpin_file("QmTest123"), "unpinned QmTest123")
+
+    def test_resolve_path(self):
+        self.assertEqual(resolve_path("QmTest123"), "/ipfs/QmTest123")
+
+    def test_api_errors_return_none(self):
+        with self.assertRaises(IPFSAPIError):
+            self.client.resolve("bad")
+        self.assertIsNone(resolve_path("bad"))
+
+    def test_falls_back_to_cli_when_daemon_unreachable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        connect_api("/ip4/127.0.0.1/tcp/1")
+
+        with patch("storage.ipfs_client.run_ipfs_command", return_value="QmFromCli") as run:
+            self.assertEqual(add_file(self.test_file_path), "QmFromCli")
+        run.assert_called_once_with(["add", "-Q", self.test_file_path])
+
+
+
+class TestIPFSDaemon(unittest.TestCase):
+    def setUp(self):
+        # Reserve a free port for the stand-in daemon
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInIPFSHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.port = self.server.server_address[1]
+        self.multiaddr = f"/ip4/127.0.0.1/tcp/{self.port}"
+        self.serving = False
+
+    def tearDown(self):
+        if self.serving:
+            self.server.shutdown()
+        self.server.server_close()
+
+    def serve(self):
+        self.serving = True
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    @patch("storage.ipfs_client.subprocess.Popen")
+    def test_reuses_running_daemon(self, popen):
+        self.serve()
+        daemon = IPFSDaemon(self.multiaddr)
+        self.assertTrue(daemon.start())
+        self.assertTrue(daemon.reused)
+        self.assertTrue(daemon.ready.is_set())
+        popen.assert_not_called()
+
+    @patch("storage.ipfs_client.subprocess.Popen")
+    def test_background_start_polls_until_ready(self, popen):
+        process = MagicMock()
+        process.poll.return_value = None
+        popen.return_value = process
+        # Nothing is listening yet
+        self.server.server_close()
+
+        daemon = IPFSDaemon(self.multiaddr)
+        started = time.monotonic()
+        self.assertTrue(daemon.start(background=True, timeout=5))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertFalse(daemon.ready.is_set())
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), StandInIPFSHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.serve()
+        self.assertTrue(daemon.ready.wait(5))
+        daemon.process = None
+
+    @patch("storage.ipfs_client.subprocess.Popen")
+    def test_gives_up_at_deadline(self, popen):
+        process = MagicMock()
+        process.poll.return_value = None
+        popen.return_value = process
+        self.server.server_close()
+
+        daemon = IPFSDaemon(self.multiaddr)
+        self.assertFalse(daemon.start(timeout=0.2))
+        self.assertFalse(daemon.ready.is_set())
+        daemon.process = None
+
+    @patch("storage.ipfs_client.subprocess.Popen")
+    def test_detects_daemon_exit(self, popen):
+        process = MagicMock()
+        process.poll.return_value = 1
+        process.returncode = 1
+        popen.return_value = process
+        self.server.server_close()
+
+        daemon = IPFSDaemon(self.multiaddr)
+        started = time.monotonic()
+        self.assertFalse(daemon.start(timeout=5))
+        self.assertLess(time.monotonic() - started, 1)
+        daemon.process = None
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import os
+import tempfile
+import threading
+from storage.upload_queue import UploadQueue, PENDING, UPLOADED, FAILED
+
+
+class TestUploadQueue(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, name))
+        os.rmdir(self.temp_dir)
+
+    def make_file(self, name, content=b"data"):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_submit_returns_before_upload(self):
+        release = threading.Event()
+
+        def uploader(path):
+            release.wait(5)
+            return "Qm" + os.path.basename(path)
+
+        uploads = UploadQueue(uploader=uploader, workers=1)
+        document = uploads.submit(b"\x01" * 32, self.make_file("a"))
+        self.assertEqual(document["status"], PENDING)
+        self.assertIsNone(document["ipfs_hash"])
+
+        release.set()
+        self.assertTrue(uploads.wait(5))
+        self.assertEqual(document["status"], UPLOADED)
+        self.assertEqual(document["ipfs_hash"], "Qma")
+        self.assertIs(uploads.get(b"\x01" * 32), document)
+        uploads.close()
+
+    def test_files_are_removed_after_upload(self):
+        uploads = UploadQueue(uploader=lambda path: "QmFile", workers=2)
+        paths = [self.make_file(f"f{i}") for i in range(5)]
+        for i, path in enumerate(paths):
+            uploads.submit(bytes([i]) * 32, path)
+        uploads.close()
+
+        self.assertEqual(os.listdir(self.temp_dir), [])
+        self.assertTrue(all(uploads.get(bytes([i]) * 32)["status"] == UPLOADED for i in range(5)))
+
+    def test_failed_upload_is_recorded(self):
+        def uploader(path):
+            raise OSError("daemon unavailable")
+
+        uploads = UploadQueue(uploader=uploader, workers=1)
+        document = uploads.submit(b"\x02" * 32, self.make_file("b"))
+        uploads.close()
+
+        self.assertEqual(document["status"], FAILED)
+        self.assertIsNone(document["ipfs_hash"])
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "b")))
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def uploader(path):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            threading.Event().wait(0.01)
+            with lock:
+                active[0] -= 1
+            return "QmFile"
+
+        uploads = UploadQueue(uploader=uploader, workers=2, batch_size=3)
+        for i in range(12):
+            uploads.submit(bytes([i]) * 32, self.make_file(f"c{i}"))
+        uploads.close()
+
+        self.assertLessEqual(active[1], 2)
+        with self.assertRaises(RuntimeError):
+            uploads.submit(b"\x03" * 32, self.make_file("d"))
+
+    def test_finished_documents_are_bounded(self):
+        release = threading.Event()
+
+        def uploader(path):
+            release.wait(5)
+            return "Qm" + os.path.basename(path)
+
+        uploads = UploadQueue(uploader=uploader, workers=1, finished_size=2)
+        hashes = [bytes([i]) * 32 for i in range(4)]
+        for i, file_hash in enumerate(hashes):
+            uploads.submit(file_hash, self.make_file(f"e{i}"))
+
+        # Pending uploads are never evicted
+        self.assertEqual([uploads.get(file_hash)["status"] for file_hash in hashes], [PENDING] * 4)
+
+        release.set()
+        uploads.close()
+        self.assertEqual(list(uploads.finished), hashes[2:])
+        self.assertEqual(uploads.pending, {})
+        self.assertIsNone(uploads.get(hashes[0]))
+        self.assertEqual(uploads.get(hashes[3])["ipfs_hash"], "Qme3")
+
+
+if __name__ == "__main__":
+    unittest.main()